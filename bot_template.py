@@ -1,7 +1,9 @@
 import os
 import re
+import json
 import base64
 import logging
+import httpx
 import requests
 from fastapi import FastAPI, Request
 from telegram import Update
@@ -25,6 +27,8 @@ logger.addHandler(fh)
 # --- КОНСТАНТЫ ---
 AMVERA_API_KEY = os.getenv("AMVERA_API_KEY")
 AMVERA_MODEL = os.getenv("AMVERA_MODEL", "gpt")
+# Потоковый ответ (handle_task_stream): 0 — весь ответ одним фрагментом
+AMVERA_STREAM = os.getenv("AMVERA_STREAM", "1") != "0"
 
 # === Проверка ключа и модели ===
 if not AMVERA_API_KEY:
@@ -96,46 +100,175 @@ def process_llm_response(chat_id: int, response: str):
 
 # === ГЛАВНАЯ ФУНКЦИЯ ===
 
+def _build_query(task: str):
+    """
+    Собирает запрос к LLM из PROMPT и задачи.
+    Возвращает (query, error) — error заполнен, если запрос отправлять нельзя.
+    Размер промпта ограничивает менеджер (бюджет токенов), здесь запрос не обрезается:
+    обрезка по символам могла выкинуть PROMPT целиком.
+    """
+    if not AMVERA_API_KEY:
+        return None, "⚠️ Ошибка: отсутствует AMVERA_API_KEY. Укажите его в .env"
+
+    if not task or not isinstance(task, str):
+        return None, "⚠️ Ошибка: пустая задача"
+
+    task = task.strip()
+    # Менеджер уже кладёт PROMPT в начало задачи — не отправляем роль дважды
+    if PROMPT and PROMPT.strip() in task:
+        query = task
+    else:
+        query = (PROMPT or "") + "\n\nПользователь: " + task
+    logger.info(f"Запрос к LLM: {query[:120]}... ({len(query)} символов)")
+    return query, None
+
+
+def _extract_text(resp):
+    """Достаёт текст из ответа LLM любого формата."""
+    if hasattr(resp, "content"):
+        return resp.content
+    elif isinstance(resp, dict) and "content" in resp:
+        return resp["content"]
+    elif isinstance(resp, str):
+        return resp
+    else:
+        return str(resp)
+
+
 def handle_task(task: str):
     """
     Выполняет задачу агента через LLM Amvera.
     Возвращает чистый текст результата.
     """
-    if isinstance(task, str) and len(task) > 4000:
-        task = task[-4000:]
+    query, error = _build_query(task)
+    if error:
+        return error
 
     try:
-        if not AMVERA_API_KEY:
-            return "⚠️ Ошибка: отсутствует AMVERA_API_KEY. Укажите его в .env"
-
-        if not task or not isinstance(task, str):
-            return "⚠️ Ошибка: пустая задача"
-
-        query = (PROMPT or "") + "\n\nПользователь: " + task.strip()
-        logger.info(f"Запрос к LLM: {query[:120]}...")
-
-        # Основной вызов LLM
-        if len(query) > 4000:
-            logger.warning(f"⚠️ Контекст слишком длинный ({len(query)} символов) — обрезаем до 4000.")
-            query = query[-4000:]
-        resp = llm.invoke(query)
-        
-
-        # Обработка результатов
-        if hasattr(resp, "content"):
-            return resp.content
-        elif isinstance(resp, dict) and "content" in resp:
-            return resp["content"]
-        elif isinstance(resp, str):
-            return resp
-        else:
-            return str(resp)
+        return _extract_text(llm.invoke(query))
+    except Exception as e:
+        logger.exception(f"Ошибка LLM: {e}")
+        return f"⚠️ Ошибка при обработке запроса: {e}"
+
+
+async def handle_task_async(task: str):
+    """
+    Асинхронный вариант handle_task — менеджер вызывает его в первую очередь.
+    llm.ainvoke ходит через общий httpx.AsyncClient клиента LLM (keep-alive),
+    поэтому поток на время ожидания ответа не занимается.
+    """
+    query, error = _build_query(task)
+    if error:
+        return error
 
+    try:
+        return _extract_text(await llm.ainvoke(query))
     except Exception as e:
         logger.exception(f"Ошибка LLM: {e}")
         return f"⚠️ Ошибка при обработке запроса: {e}"
 
 
+# === ПОТОКОВЫЙ ОТВЕТ ===
+# У AmveraLLM нет _astream: llm.astream() сводится к ainvoke и отдаёт весь
+# ответ одним фрагментом. Поэтому поток читается из API напрямую.
+_stream_client = None
+
+
+def _get_stream_client():
+    global _stream_client
+    if _stream_client is None:
+        _stream_client = httpx.AsyncClient(
+            base_url=llm.base_url,
+            headers={
+                "accept": "text/event-stream, application/json",
+                "Content-Type": "application/json",
+                "X-Auth-Token": f"Bearer {AMVERA_API_KEY}",
+            },
+            timeout=httpx.Timeout(connect=10.0, read=120.0, write=30.0, pool=10.0),
+        )
+    return _stream_client
+
+
+def _stream_text(data: dict, sent: str) -> str:
+    """
+    Новый текст из очередного события потока.
+    OpenAI-формат отдаёт приращения (choices[0].delta.content), формат Amvera
+    (result.alternatives) — накопленный текст, из которого берётся только прирост.
+    """
+    if data.get("choices"):
+        choice = data["choices"][0]
+        if "delta" in choice:
+            return choice["delta"].get("content") or ""
+        text = (choice.get("message") or {}).get("content") or ""
+    else:
+        alternatives = (data.get("result") or {}).get("alternatives") or []
+        text = ((alternatives[0] if alternatives else {}).get("message") or {}).get("text") or ""
+    return text[len(sent):] if text.startswith(sent) else text
+
+
+async def _astream_amvera(query: str):
+    """
+    Отдаёт ответ Amvera API фрагментами по мере генерации ("stream": true).
+    Понимает SSE ("data: {...}") и JSON-строки. Если API потока не поддерживает
+    и вернул один JSON — он придёт одним фрагментом.
+    """
+    endpoint = "/models/gpt" if AMVERA_MODEL.startswith("gpt") else "/models/llama"
+    payload = {"model": AMVERA_MODEL, "messages": [{"role": "user", "text": query}], "stream": True}
+    sent, rest = "", []
+    async with _get_stream_client().stream("POST", endpoint, json=payload) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            line = line.strip()
+            if line.startswith("data:"):
+                line = line[5:].strip()
+            if not line or line == "[DONE]":
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError:
+                rest.append(line)  # обычный JSON, разбитый на строки
+                continue
+            text = _stream_text(data, sent)
+            if text:
+                sent += text
+                yield text
+    if not sent and rest:
+        text = _stream_text(json.loads("\n".join(rest)), "")
+        if text:
+            yield text
+
+
+async def handle_task_stream(task: str):
+    """
+    Потоковый вариант: отдаёт текст ответа LLM фрагментами по мере генерации.
+    Используется менеджером для /assign_task_stream. Если поток не удалось
+    открыть (AMVERA_STREAM=0, ошибка до первого фрагмента) — ответ приходит
+    одним фрагментом через llm.ainvoke.
+    """
+    query, error = _build_query(task)
+    if error:
+        yield error
+        return
+
+    started = False
+    try:
+        if AMVERA_STREAM:
+            try:
+                async for text in _astream_amvera(query):
+                    started = True
+                    yield text
+                if started:
+                    return
+            except Exception as e:
+                if started:
+                    raise
+                logger.warning(f"Поток Amvera недоступен ({e}) — ответ придёт целиком")
+        yield _extract_text(await llm.ainvoke(query))
+    except Exception as e:
+        logger.exception(f"Ошибка LLM: {e}")
+        yield f"⚠️ Ошибка при обработке запроса: {e}"
+
+
 # === TELEGRAM WEBHOOK ===
 @app.post("/webhook")
 async def webhook(request: Request):
@@ -146,7 +279,7 @@ async def webhook(request: Request):
         if update.message and update.message.text:
             user_text = update.message.text
             chat_id = update.message.chat.id
-            result = handle_task(user_text)
+            result = await handle_task_async(user_text)
             process_llm_response(chat_id, result)
         return {"ok": True}
     except Exception as e:
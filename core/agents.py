@@ -7,12 +7,19 @@ sys.path.append(os.path.dirname(__file__))
 
 import asyncio
 from pathlib import Path
-import importlib.util
 from fastapi import APIRouter, Request, Form, HTTPException, Request, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from utils import load_meta, save_meta, call_agent_local, call_agent_remote, save_memory, ensure_user_root, filter_meta_by_owner
-from mcp import load_context, save_context
+from utils import load_meta, call_agent_local, call_agent_remote, save_memory, ensure_user_root, filter_meta_by_owner
+from core.mcp import context_store
+from core.loader import load_agent_module, registry
+from core.executor import agent_executor
+from core.render import IncrementalMarkdown, normalize_result_text, render_markdown
+from core.fanout import fan_out
+from core.meta_store import meta_store
+from core.results import result_store
+from core.memory import memory_index
+from core.retrieval import memory_retriever
 
 
 
@@ -46,13 +53,7 @@ async def index(request: Request):
 
 @router.get("/folder/{folder_name}")
 async def get_folder_agents(folder_name: str, user: str = Depends(get_current_user)):
-    meta = load_meta()
-    agents = [
-        a for a in meta
-        if not a.get("is_folder", False)
-        and a.get("folder") == folder_name
-        and a.get("owner") == user
-    ]
+    agents = meta_store.find(owner=user, folder=folder_name, is_folder=False)
     return JSONResponse(agents)
 
 
@@ -70,8 +71,7 @@ async def view_agent(request: Request, slug: str):
 @router.get("/api/agent/{slug}")
 async def get_agent_data(slug: str, user: str = Depends(get_current_user)):
     """Возвращает данные агента (только для владельца)."""
-    meta = load_meta()
-    agent = next((a for a in meta if a["slug"] == slug and a.get("owner") == user), None)
+    agent = meta_store.get(slug, owner=user)
     if not agent:
         raise HTTPException(status_code=403, detail="Access denied")
 
@@ -89,6 +89,7 @@ async def get_agent_data(slug: str, user: str = Depends(get_current_user)):
         "status": agent.get("status", "ready"),
         "prompt": prompt,
         "path": agent["path"],
+        "llm_cache": agent.get("llm_cache", True),
     }
 
 
@@ -109,9 +110,8 @@ async def create_agent(
     slug = slugify(name)
     folder = folder.strip() or "root"
 
-    meta = load_meta()
-    # Фильтрация только по текущему пользователю
-    user_meta = filter_meta_by_owner(meta, user)
+    # Только записи текущего пользователя
+    user_meta = meta_store.find(owner=user)
 
     if any(a.get("slug") == slug or a.get("name").lower() == name.lower() for a in user_meta):
         return JSONResponse({"ok": False, "error": f"Сотрудник '{name}' уже существует"})
@@ -146,7 +146,7 @@ async def create_agent(
         if src.exists():
             shutil.copy(src, dest / fn)
 
-    # === Добавляем запись в agents.json ===
+    # === Добавляем запись в метаданные ===
     entry = {
         "name": name,
         "slug": slug,
@@ -158,8 +158,7 @@ async def create_agent(
         "deploy_url": "",
         "status": "created"
     }
-    meta.append(entry)
-    save_meta(meta)
+    meta_store.create(entry)
 
     # === Telegram webhook (если указан токен) ===
     if telegram_token.strip():
@@ -174,7 +173,7 @@ async def create_agent(
             )
             if r.status_code == 200 and r.json().get("ok"):
                 entry["deploy_url"] = webhook_url
-                save_meta(meta)
+                meta_store.update(slug, user, {"deploy_url": webhook_url})
             else:
                 logger.warning("Не удалось установить webhook: %s", r.text)
         except Exception as e:
@@ -193,19 +192,22 @@ async def update_agent(
     deploy_url: str = Form(''),
     folder: str = Form(''),
     team_bias: float = Form(0.5),
+    llm_cache: bool | None = Form(None),
     user: str = Depends(get_current_user)
 ):
-    meta = load_meta()
-    agent = next((a for a in meta if a["slug"] == slug and a.get("owner") == user), None)
+    agent = meta_store.get(slug, owner=user)
     if not agent:
         raise HTTPException(status_code=403, detail="Access denied")
 
-    agent.update({
+    changes = {
         "name": name.strip(),
         "deploy_url": deploy_url.strip(),
         "folder": folder.strip() or agent.get("folder", "root"),
         "team_bias": team_bias
-    })
+    }
+    if llm_cache is not None:
+        # Агент может отказаться от кэша ответов LLM (например, если нужна «свежая» генерация)
+        changes["llm_cache"] = llm_cache
 
     # обновляем PROMPT в bot.py
     bot_file = Path(agent["path"]) / "bot.py"
@@ -214,7 +216,8 @@ async def update_agent(
         code = re.sub(r'PROMPT\s*=\s*""".*?"""', f'PROMPT = """{prompt.strip()}"""', code, flags=re.DOTALL)
         bot_file.write_text(code, encoding="utf-8")
 
-    save_meta(meta)
+    context_store.move(agent, changes["folder"])
+    meta_store.update(slug, user, changes)
     logger.info(f"✅ Обновлены данные агента {slug}")
     return JSONResponse({"ok": True, "message": f"Изменения агента '{slug}' сохранены"})
 
@@ -235,9 +238,8 @@ async def create_folder(name: str = Form(...), user: str = Depends(get_current_u
 
     folder_path.mkdir(parents=True, exist_ok=True)
 
-    meta = load_meta()
-    if not any(a.get("is_folder") and a.get("folder") == folder and a.get("owner") == user for a in meta):
-        meta.append({
+    if not meta_store.find(owner=user, folder=folder, is_folder=True):
+        meta_store.create({
             "folder": folder,
             "is_folder": True,
             "name": folder,
@@ -245,7 +247,6 @@ async def create_folder(name: str = Form(...), user: str = Depends(get_current_u
             "owner": user,  # ✅ владелец
             "created_at": __import__('datetime').datetime.utcnow().isoformat() + 'Z'
         })
-        save_meta(meta)
 
     return JSONResponse({"ok": True, "folder": folder})
 
@@ -254,7 +255,7 @@ async def create_folder(name: str = Form(...), user: str = Depends(get_current_u
 async def delete_folder(name: str = Form(...), user: str = Depends(get_current_user)):
     """
     Удаляет каталог текущего пользователя, если он пуст,
-    и убирает запись из agents.json.
+    и убирает его записи из метаданных.
     """
     import json
     folder = name.strip()
@@ -269,15 +270,8 @@ async def delete_folder(name: str = Form(...), user: str = Depends(get_current_u
         print(f"⚠️ Папка {folder_path} не найдена")
         raise HTTPException(status_code=404, detail=f"Каталог '{folder}' не найден")
 
-    meta = load_meta()
-
     # Проверяем, есть ли агенты в каталоге пользователя
-    agents_in_folder = [
-        a for a in meta
-        if not a.get("is_folder", False)
-        and a.get("folder") == folder
-        and a.get("owner") == user
-    ]
+    agents_in_folder = meta_store.find(owner=user, folder=folder, is_folder=False)
     if agents_in_folder:
         count = len(agents_in_folder)
         print(f"❌ Каталог '{folder}' пользователя '{user}' не пуст ({count} агентов)")
@@ -287,19 +281,9 @@ async def delete_folder(name: str = Form(...), user: str = Depends(get_current_u
         # Удаляем сам каталог с диска
         shutil.rmtree(folder_path, ignore_errors=True)
 
-        # Фильтруем записи meta
-        new_meta = [
-            a for a in meta
-            if not (
-                (a.get("is_folder") and a.get("folder") == folder and a.get("owner") == user)
-                or (a.get("folder") == folder and a.get("owner") == user)
-                or (a.get("slug") == f"folder_{folder}_{user}")
-            )
-        ]
-
-        removed = len(meta) - len(new_meta)
-        save_meta(new_meta)
-        print(f"✅ Каталог '{folder}' ({user}) удалён. Убрано {removed} записей из agents.json")
+        # Удаляем записи каталога
+        removed = meta_store.delete_folder(folder, user)
+        print(f"✅ Каталог '{folder}' ({user}) удалён. Убрано {removed} записей из метаданных")
 
         return JSONResponse({"ok": True, "folder": folder, "removed": removed})
     except Exception as e:
@@ -357,56 +341,44 @@ async def assign_task_folder(
     🧩 Поручает задачу всем агентам в указанном каталоге.
     Каждый агент получает свою роль (PROMPT), общий контекст коллег и задачу.
     """
-    from core.mcp import load_context, save_context, merge_contexts
+    from core.mcp import load_context, update_context, merge_contexts
     from utils import call_agent_with_context, save_memory
-    import json, asyncio
+    import json
     logger.info(f"[assign_task_folder] {user=} folder='{folder}' task='{task}'")
 
-    meta = load_meta()
-    agents_in_folder = [
-        a for a in meta
-        if a.get("folder") == folder
-        and not a.get("is_folder")
-        and a.get("owner") == user
-    ]
+    agents_in_folder = meta_store.find(owner=user, folder=folder, is_folder=False)
     if not agents_in_folder:
         return JSONResponse({"ok": False, "error": f"Нет сотрудников в каталоге '{folder}'"}, status_code=404)
 
     # 🧠 Групповой контекст
-    all_contexts = {a["slug"]: load_context(a["slug"]) for a in agents_in_folder}
+    all_contexts = {a["slug"]: load_context(a) for a in agents_in_folder}
     merged_context = merge_contexts(*all_contexts.values())
     context_text = json.dumps(merged_context, ensure_ascii=False, indent=2)
 
-    results = []
-
     async def handle(agent):
         slug = agent["slug"]
-        try:
-            enriched_task = (
-                f"{task}\n\n"
-                f"📘 Контексты коллег:\n{context_text}\n\n"
-                f"Ответь с учётом своей роли и общего контекста команды."
-            )
-
-            res = await call_agent_with_context(agent, enriched_task)
-            result_text = res.get("result") if isinstance(res, dict) else str(res)
-
-            save_memory(Path(agent["path"]), {"task": f"GroupTask: {task}", "result": result_text})
-            ctx = load_context(slug)
-            ctx.update({
-                "last_group_task": task,
-                "last_group_result": result_text,
-                "colleague_contexts": list(all_contexts.keys())
-            })
-            save_context(slug, ctx)
-
-            results.append({"agent": slug, "result": result_text})
-        except Exception as e:
-            logger.exception(f"Ошибка у агента {slug}: {e}")
-            results.append({"agent": slug, "error": str(e)})
+        enriched_task = (
+            f"{task}\n\n"
+            f"📘 Контексты коллег:\n{context_text}\n\n"
+            f"Ответь с учётом своей роли и общего контекста команды."
+        )
+
+        res = await call_agent_with_context(agent, enriched_task)
+        if isinstance(res, dict) and not res.get("ok", True):
+            raise RuntimeError(res.get("error") or "Агент вернул ошибку")
+        result_text = res.get("result") if isinstance(res, dict) else str(res)
+
+        save_memory(Path(agent["path"]), {"task": f"GroupTask: {task}", "result": result_text},
+                    owner=agent.get("owner"), slug=slug)
+        update_context(agent, {
+            "last_group_task": task,
+            "last_group_result": result_text,
+            "colleague_contexts": list(all_contexts.keys())
+        })
+        return result_text
 
-    await asyncio.gather(*[handle(a) for a in agents_in_folder])
-    return JSONResponse({"ok": True, "folder": folder, "results": results})
+    run = await fan_out(agents_in_folder, handle)
+    return JSONResponse({"ok": True, "folder": folder, **run})
 
 
 
@@ -423,40 +395,26 @@ async def assign_task(
     logger.info("Назначаем задачу '%s' агенту %s", task, slug)
 
     try:
-        meta = load_meta()
-        entry = next((e for e in meta if e["slug"] == slug and e.get("owner") == user), None)
+        entry = meta_store.get(slug, owner=user)
         if not entry:
             raise HTTPException(status_code=403, detail="Access denied")
 
         from utils import call_agent_with_context
         res = await call_agent_with_context(entry, task)
 
-        # 🧠 Нормализуем результат
+        # 🧠 Нормализуем результат (пустой ответ, JSON)
         if isinstance(res, dict):
             raw_text = res.get("result") or str(res)
         else:
-            raw_text = str(res or "").strip()
-
-        if not raw_text:
-            raw_text = "(пустой ответ от агента)"
-
-        # 🔧 Безопасная обработка JSON
-        if raw_text.lstrip().startswith(("{", "[")):
-            try:
-                parsed_json = json.loads(raw_text)
-                raw_text = json.dumps(parsed_json, ensure_ascii=False, indent=2)
-            except (json.JSONDecodeError, TypeError, ValueError):
-                logger.warning(f"[assign_task] ответ агента невалидный JSON, обрабатываю как текст")
+            raw_text = str(res or "")
+        raw_text = normalize_result_text(raw_text)
 
         # 🧩 Формируем HTML для вывода
-        from markdown2 import markdown
-        rendered_html = markdown(raw_text, extras=["fenced-code-blocks", "tables"])
-
-        parsed = {"html": rendered_html}
-        entry["last_task"] = {"task": task, "result": parsed}
-        save_meta(meta)
+        parsed = {"html": render_markdown(raw_text)}
+        result_store.append(user, slug, task, parsed)
 
-        return JSONResponse({"ok": True, "agent": slug, "result": parsed})
+        cached = bool(isinstance(res, dict) and res.get("cached"))
+        return JSONResponse({"ok": True, "agent": slug, "result": parsed, "cache": {"hit": cached}})
 
     except Exception as e:
         error_text = f"{type(e).__name__}: {e}"
@@ -468,6 +426,61 @@ async def assign_task(
 
 
 
+@router.post("/assign_task_stream")
+async def assign_task_stream(
+    slug: str = Form(...),
+    task: str = Form(...),
+    user: str = Depends(get_current_user)
+):
+    """
+    Потоковый вариант /assign_task (NDJSON, одна JSON-строка на событие):
+      {"type": "delta", "text": ...}  — очередной фрагмент ответа модели
+      {"type": "html", "html": ..., "pending": ...} — HTML завершённых Markdown-блоков
+                                      и ещё не отрендеренный хвост текста
+      {"type": "done", "result": {"html": ...}} — финальный результат
+      {"type": "error", "error": ...}
+    Память, контекст и результат сохраняются после окончания потока.
+    """
+    logger.info("Назначаем задачу (поток) '%s' агенту %s", task, slug)
+    entry = meta_store.get(slug, owner=user)
+    if not entry:
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    from utils import stream_agent_with_context
+
+    def line(event: dict) -> bytes:
+        return (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+
+    async def events():
+        md = IncrementalMarkdown()
+        try:
+            async for chunk in stream_agent_with_context(entry, task):
+                yield line({"type": "delta", "text": chunk})
+                html = md.feed(chunk)
+                if html:
+                    yield line({"type": "html", "html": html, "pending": md.pending})
+            # Поток закончился — хвост без пустой строки в конце тоже завершённый блок
+            html = md.finish()
+            if html:
+                yield line({"type": "html", "html": html, "pending": ""})
+
+            raw_text = normalize_result_text(md.buffer)
+            parsed = {"html": render_markdown(raw_text)}
+            save_memory(Path(entry["path"]), {"task": task, "result": raw_text}, owner=user, slug=slug)
+            result_store.append(user, slug, task, parsed)
+            yield line({"type": "done", "agent": slug, "result": parsed})
+        except Exception as e:
+            error_text = f"{type(e).__name__}: {e}"
+            logger.exception("Ошибка потоковой задачи агента %s: %s", slug, error_text)
+            yield line({"type": "error", "error": error_text})
+
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/assign_task_to_folder")
 async def assign_task_to_folder(
     folder: str = Form(...),
@@ -475,30 +488,22 @@ async def assign_task_to_folder(
     user: str = Depends(get_current_user)
 ):
     """Назначает задачу всем агентам пользователя в указанном каталоге."""
-    meta = load_meta()
-    agents = [
-        a for a in meta
-        if not a.get("is_folder", False)
-        and a.get("folder") == folder
-        and a.get("owner") == user
-    ]
+    agents = meta_store.find(owner=user, folder=folder, is_folder=False)
 
     if not agents:
         return JSONResponse({"ok": False, "error": f"Нет сотрудников в каталоге '{folder}'"}, status_code=404)
 
-    results = []
-    for agent in agents:
-        slug = agent.get("slug")
-        try:
-            res = await assign_task(slug=slug, task=task, user=user)
-            if isinstance(res, JSONResponse):
-                body = res.body.decode()
-                res = json.loads(body) if body.strip() else {"ok": False, "error": "empty response"}
-            results.append({"agent": slug, "result": res})
-        except Exception as e:
-            results.append({"agent": slug, "error": str(e)})
+    async def handle(agent):
+        res = await assign_task(slug=agent.get("slug"), task=task, user=user)
+        if isinstance(res, JSONResponse):
+            body = res.body.decode()
+            res = json.loads(body) if body.strip() else {"ok": False, "error": "empty response"}
+        if not res.get("ok"):
+            raise RuntimeError(res.get("error") or "empty response")
+        return res
 
-    return JSONResponse({"ok": True, "results": results})
+    run = await fan_out(agents, handle)
+    return JSONResponse({"ok": True, **run})
 
 
 
@@ -506,31 +511,32 @@ async def assign_task_to_folder(
 @router.post('/agents/{folder}/{slug}/webhook')
 async def proxy_agent_webhook(request: Request, slug: str, folder: str = None):
     try:
-        meta = load_meta()
+        candidates = meta_store.find(slug=slug)
         if folder:
-            agent = next((a for a in meta if a['slug'] == slug and a.get('folder') == folder), None)
+            agent = next((a for a in candidates if a.get('folder') == folder), None)
         else:
-            agent = next((a for a in meta if a['slug'] == slug and not a.get('folder')), None) or                     next((a for a in meta if a['slug'] == slug), None)
+            agent = next((a for a in candidates if not a.get('folder')), None) or next(iter(candidates), None)
         if not agent:
             raise HTTPException(status_code=404, detail='Agent not found')
         bot_path = Path(agent['path']) / 'bot.py'
         if not bot_path.exists():
             raise HTTPException(status_code=404, detail='bot.py not found')
-        spec = importlib.util.spec_from_file_location(f"agent_{slug}", str(bot_path))
-        mod = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(mod)
+        mod = await agent_executor.run(load_agent_module, bot_path.parent, owner=agent.get('owner'))
         data = await request.json()
         if hasattr(mod, 'app'):
             from fastapi.testclient import TestClient
             client = TestClient(mod.app)
-            resp = client.post('/webhook', json=data)
+            resp = await agent_executor.run(client.post, '/webhook', json=data, owner=agent.get('owner'))
             try:
                 return JSONResponse(resp.json(), status_code=resp.status_code)
             except Exception:
                 return JSONResponse({'ok': True, 'status_code': resp.status_code, 'text': resp.text}, status_code=resp.status_code)
+        text = data.get('message', {}).get('text', '')
+        if hasattr(mod, 'handle_task_async'):
+            res = await agent_executor.run_async(mod.handle_task_async, text, owner=agent.get('owner'))
+            return JSONResponse({'ok': True, 'result': res})
         if hasattr(mod, 'handle_task'):
-            text = data.get('message', {}).get('text', '')
-            res = mod.handle_task(text)
+            res = await agent_executor.run(mod.handle_task, text, owner=agent.get('owner'))
             return JSONResponse({'ok': True, 'result': res})
         raise HTTPException(status_code=500, detail='No webhook or handler found for agent')
     except HTTPException:
@@ -548,12 +554,9 @@ def get_folders(user: str = Depends(get_current_user)):
     Возвращает список всех каталогов (папок) текущего пользователя.
     Показывает только те, у которых is_folder=True.
     """
-    meta = load_meta()
-    user_meta = filter_meta_by_owner(meta, user)
     folders = sorted({
         a.get("folder", "root")
-        for a in user_meta
-        if a.get("is_folder", False)
+        for a in meta_store.find(owner=user, is_folder=True)
     })
     return JSONResponse(folders)
 
@@ -561,12 +564,7 @@ def get_folders(user: str = Depends(get_current_user)):
 async def list_agents(user: str = Depends(get_current_user)):
     """Возвращает список сотрудников текущего пользователя."""
     try:
-        meta = load_meta()
-        agents = [
-            a for a in meta
-            if not a.get("is_folder", False)
-            and a.get("owner") == user
-        ]
+        agents = meta_store.find(owner=user, is_folder=False)
         return JSONResponse(agents)
     except Exception as e:
         logger.exception("Ошибка при получении списка агентов: %s", e)
@@ -576,36 +574,31 @@ async def list_agents(user: str = Depends(get_current_user)):
 @router.post("/cleanup_meta")
 async def cleanup_meta(user: str = Depends(get_current_user)):
     """
-    Очищает agents.json от несуществующих агентов/каталогов
+    Очищает метаданные от несуществующих агентов/каталогов
     и удаляет физические папки без записей.
     """
     import json, shutil
     removed = 0
-    meta = load_meta()
     user_root = ensure_user_root(user)
     cleaned = []
 
-    for a in meta:
+    for a in meta_store.find(owner=user):
         try:
-            if a.get("owner") != user:
-                cleaned.append(a)
-                continue
-
             if a.get("is_folder"):
                 folder_path = user_root / a.get("folder")
                 if not folder_path.exists():
-                    removed += 1
+                    removed += meta_store.delete(a["slug"], user)
                     continue
             else:
                 path = Path(a.get("path", ""))
                 if not path.exists() or not (path / "bot.py").exists():
-                    removed += 1
+                    removed += meta_store.delete(a["slug"], user)
                     continue
             cleaned.append(a)
         except Exception as e:
             print(f"⚠️ Ошибка при проверке {a.get('name')}: {e}")
 
-    # Удаляем папки, которых нет в JSON
+    # Удаляем папки, у которых нет записей
     existing_folders = {a.get("folder") for a in cleaned if a.get("is_folder")}
     for f in user_root.iterdir():
         if f.is_dir() and f.name not in existing_folders:
@@ -615,24 +608,26 @@ async def cleanup_meta(user: str = Depends(get_current_user)):
             except Exception as e:
                 print(f"⚠️ Не удалось удалить {f}: {e}")
 
-    save_meta(cleaned)
     print(f"✅ Очистка завершена: удалено {removed}, осталось {len(cleaned)}")
     return {"ok": True, "removed": removed, "total": len(cleaned)}
 
 
 @router.post("/delete_agent")
 async def delete_agent(slug: str = Form(...), user: str = Depends(get_current_user)):
-    meta = load_meta()
-    entry = next((e for e in meta if e["slug"] == slug and e.get("owner") == user), None)
+    entry = meta_store.get(slug, owner=user)
     if not entry:
         raise HTTPException(status_code=403, detail="Access denied")
 
     try:
         p = Path(entry['path'])
+        registry.invalidate(p / "bot.py")
         if p.exists():
             shutil.rmtree(p)
-        meta = [e for e in meta if not (e['slug'] == slug and e.get("owner") == user)]
-        save_meta(meta)
+        meta_store.delete(slug, user)
+        context_store.forget(entry)
+        result_store.forget(user, slug)
+        memory_index.forget(user, slug)
+        memory_retriever.forget(p)
         return JSONResponse({"ok": True, "message": f"Агент '{slug}' удалён"})
     except Exception as e:
         logger.exception("Ошибка при удалении агента: %s", e)
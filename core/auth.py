@@ -6,62 +6,151 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from pathlib import Path
-import json, os
+import os, uuid
+from core.users import user_store, UserExists
+from core.passwords import password_hasher, login_throttle, HasherBusy
+from core.sessions import token_cache, revocations
 
 # === ИНИЦИАЛИЗАЦИЯ ===
 router = APIRouter()
 BASE = Path(__file__).resolve().parent.parent
 templates = Jinja2Templates(directory=str(BASE / "templates"))
-DATA_DIR = BASE / "data"
-USERS_FILE = DATA_DIR / "users.json"
-DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 SECRET_KEY = os.getenv("SECRET_KEY", "supersecret")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 360
+# С ротацией refresh-токенов access-токен живёт недолго: фронт обновляет его сам (/token/refresh)
+REFRESH_TOKEN_ROTATION = os.getenv("REFRESH_TOKEN_ROTATION", "1").lower() not in ("0", "false", "no")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30" if REFRESH_TOKEN_ROTATION else "360"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
 # === УТИЛИТЫ ===
-def load_users():
-    if not USERS_FILE.exists():
-        USERS_FILE.write_text("[]", encoding="utf-8")
-    return json.loads(USERS_FILE.read_text(encoding="utf-8"))
-
-def save_users(users):
-    USERS_FILE.write_text(json.dumps(users, ensure_ascii=False, indent=2), encoding="utf-8")
-
 def verify_password(plain, hashed): 
     return pwd_context.verify(plain, hashed)
 
 def get_password_hash(password): 
     return pwd_context.hash(password)
 
+async def _in_hasher(fn, *args):
+    """bcrypt — в отдельном пуле потоков, чтобы не останавливать event loop."""
+    try:
+        return await password_hasher.run(fn, *args)
+    except HasherBusy:
+        raise HTTPException(status_code=503, detail="Сервер перегружен, повторите попытку",
+                            headers={"Retry-After": "1"})
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
+    to_encode.setdefault("type", "access")
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+def create_refresh_token(username: str, fam: str):
+    return create_access_token({"sub": username, "fam": fam, "type": "refresh"},
+                               timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS))
+
+def issue_tokens(username: str, fam: str | None = None) -> dict:
+    """Access-токен (и refresh-токен того же семейства, если включена ротация)."""
+    fam = fam or uuid.uuid4().hex
+    tokens = {"ok": True, "access_token": create_access_token({"sub": username, "fam": fam}),
+              "token_type": "bearer", "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60}
+    if REFRESH_TOKEN_ROTATION:
+        tokens["refresh_token"] = create_refresh_token(username, fam)
+    return tokens
+
+def decode_token(token: str, expected_type: str = "access", check_revoked: bool = True) -> dict:
+    """
+    Проверенный payload токена. Проверка подписи — только при промахе кэша;
+    отзыв (jti или семейство) проверяется всегда.
+    """
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Неверный токен")
+        if payload.get("sub") is None:
+            raise HTTPException(status_code=401, detail="Неверный токен")
+        token_cache.put(token, payload)
+    # Токены, выданные до появления типов, — access-токены
+    if payload.get("type", "access") != expected_type:
+        raise HTTPException(status_code=401, detail="Неверный токен")
+    if check_revoked and revocations.is_revoked(payload):
+        raise HTTPException(status_code=401, detail="Токен отозван")
+    return payload
+
+def revoke_family(fam: str):
+    """Отзывает все токены одного входа (на срок жизни самого нового refresh-токена)."""
+    revocations.revoke(f"fam:{fam}", (datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)).timestamp())
+
 # === РЕГИСТРАЦИЯ ===
 @router.post("/register")
 async def register(username: str = Form(...), password: str = Form(...)):
-    users = load_users()
-    if any(u["username"] == username for u in users):
+    if user_store.get(username):
+        raise HTTPException(status_code=400, detail="Пользователь уже существует")
+    try:
+        user_store.create(username, await _in_hasher(get_password_hash, password))
+    except UserExists:
         raise HTTPException(status_code=400, detail="Пользователь уже существует")
-    users.append({"username": username, "password": get_password_hash(password)})
-    save_users(users)
     return {"ok": True, "message": f"Пользователь {username} зарегистрирован"}
 
 # === ВХОД (API) ===
 @router.post("/login")
-async def login(username: str = Form(...), password: str = Form(...)):
-    users = load_users()
-    user = next((u for u in users if u["username"] == username), None)
-    if not user or not verify_password(password, user["password"]):
+async def login(request: Request, username: str = Form(...), password: str = Form(...)):
+    # За прокси — адрес клиента из X-Forwarded-For (uvicorn, FORWARDED_ALLOW_IPS)
+    ip = request.client.host if request.client else None
+    wait = login_throttle.acquire(username, ip)
+    if wait:
+        raise HTTPException(status_code=429, detail="Слишком много неудачных попыток входа, попробуйте позже",
+                            headers={"Retry-After": str(wait)})
+    try:
+        user = user_store.get(username)
+        ok = bool(user) and await _in_hasher(verify_password, password, user["password"])
+    except BaseException:
+        login_throttle.release(username, ip)
+        raise
+    if not ok:
+        login_throttle.failure(username, ip)
         raise HTTPException(status_code=401, detail="Неверные учетные данные")
-    token = create_access_token({"sub": username})
-    return {"ok": True, "access_token": token, "token_type": "bearer"}
+    login_throttle.success(username, ip)
+    return issue_tokens(username)
+
+# === ОБНОВЛЕНИЕ И ОТЗЫВ ТОКЕНОВ ===
+@router.post("/token/refresh")
+async def refresh_tokens(refresh_token: str = Form(...)):
+    """
+    Ротация: старый refresh-токен отзывается, выдаётся новая пара того же семейства.
+    Тот же refresh-токен, предъявленный повторно в пределах REFRESH_TOKEN_REUSE_GRACE
+    (несколько вкладок обновились одновременно), получает ту же новую пару.
+    Более позднее предъявление уже использованного токена означает утечку —
+    тогда отзывается всё семейство (все токены этого входа).
+    """
+    if not REFRESH_TOKEN_ROTATION:
+        raise HTTPException(status_code=404, detail="Обновление токенов выключено")
+    payload = decode_token(refresh_token, expected_type="refresh", check_revoked=False)
+    fam = payload.get("fam")
+    if fam and revocations.is_revoked({"fam": fam}):
+        raise HTTPException(status_code=401, detail="Токен отозван")
+    tokens = revocations.rotate(payload["jti"], payload["exp"], issue_tokens(payload["sub"], fam))
+    token_cache.drop(refresh_token)
+    if tokens is None:
+        if fam:
+            revoke_family(fam)
+        raise HTTPException(status_code=401, detail="Токен отозван")
+    return tokens
+
+@router.post("/logout")
+async def logout(token: str = Depends(oauth2_scheme)):
+    """Отзывает текущий токен и всё его семейство (refresh-токены этого входа)."""
+    payload = decode_token(token)
+    if payload.get("fam"):
+        revoke_family(payload["fam"])
+    if payload.get("jti"):
+        revocations.revoke(payload["jti"], payload["exp"])
+    token_cache.drop(token)
+    return {"ok": True}
 
 # === HTML-СТРАНИЦА ВХОДА ===
 @router.get("/login", response_class=HTMLResponse)
@@ -71,14 +160,7 @@ async def login_page(request: Request):
 
 # === ПРОВЕРКА ТОКЕНА ===
 def get_current_user(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Неверный токен")
-        return username
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Неверный токен")
+    return decode_token(token)["sub"]
 
 # === ЗАЩИЩЕННЫЙ ТЕСТОВЫЙ МАРШРУТ ===
 @router.get("/me")
@@ -1,8 +1,10 @@
 from pathlib import Path
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Depends, Query
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
-import json
+from core.auth import get_current_user
+from core.meta_store import meta_store
+from core.memory import memory_index
 
 router = APIRouter()
 BASE = Path(__file__).resolve().parent.parent
@@ -20,20 +22,40 @@ async def checklist(request: Request):
         )
 
 @router.get("/check_memory")
-async def check_memory():
-    results = {}
+async def check_memory(
+    page: int = Query(1, ge=1),
+    per_page: int = Query(50, ge=1, le=200),
+    user: str = Depends(get_current_user),
+):
+    """
+    Последние 3 записи памяти каждого агента текущего пользователя (постранично).
+    Читается индекс хвостов памяти владельца, а не memory-журналы всех агентов.
+    """
     try:
-        for folder in AGENTS_DIR.rglob("memory.json"):
-            try:
-                data = json.loads(folder.read_text(encoding="utf-8"))
-                agent_name = folder.parent.name
-                results[agent_name] = data[-3:] if len(data) > 3 else data
-            except Exception as e:
-                results[folder.parent.name] = f"Ошибка чтения: {e}"
-        return JSONResponse({"ok": True, "memories": results})
+        agents = meta_store.find(owner=user, is_folder=False)
+        shard = memory_index.shard(user, agents)
+        slugs = sorted(a["slug"] for a in agents)
+        start = (page - 1) * per_page
+        results = {
+            slug: shard.get(slug, {}).get("tail", [])[-3:]
+            for slug in slugs[start:start + per_page]
+        }
+        return JSONResponse({
+            "ok": True,
+            "memories": results,
+            "page": page,
+            "per_page": per_page,
+            "total": len(slugs),
+        })
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)})
+
+
 @router.get("/memory")
-async def memory_alias():
+async def memory_alias(
+    page: int = Query(1, ge=1),
+    per_page: int = Query(50, ge=1, le=200),
+    user: str = Depends(get_current_user),
+):
     """Алиас для совместимости с фронтом."""
-    return await check_memory()
+    return await check_memory(page=page, per_page=per_page, user=user)
@@ -0,0 +1,194 @@
+"""
+Фоновое сжатие контекстов агентов (LLM-суммаризация).
+
+В контексте копятся ключи с полными ответами LLM (last_group_result,
+brainstorm_result, teamthink_result, ...), а при сборке промпта они всё равно
+обрезаются по бюджету — и знания команды теряются как попало. Когда контекст
+агента после записи превышает CONTEXT_COMPACT_TOKENS, он ставится в очередь:
+фоновая задача просит самого агента (его bot.py, через call_agent_local)
+свести старые записи и прежнюю сводку в одну короткую сводку digest.
+Сжатые записи заменяются сводкой одним событием журнала контекста, а их
+исходные значения уходят в архив <slug>.archive.jsonl (см. core/mcp.py).
+Записи, изменившиеся, пока шло сжатие, не трогаются. Статистика последнего
+сжатия лежит в служебном ключе _compacted, общие счётчики — в /api/metrics.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import datetime
+from pathlib import Path
+from core.mcp import context_store, context_key
+from core.tokens import count_tokens, truncate_tokens, truncate_chars
+from utils import call_agent_local, agent_char_limit, _agent_model
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+CONTEXT_COMPACT_ENABLED = os.getenv("CONTEXT_COMPACT", "1") != "0"
+CONTEXT_COMPACT_TOKENS = int(os.getenv("CONTEXT_COMPACT_TOKENS", "2000"))
+CONTEXT_COMPACT_INPUT_TOKENS = int(os.getenv("CONTEXT_COMPACT_INPUT_TOKENS", "4000"))
+CONTEXT_COMPACT_DIGEST_TOKENS = int(os.getenv("CONTEXT_COMPACT_DIGEST_TOKENS", "400"))
+CONTEXT_COMPACT_RETRY = float(os.getenv("CONTEXT_COMPACT_RETRY", "300"))
+
+DIGEST_KEY = "digest"
+# Последняя задача и результат нужны как есть (страница /context, повтор задачи)
+_KEEP_KEYS = {"last_task", "last_result", DIGEST_KEY}
+
+
+def context_tokens(context: dict, model: str = "") -> int:
+    """Сколько токенов контекст займёт в промпте (служебные ключи не считаются)."""
+    payload = {k: v for k, v in context.items() if not k.startswith("_")}
+    return count_tokens(json.dumps(payload, ensure_ascii=False, indent=2), model)
+
+
+def _summary_prompt(digest: str | None, entries: dict, model: str, char_limit: int | None = None) -> str:
+    """char_limit — сколько символов примет старый бот, не обрезав начало с инструкцией (utils.bot_char_limit)."""
+    if digest and char_limit is not None:
+        digest = truncate_chars(digest, char_limit // 3)
+    previous = f"Прежняя сводка:\n{digest}\n\n" if digest else ""
+    head = (
+        "🗜 Сожми накопленный контекст команды в короткую сводку.\n"
+        f"Оставь решения, факты, договорённости и открытые вопросы; без вступлений. "
+        f"Не длиннее {CONTEXT_COMPACT_DIGEST_TOKENS} токенов.\n\n"
+        f"{previous}"
+        f"Записи контекста:\n\n"
+    )
+    share = max(64, CONTEXT_COMPACT_INPUT_TOKENS // max(1, len(entries)))
+    chars = None if char_limit is None else max(0, char_limit - len(head)) // max(1, len(entries))
+    lines = []
+    for k, v in entries.items():
+        text = v if isinstance(v, str) else json.dumps(v, ensure_ascii=False)
+        text = truncate_tokens(re.sub(r'<[^>]+>', ' ', text), share, model)
+        if chars is not None:
+            text = truncate_chars(text, chars - len(k) - 6)  # "### k\n" + "\n\n"
+        lines.append(f"### {k}\n{text}")
+    return head + "\n\n".join(lines)
+
+
+def _usable(text) -> bool:
+    return isinstance(text, str) and bool(text.strip()) and not text.startswith("⚠️")
+
+
+class ContextCompactor:
+    def __init__(self, threshold: int = CONTEXT_COMPACT_TOKENS):
+        self.threshold = threshold
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._pending: set[tuple] = set()
+        self._failed: dict[tuple, float] = {}
+        self.compactions = 0
+        self.failures = 0
+        self.skipped = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    # === Жизненный цикл (startup/shutdown менеджера) ===
+    def start(self):
+        if not CONTEXT_COMPACT_ENABLED or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = self._loop.create_task(self._run())
+        context_store.listeners.append(self.maybe_schedule)
+
+    async def stop(self):
+        if self.maybe_schedule in context_store.listeners:
+            context_store.listeners.remove(self.maybe_schedule)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    # === Постановка в очередь ===
+    def maybe_schedule(self, agent: dict, context: dict):
+        """Слушатель записей контекста: ставит агента в очередь, если контекст перерос порог."""
+        if self._loop is None or not agent.get("path"):
+            return
+        key = context_key(agent)
+        if key in self._pending or time.monotonic() - self._failed.get(key, -CONTEXT_COMPACT_RETRY) < CONTEXT_COMPACT_RETRY:
+            return
+        if context_tokens(context, _agent_model(agent)) <= self.threshold:
+            return
+        self._pending.add(key)
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, dict(agent))
+
+    async def _run(self):
+        while True:
+            agent = await self._queue.get()
+            key = context_key(agent)
+            try:
+                await self.compact(agent)
+                self._failed.pop(key, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                self._failed[key] = time.monotonic()
+                logger.warning(f"⚠️ Не удалось сжать контекст {agent.get('slug')}: {e}")
+            finally:
+                self._pending.discard(key)
+
+    # === Сжатие ===
+    async def compact(self, agent: dict) -> dict | None:
+        """Сжимает контекст агента; возвращает статистику или None, если сжимать нечего."""
+        model = _agent_model(agent)
+        version, context = context_store.load_versioned(agent)
+        entries = {k: v for k, v in context.items() if not k.startswith("_") and k not in _KEEP_KEYS}
+        before = context_tokens(context, model)
+        # Контекст раздут ключами, которые не сжимаются (длинный last_result), — звать LLM незачем
+        if before <= self.threshold or context_tokens(entries, model) < self.threshold // 4:
+            self.skipped += 1
+            return None
+
+        started = time.perf_counter()
+        path = Path(agent["path"])
+        prompt = _summary_prompt(context.get(DIGEST_KEY), entries, model, agent_char_limit(path))
+        res = await call_agent_local(path, prompt, owner=agent.get("owner"))
+        if not res.get("ok") or not _usable(res.get("result")):
+            raise RuntimeError(res.get("error") or "агент не вернул сводку")
+        digest = truncate_tokens(res["result"].strip(), CONTEXT_COMPACT_DIGEST_TOKENS * 2, model)
+
+        after_context = {**{k: v for k, v in context.items() if k not in entries}, DIGEST_KEY: digest}
+        stats = {
+            "at": datetime.datetime.now().isoformat(),
+            "version": version,
+            "keys": sorted(entries),
+            "tokens_before": before,
+            "tokens_after": context_tokens(after_context, model),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000),
+        }
+        removed = context_store.compact(agent, version, entries.keys(), {DIGEST_KEY: digest, "_compacted": stats})
+        if not removed:
+            self.skipped += 1
+            return None
+        stats["keys"] = sorted(removed)
+        self.compactions += 1
+        self.tokens_before += stats["tokens_before"]
+        self.tokens_after += stats["tokens_after"]
+        logger.info(
+            f"🗜 Контекст {agent['slug']} сжат: {stats['tokens_before']} → {stats['tokens_after']} токенов, "
+            f"в архиве {len(removed)} записей"
+        )
+        return stats
+
+    def stats(self) -> dict:
+        return {
+            "enabled": CONTEXT_COMPACT_ENABLED,
+            "threshold": self.threshold,
+            "queued": len(self._pending),
+            "compactions": self.compactions,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+        }
+
+
+context_compactor = ContextCompactor()
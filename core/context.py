@@ -1,15 +1,14 @@
 # app/routes/context.py
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Depends, HTTPException, Query
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
-from pathlib import Path
-import json
+from core.auth import get_current_user
+from core.meta_store import meta_store
+from core.mcp import context_store
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
-CONTEXT_DIR = Path("data/context")
-
 @router.get("/context", response_class=HTMLResponse)
 async def context_page(request: Request):
     """Отображение страницы контекста агентов"""
@@ -17,21 +16,34 @@ async def context_page(request: Request):
 
 
 @router.get("/api/context", response_class=JSONResponse)
-async def context_data():
-    """Возвращает объединённый контекст всех агентов"""
-    if not CONTEXT_DIR.exists() or not CONTEXT_DIR.is_dir():
-        return JSONResponse(
-            {"error": f"Папка {CONTEXT_DIR} не найдена"}, status_code=404
-        )
-
-    all_contexts = {}
-    for file in CONTEXT_DIR.glob("*.json"):
-        try:
-            with open(file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            agent_name = file.stem  # имя файла без .json
-            all_contexts[agent_name] = data
-        except Exception as e:
-            all_contexts[file.name] = {"error": str(e)}
-
-    return all_contexts
+async def context_data(user: str = Depends(get_current_user)):
+    """Возвращает контексты агентов текущего пользователя (только его шард)"""
+    agents = meta_store.find(owner=user, is_folder=False)
+    return context_store.shard(user, agents)
+
+
+def _agent(slug: str, user: str) -> dict:
+    agent = meta_store.get(slug, owner=user)
+    if not agent:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return agent
+
+
+@router.get("/api/context/{slug}", response_class=JSONResponse)
+async def context_version(slug: str, version: int | None = Query(None, ge=0),
+                          user: str = Depends(get_current_user)):
+    """Контекст агента: текущий или на версию version"""
+    agent = _agent(slug, user)
+    current, state = context_store.load_versioned(agent)
+    if version is not None and version < current:
+        state = context_store.state_at(agent, version)
+        if state is None:
+            raise HTTPException(status_code=410, detail=f"Версия {version} уже вытеснена из журнала")
+        current = version
+    return {"ok": True, "agent": slug, "version": current, "context": state}
+
+
+@router.get("/api/context/{slug}/changes", response_class=JSONResponse)
+async def context_changes(slug: str, since: int = Query(0, ge=0), user: str = Depends(get_current_user)):
+    """Изменения контекста агента после версии since"""
+    return {"ok": True, "agent": slug, **context_store.changes_since(_agent(slug, user), since)}
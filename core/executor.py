@@ -0,0 +1,179 @@
+"""
+Выделенный пул потоков для выполнения агентов.
+
+handle_task в bot.py синхронный (блокирующий llm.invoke), поэтому вызывать
+его прямо в event loop нельзя — один медленный ответ LLM замораживает весь
+сервер. Здесь задачи агентов уходят в отдельный ThreadPoolExecutor
+с глобальным лимитом параллелизма и лимитом на пользователя.
+"""
+import os
+import time
+import asyncio
+import logging
+import contextlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+AGENT_EXECUTOR_THREADS = int(os.getenv("AGENT_EXECUTOR_THREADS", "16"))
+AGENT_MAX_CONCURRENCY = int(os.getenv("AGENT_MAX_CONCURRENCY", str(AGENT_EXECUTOR_THREADS)))
+AGENT_MAX_PER_USER = int(os.getenv("AGENT_MAX_PER_USER", "4"))
+# Асинхронные агенты (handle_task_async) не занимают поток — им отдельный, более широкий лимит
+AGENT_MAX_ASYNC_CONCURRENCY = int(os.getenv("AGENT_MAX_ASYNC_CONCURRENCY", "256"))
+
+
+class AgentExecutor:
+    """Пул потоков для задач агентов с лимитами и метриками очереди."""
+
+    def __init__(self, threads: int = AGENT_EXECUTOR_THREADS,
+                 max_concurrency: int = AGENT_MAX_CONCURRENCY,
+                 max_per_user: int = AGENT_MAX_PER_USER,
+                 max_async_concurrency: int = AGENT_MAX_ASYNC_CONCURRENCY):
+        self.threads = threads
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="agent")
+        self.max_async_concurrency = max_async_concurrency
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._global_async = asyncio.Semaphore(max_async_concurrency)
+        self._user_sems: dict[str, asyncio.Semaphore] = {}
+        self._user_inflight: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self._wait_total = 0.0
+
+    def _user_sem(self, owner: str) -> asyncio.Semaphore:
+        with self._lock:
+            self._user_inflight[owner] = self._user_inflight.get(owner, 0) + 1
+            sem = self._user_sems.get(owner)
+            if sem is None:
+                sem = self._user_sems[owner] = asyncio.Semaphore(self.max_per_user)
+            return sem
+
+    def _user_done(self, owner: str):
+        with self._lock:
+            left = self._user_inflight.get(owner, 1) - 1
+            if left <= 0:
+                # Семафор больше никому не нужен — не копим их по всем пользователям
+                self._user_inflight.pop(owner, None)
+                self._user_sems.pop(owner, None)
+            else:
+                self._user_inflight[owner] = left
+
+    async def take_slot(self, owner: str | None = None, blocking: bool = True):
+        """
+        Ждёт место в очереди агентов с учётом лимитов пользователя и глобального.
+        Возвращает release(ok) — освободить место (повторные вызовы ничего не делают).
+        """
+        owner = owner or "_anonymous"
+        enqueued = time.monotonic()
+        user_sem = self._user_sem(owner)
+        global_sem = self._global if blocking else self._global_async
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        try:
+            await user_sem.acquire()
+            try:
+                await global_sem.acquire()
+            except BaseException:
+                user_sem.release()
+                raise
+        except BaseException:
+            self.queued -= 1
+            self._user_done(owner)
+            raise
+        self.queued -= 1
+        self.active += 1
+        self._wait_total += time.monotonic() - enqueued
+        released = False
+
+        def release(ok: bool):
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.active -= 1
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            global_sem.release()
+            user_sem.release()
+            self._user_done(owner)
+
+        return release
+
+    @contextlib.asynccontextmanager
+    async def slot(self, owner: str | None = None, blocking: bool = True):
+        """Занимает место в очереди агентов на время блока with."""
+        release = await self.take_slot(owner, blocking)
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            release(ok)
+
+    async def submit(self, release, fn, *args, **kwargs):
+        """
+        Выполняет блокирующую функцию в пуле потоков под уже занятым местом (take_slot).
+        Место освобождается, когда закончит поток, а не ожидающая корутина:
+        отменённый вызов, который ещё выполняется, по-прежнему занимает лимит.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            cf = self._pool.submit(functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            release(False)
+            raise
+
+        def done(f):
+            ok = not f.cancelled() and f.exception() is None
+            try:
+                loop.call_soon_threadsafe(release, ok)
+            except RuntimeError:
+                pass  # event loop уже закрыт (остановка менеджера)
+
+        cf.add_done_callback(done)
+        return await asyncio.wrap_future(cf, loop=loop)
+
+    async def run(self, fn, *args, owner: str | None = None, **kwargs):
+        """Выполняет блокирующую функцию в пуле потоков."""
+        release = await self.take_slot(owner)
+        return await self.submit(release, fn, *args, **kwargs)
+
+    async def run_async(self, coro_fn, *args, owner: str | None = None, **kwargs):
+        """Выполняет асинхронную функцию прямо в event loop, но под теми же лимитами."""
+        async with self.slot(owner, blocking=False):
+            return await coro_fn(*args, **kwargs)
+
+    def stats(self) -> dict:
+        started = self.completed + self.failed + self.active
+        with self._lock:
+            per_user = dict(self._user_inflight)
+        return {
+            "threads": self.threads,
+            "max_concurrency": self.max_concurrency,
+            "max_async_concurrency": self.max_async_concurrency,
+            "max_per_user": self.max_per_user,
+            "queued": self.queued,
+            "active": self.active,
+            "max_queue_depth": self.max_queue_depth,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_ms": round(self._wait_total / started * 1000, 1) if started else 0.0,
+            "inflight_per_user": per_user,
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+agent_executor = AgentExecutor()
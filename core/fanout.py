@@ -0,0 +1,66 @@
+"""
+Планировщик групповых запусков (каталог целиком: assign_task_folder,
+assign_task_to_folder, brainstorm, team_think).
+
+Агенты запускаются параллельно, но не больше FANOUT_CONCURRENCY одновременно;
+у каждого агента свой таймаут, у всего запуска — общий дедлайн. Результат
+всегда частичный-безопасный: по каждому агенту известен статус
+(ok / error / timeout / deadline), и ответ отдаётся, даже если кто-то не успел.
+"""
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "8"))
+FANOUT_AGENT_TIMEOUT = float(os.getenv("FANOUT_AGENT_TIMEOUT", "120"))
+FANOUT_DEADLINE = float(os.getenv("FANOUT_DEADLINE", "300"))
+
+
+async def fan_out(agents: list[dict], handler, *, concurrency: int | None = None,
+                  agent_timeout: float | None = None, deadline: float | None = None) -> dict:
+    """
+    Запускает handler(agent) для каждого агента.
+    Возвращает {"results": [...], "partial": bool, "elapsed_ms": int};
+    results идут в порядке agents: {"agent", "status", "result" | "error", "elapsed_ms"}.
+    """
+    concurrency = concurrency or FANOUT_CONCURRENCY
+    agent_timeout = agent_timeout or FANOUT_AGENT_TIMEOUT
+    deadline = deadline or FANOUT_DEADLINE
+
+    sem = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+    deadline_at = started + deadline
+
+    async def run_one(agent: dict) -> dict:
+        slug = agent.get("slug")
+        async with sem:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                return {"agent": slug, "status": "deadline", "error": "Общий дедлайн запуска истёк", "elapsed_ms": 0}
+            t0 = time.monotonic()
+            entry = {"agent": slug}
+            try:
+                entry["result"] = await asyncio.wait_for(handler(agent), timeout=min(agent_timeout, remaining))
+                entry["status"] = "ok"
+            except asyncio.TimeoutError:
+                entry["status"] = "timeout" if agent_timeout <= remaining else "deadline"
+                entry["error"] = f"Агент не ответил за {min(agent_timeout, remaining):.0f} с"
+            except Exception as e:
+                logger.exception(f"[fan_out] Ошибка у агента {slug}: {e}")
+                entry["status"] = "error"
+                entry["error"] = str(e)
+            entry["elapsed_ms"] = int((time.monotonic() - t0) * 1000)
+            return entry
+
+    results = await asyncio.gather(*[run_one(a) for a in agents])
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    partial = any(r["status"] != "ok" for r in results)
+    logger.info(
+        "[fan_out] %s агентов за %s мс (параллельно ≤ %s)%s",
+        len(agents), elapsed_ms, concurrency, " — частичный результат" if partial else "",
+    )
+    return {"results": list(results), "partial": partial, "elapsed_ms": elapsed_ms}
@@ -0,0 +1,175 @@
+"""
+Кэш ответов LLM, адресуемый по содержимому.
+
+Ключ — sha256 от модели, версии bot.py и полного промпта, который уходит агенту.
+Два уровня: LRU в памяти и файлы на диске (data/cache/llm/<aa>/<key>.json).
+Записи живут LLM_CACHE_TTL секунд; диск подрезается по LLM_CACHE_DISK_MB
+(сначала удаляются самые старые файлы).
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger("manager")
+
+BASE = Path(__file__).resolve().parent.parent
+
+# === Настройки ===
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(24 * 3600)))
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "256"))
+LLM_CACHE_DISK_MB = float(os.getenv("LLM_CACHE_DISK_MB", "100"))
+LLM_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", str(BASE / "data" / "cache" / "llm")))
+
+
+def cache_key(model: str, bot_digest: str, prompt: str) -> str:
+    h = hashlib.sha256()
+    for part in (model or "", bot_digest or "", prompt):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """Двухуровневый (память + диск) кэш ответов с TTL и ограничением размера."""
+
+    def __init__(self, directory: Path = LLM_CACHE_DIR, ttl: int = LLM_CACHE_TTL,
+                 memory_items: int = LLM_CACHE_MEMORY_ITEMS, disk_mb: float = LLM_CACHE_DISK_MB):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.disk_bytes = int(disk_mb * 1024 * 1024)
+        self._memory: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_used: int | None = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _file(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item:
+                expires, value = item
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+        path = self._file(key)
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+        if data.get("expires", 0) <= now:
+            self._unlink(path)
+            self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, data["expires"], data["result"])
+        return data["result"]
+
+    def put(self, key: str, value: str, model: str = ""):
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires, value)
+            self.stores += 1
+
+        path = self._file(key)
+        payload = json.dumps({"model": model, "expires": expires, "result": value}, ensure_ascii=False)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(payload, encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Не удалось записать кэш LLM: {e}")
+            return
+        self._account(len(payload.encode("utf-8")))
+
+    def _remember(self, key: str, expires: float, value: str):
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _unlink(self, path: Path):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+            self._account(-size)
+        except OSError:
+            pass
+
+    def _account(self, delta: int):
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = sum(f.stat().st_size for f in self.directory.glob("*/*.json"))
+            else:
+                self._disk_used += delta
+            over = self._disk_used > self.disk_bytes
+        if over:
+            self._prune()
+
+    def _prune(self):
+        """Удаляет просроченные и самые старые файлы, пока диск не займёт ≤ 90% лимита."""
+        now = time.time()
+        files = []
+        for f in self.directory.glob("*/*.json"):
+            try:
+                st = f.stat()
+                files.append((st.st_mtime, st.st_size, f))
+            except OSError:
+                pass
+        files.sort()
+        used = sum(size for _, size, _ in files)
+        target = int(self.disk_bytes * 0.9)
+        for mtime, size, f in files:
+            if used <= target and mtime + self.ttl > now:
+                break
+            try:
+                f.unlink()
+                used -= size
+                self.evictions += 1
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_used = used
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "enabled": LLM_CACHE_ENABLED,
+            "memory_items": len(self._memory),
+            "disk_bytes": self._disk_used,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "hit_ratio": round(hits / total, 3) if total else 0.0,
+        }
+
+
+response_cache = ResponseCache()
+
+
+def cache_enabled_for(agent: dict) -> bool:
+    """Кэш включён глобально и агент не отказался от него (llm_cache: false в agents.json)."""
+    return LLM_CACHE_ENABLED and agent.get("llm_cache", True) is not False
@@ -0,0 +1,185 @@
+"""
+Реестр загруженных модулей агентов (bot.py).
+
+Каждый bot.py компилируется и исполняется один раз, после чего модуль
+хранится в памяти под ключом (путь, mtime, size, sha1). Повторная загрузка
+происходит только при изменении файла. Неиспользуемые модули вытесняются
+по LRU, когда превышен лимит по количеству или по оценке занимаемой памяти.
+"""
+import os
+import sys
+import hashlib
+import logging
+import threading
+import importlib.util
+from collections import OrderedDict
+from pathlib import Path
+from types import ModuleType
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+MODULE_CACHE_MAX = int(os.getenv("AGENT_MODULE_CACHE_MAX", "64"))
+MODULE_CACHE_MB = float(os.getenv("AGENT_MODULE_CACHE_MB", "256"))
+
+
+def _estimate_size(mod: ModuleType, source: bytes) -> int:
+    """Грубая оценка памяти модуля: исходник + поверхностный размер его глобалов."""
+    size = len(source)
+    for value in vars(mod).values():
+        try:
+            size += sys.getsizeof(value)
+        except Exception:
+            pass
+    return size
+
+
+def _release(mod: ModuleType):
+    """Отцепляет FileHandler, который bot.py вешает на общий логгер 'agent'."""
+    fh = getattr(mod, "fh", None)
+    mod_logger = getattr(mod, "logger", None)
+    if isinstance(fh, logging.Handler) and isinstance(mod_logger, logging.Logger):
+        mod_logger.removeHandler(fh)
+        try:
+            fh.close()
+        except Exception:
+            pass
+
+
+class _Entry:
+    __slots__ = ("module", "mtime_ns", "size", "digest", "weight")
+
+    def __init__(self, module, mtime_ns, size, digest, weight):
+        self.module = module
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.weight = weight
+
+
+class ModuleRegistry:
+    """LRU-кэш модулей агентов с проверкой изменений по mtime/размеру/хэшу."""
+
+    def __init__(self, max_modules: int = MODULE_CACHE_MAX, max_mb: float = MODULE_CACHE_MB):
+        self.max_modules = max_modules
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._path_locks: dict[str, threading.Lock] = {}
+        self._weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def _path_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._path_locks.setdefault(key, threading.Lock())
+
+    def _lookup(self, key: str, st: os.stat_result) -> ModuleType | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.module
+        return None
+
+    def get(self, bot_file: Path) -> ModuleType:
+        """Возвращает загруженный модуль bot.py, перезагружая его только при изменении файла."""
+        bot_file = Path(bot_file).resolve()
+        key = str(bot_file)
+        st = bot_file.stat()
+
+        mod = self._lookup(key, st)
+        if mod is not None:
+            return mod
+
+        with self._path_lock(key):
+            # Пока ждали блокировку, модуль мог загрузить другой поток
+            st = bot_file.stat()
+            mod = self._lookup(key, st)
+            if mod is not None:
+                return mod
+
+            source = bot_file.read_bytes()
+            digest = hashlib.sha1(source).hexdigest()
+
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry.digest == digest:
+                    # Файл «тронут», но содержимое то же — перезагрузка не нужна
+                    entry.mtime_ns, entry.size = st.st_mtime_ns, st.st_size
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.module
+
+            mod = self._exec(bot_file, source, digest)
+            weight = _estimate_size(mod, source)
+
+            with self._lock:
+                self.misses += 1
+                old = self._entries.pop(key, None)
+                if old:
+                    self.reloads += 1
+                    self._weight -= old.weight
+                    _release(old.module)
+                    logger.info("♻️ bot.py изменён — модуль перезагружен: %s", key)
+                self._entries[key] = _Entry(mod, st.st_mtime_ns, st.st_size, digest, weight)
+                self._weight += weight
+                self._evict()
+            return mod
+
+    def _exec(self, bot_file: Path, source: bytes, digest: str) -> ModuleType:
+        name = f"agent_{bot_file.parent.name}_{digest[:8]}"
+        spec = importlib.util.spec_from_file_location(name, str(bot_file))
+        mod = importlib.util.module_from_spec(spec)
+        code = compile(source, str(bot_file), "exec")
+        exec(code, mod.__dict__)
+        return mod
+
+    def _evict(self):
+        """Вытесняет самые давно использованные модули, пока не уложимся в лимиты."""
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_modules or self._weight > self.max_bytes
+        ):
+            key, entry = self._entries.popitem(last=False)
+            self._weight -= entry.weight
+            self.evictions += 1
+            _release(entry.module)
+            logger.debug("Модуль агента вытеснен из кэша: %s", key)
+
+    def invalidate(self, bot_file: Path):
+        """Принудительно выбрасывает модуль из кэша (например, после удаления агента)."""
+        key = str(Path(bot_file).resolve())
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._weight -= entry.weight
+                _release(entry.module)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "modules": len(self._entries),
+                "approx_bytes": self._weight,
+                "max_modules": self.max_modules,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+registry = ModuleRegistry()
+
+
+def load_agent_module(path: Path) -> ModuleType:
+    """Возвращает модуль bot.py из каталога агента (через общий реестр)."""
+    bot_file = Path(path) / "bot.py"
+    if not bot_file.exists():
+        raise FileNotFoundError(f"bot.py не найден в {path}")
+    return registry.get(bot_file)
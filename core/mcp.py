@@ -1,20 +1,528 @@
-import json, os, datetime
-
-CONTEXT_PATH = "data/context"
-
-def load_context(agent_id):
-    path = os.path.join(CONTEXT_PATH, f"{agent_id}.json")
-    if not os.path.exists(path):
-        return {}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def save_context(agent_id, context):
-    os.makedirs(CONTEXT_PATH, exist_ok=True)
-    path = os.path.join(CONTEXT_PATH, f"{agent_id}.json")
-    context["_updated"] = datetime.datetime.now().isoformat()
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(context, f, ensure_ascii=False, indent=2)
+"""
+Контексты агентов, разложенные по владельцам: data/context/<owner>/<folder>/<slug>.*
+
+Раньше все контексты лежали в одной плоской папке data/context/{slug}.json,
+и одноимённые агенты разных пользователей (assistant_default) делили один файл.
+Теперь ключ контекста — (владелец, каталог, slug), а функции модуля принимают
+запись агента из метаданных. Старые плоские файлы переносит
+migrate_flat_contexts() при старте: контекст уходит только агенту, первым
+зарегистрированному в метаданных под этим slug (его владельцу он и
+принадлежал), а исходный файл переименовывается в {slug}.json.migrated.
+Одноимённые агенты других владельцев начинают с пустого контекста.
+
+Контекст хранится как журнал событий, а не как перезаписываемый JSON:
+  <slug>.events.jsonl — по строке на изменение {"v", "ts", "set", "unset"};
+  <slug>.snapshots/   — снимки состояния {"version", "state"} каждые
+                        CONTEXT_SNAPSHOT_EVERY событий (хранятся последние
+                        CONTEXT_SNAPSHOT_KEEP, журнал подрезается до старейшего).
+Запись — дописывание одной строки с изменившимися ключами, поэтому её цена
+пропорциональна правке, а не размеру контекста. Текущее состояние держится
+в кэше и догоняет журнал, дочитывая только новые строки (в том числе
+записанные другим воркером). Можно получить состояние на версию N
+(state_at) и изменения после версии N (changes_since) — на этом строятся
+инкрементальные слияния контекстов команды. Записи, которые фоновое сжатие
+(core/compaction.py) заменило сводкой, сохраняются в <slug>.archive.jsonl.
+
+Запись идёт под блокировкой ключа: потоковой внутри процесса и файловой
+между воркерами. Для правок «прочитать → изменить → записать» —
+update_context(), который делает это целиком под блокировкой.
+"""
+import os
+import re
+import json
+import shutil
+import logging
+import datetime
+import threading
+from collections import deque
+from pathlib import Path
+from filelock import FileLock
+from core.meta_store import meta_store
+
+logger = logging.getLogger("manager")
+
+BASE = Path(__file__).resolve().parent.parent
+
+# === Настройки ===
+CONTEXT_PATH = Path(os.getenv("CONTEXT_DIR", str(BASE / "data" / "context")))
+CONTEXT_SNAPSHOT_EVERY = int(os.getenv("CONTEXT_SNAPSHOT_EVERY", "50"))
+CONTEXT_SNAPSHOT_KEEP = int(os.getenv("CONTEXT_SNAPSHOT_KEEP", "3"))
+CONTEXT_RECENT_EVENTS = int(os.getenv("CONTEXT_RECENT_EVENTS", "64"))
+
+
+def _safe(name: str) -> str:
+    return re.sub(r"[^\w.-]", "_", name or "_").lstrip(".") or "_"
+
+
+def context_key(agent: dict) -> tuple:
+    return agent.get("owner") or "", agent.get("folder") or "root", agent["slug"]
+
+
+def _apply_event(state: dict, event: dict):
+    state.update(event.get("set") or {})
+    for k in event.get("unset") or ():
+        state.pop(k, None)
+
+
+def _parse_events(data: bytes) -> list[dict]:
+    events = []
+    for line in data.decode("utf-8", errors="ignore").splitlines():
+        if not line.strip():
+            continue
+        try:
+            events.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue  # строка, оборванная при сбое записи
+    return events
+
+
+class _Entry:
+    """Закэшированное состояние контекста и позиция, до которой прочитан журнал."""
+    __slots__ = ("state", "version", "offset", "inode", "recent", "first")
+
+    def __init__(self):
+        self.state: dict = {}
+        self.version = 0
+        self.offset = 0
+        self.inode = None
+        self.recent: deque = deque(maxlen=CONTEXT_RECENT_EVENTS)
+        self.first = 1  # самая ранняя версия, событие которой ещё есть в журнале
+
+
+class ContextStore:
+    def __init__(self, directory: Path = CONTEXT_PATH,
+                 snapshot_every: int = CONTEXT_SNAPSHOT_EVERY, snapshot_keep: int = CONTEXT_SNAPSHOT_KEEP):
+        self.directory = Path(directory)
+        self.snapshot_every = snapshot_every
+        self.snapshot_keep = max(1, snapshot_keep)
+        self._cache: dict[tuple, _Entry] = {}
+        self._locks: dict[tuple, threading.RLock] = {}
+        self._file_locks: dict[tuple, FileLock] = {}
+        self._guard = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.caught_up = 0
+        self.events = 0
+        self.snapshots = 0
+        self.migrated = 0
+        self.listeners: list = []  # fn(agent, context) после каждой записи (см. core/compaction.py)
+
+    # === Файлы ===
+    def _base(self, key: tuple) -> Path:
+        owner, folder, slug = key
+        return self.directory / _safe(owner) / _safe(folder) / _safe(slug)
+
+    def _log(self, key: tuple) -> Path:
+        base = self._base(key)
+        return base.with_name(base.name + ".events.jsonl")
+
+    def _snap_dir(self, key: tuple) -> Path:
+        base = self._base(key)
+        return base.with_name(base.name + ".snapshots")
+
+    def _legacy(self, key: tuple) -> Path:
+        base = self._base(key)
+        return base.with_name(base.name + ".json")
+
+    def _archive_file(self, key: tuple) -> Path:
+        base = self._base(key)
+        return base.with_name(base.name + ".archive.jsonl")
+
+    def _snapshot_versions(self, key: tuple) -> list[int]:
+        d = self._snap_dir(key)
+        if not d.is_dir():
+            return []
+        versions = []
+        for p in d.glob("*.json"):
+            try:
+                versions.append(int(p.stem))
+            except ValueError:
+                continue
+        return sorted(versions)
+
+    def _read_snapshot(self, key: tuple, version: int) -> dict:
+        path = self._snap_dir(key) / f"{version:08d}.json"
+        return json.loads(path.read_text(encoding="utf-8"))["state"]
+
+    def _key_lock(self, key: tuple) -> threading.RLock:
+        with self._guard:
+            return self._locks.setdefault(key, threading.RLock())
+
+    def _locked(self, key: tuple) -> FileLock:
+        """Файловая блокировка ключа; один объект на ключ, поэтому повторный вход в потоке не блокирует."""
+        with self._guard:
+            lock = self._file_locks.get(key)
+            if lock is None:
+                base = self._base(key)
+                base.parent.mkdir(parents=True, exist_ok=True)
+                lock = self._file_locks[key] = FileLock(str(base) + ".lock")
+            return lock
+
+    # === Чтение ===
+    def _reload(self, key: tuple) -> _Entry:
+        """Полная загрузка: последний снимок + события после него."""
+        entry = _Entry()
+        log = self._log(key)
+        snaps = self._snapshot_versions(key)
+        if snaps:
+            entry.version = snaps[-1]
+            entry.state = self._read_snapshot(key, snaps[-1])
+        try:
+            with open(log, "rb") as f:
+                entry.inode = os.fstat(f.fileno()).st_ino
+                data = f.read()
+        except OSError:
+            return entry
+        end = data.rfind(b"\n") + 1
+        events = _parse_events(data[:end])
+        entry.first = events[0]["v"] if events else entry.version + 1
+        for ev in events:
+            if ev["v"] > entry.version:
+                _apply_event(entry.state, ev)
+                entry.version = ev["v"]
+            entry.recent.append(ev)
+        entry.offset = end
+        return entry
+
+    def _current(self, key: tuple) -> _Entry:
+        """Актуальное состояние (вызывается под блокировкой ключа)."""
+        log = self._log(key)
+        try:
+            st = log.stat()
+        except OSError:
+            st = None
+        if st is None and self._legacy(key).exists():
+            self._import_legacy(key)
+            st = log.stat()
+        entry = self._cache.get(key)
+        if entry is not None and st is not None and entry.inode == st.st_ino and entry.offset <= st.st_size:
+            if entry.offset == st.st_size:
+                self.hits += 1
+                return entry
+            # Журнал дописан (например, другим воркером) — дочитываем только хвост
+            with open(log, "rb") as f:
+                f.seek(entry.offset)
+                data = f.read(st.st_size - entry.offset)
+            end = data.rfind(b"\n") + 1
+            for ev in _parse_events(data[:end]):
+                if ev["v"] > entry.version:
+                    _apply_event(entry.state, ev)
+                    entry.version = ev["v"]
+                    entry.recent.append(ev)
+            entry.offset += end
+            self.caught_up += 1
+            return entry
+        if entry is not None and st is None and entry.inode is None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self._reload(key)
+        self._cache[key] = entry
+        return entry
+
+    def load(self, agent: dict) -> dict:
+        """Контекст агента (копия: правки вызывающего не попадают в кэш)."""
+        key = context_key(agent)
+        with self._key_lock(key):
+            return dict(self._current(key).state)
+
+    def load_versioned(self, agent: dict) -> tuple[int, dict]:
+        """(версия, контекст) — согласованная пара для последующего changes_since."""
+        key = context_key(agent)
+        with self._key_lock(key):
+            entry = self._current(key)
+            return entry.version, dict(entry.state)
+
+    def state_at(self, agent: dict, version: int) -> dict | None:
+        """
+        Состояние контекста на версию version.
+        None — если эта версия старше самого раннего хранимого снимка.
+        """
+        key = context_key(agent)
+        with self._key_lock(key):
+            entry = self._current(key)
+            if version >= entry.version:
+                return dict(entry.state)
+            base = [v for v in self._snapshot_versions(key) if v <= version]
+            if base:
+                start, state = base[-1], self._read_snapshot(key, base[-1])
+            elif entry.first == 1:
+                start, state = 0, {}
+            else:
+                return None
+            try:
+                data = self._log(key).read_bytes()[:entry.offset]
+            except OSError:
+                data = b""
+            for ev in _parse_events(data):
+                if start < ev["v"] <= version:
+                    _apply_event(state, ev)
+            return state
+
+    def changes_since(self, agent: dict, version: int) -> dict:
+        """
+        Изменения контекста после версии version:
+        {"version": текущая, "set": {...}, "unset": [...], "reset": bool}.
+        reset=True — событий после version уже нет в журнале, в set лежит всё состояние.
+        """
+        key = context_key(agent)
+        with self._key_lock(key):
+            entry = self._current(key)
+            if version >= entry.version:
+                return {"version": entry.version, "set": {}, "unset": [], "reset": False}
+            if entry.recent and entry.recent[0]["v"] <= version + 1:
+                events = [ev for ev in entry.recent if ev["v"] > version]
+            elif entry.first <= version + 1:
+                try:
+                    data = self._log(key).read_bytes()[:entry.offset]
+                except OSError:
+                    data = b""
+                events = [ev for ev in _parse_events(data) if ev["v"] > version]
+            else:
+                return {"version": entry.version, "set": dict(entry.state), "unset": [], "reset": True}
+            changed: dict = {}
+            removed: set = set()
+            for ev in events:
+                for k, v in (ev.get("set") or {}).items():
+                    changed[k] = v
+                    removed.discard(k)
+                for k in ev.get("unset") or ():
+                    changed.pop(k, None)
+                    removed.add(k)
+            return {"version": entry.version, "set": changed, "unset": sorted(removed), "reset": False}
+
+    # === Запись ===
+    def _append(self, key: tuple, entry: _Entry, changed: dict, removed: list) -> _Entry:
+        """Дописывает событие в журнал (под блокировками ключа)."""
+        event = {"v": entry.version + 1, "ts": datetime.datetime.now().isoformat(),
+                 "set": changed, "unset": removed}
+        log = self._log(key)
+        log.parent.mkdir(parents=True, exist_ok=True)
+        with open(log, "ab") as f:
+            f.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+            entry.offset = f.tell()
+            entry.inode = os.fstat(f.fileno()).st_ino
+        _apply_event(entry.state, event)
+        entry.version = event["v"]
+        entry.recent.append(event)
+        self.events += 1
+        if self.snapshot_every > 0 and entry.version % self.snapshot_every == 0:
+            self._snapshot(key, entry)
+        return entry
+
+    def _snapshot(self, key: tuple, entry: _Entry):
+        """Снимок состояния + подрезка журнала до старейшего хранимого снимка."""
+        d = self._snap_dir(key)
+        d.mkdir(parents=True, exist_ok=True)
+        path = d / f"{entry.version:08d}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"version": entry.version, "state": entry.state}, ensure_ascii=False),
+                       encoding="utf-8")
+        os.replace(tmp, path)
+        self.snapshots += 1
+
+        versions = self._snapshot_versions(key)
+        for old in versions[:-self.snapshot_keep]:
+            (d / f"{old:08d}.json").unlink(missing_ok=True)
+        oldest = versions[-self.snapshot_keep:][0]
+        if entry.first > oldest:
+            return
+        log = self._log(key)
+        data = log.read_bytes()[:entry.offset]
+        keep = [ev for ev in _parse_events(data) if ev["v"] > oldest]
+        tmp = log.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            for ev in keep:
+                f.write((json.dumps(ev, ensure_ascii=False) + "\n").encode("utf-8"))
+            entry.offset = f.tell()
+        os.replace(tmp, log)
+        entry.inode = log.stat().st_ino
+        entry.first = oldest + 1
+
+    def save(self, agent: dict, context: dict):
+        """Заменяет контекст целиком (в журнал попадает только разница)."""
+        key = context_key(agent)
+        context["_updated"] = datetime.datetime.now().isoformat()
+        with self._key_lock(key), self._locked(key):
+            entry = self._current(key)
+            changed = {k: v for k, v in context.items() if entry.state.get(k, _MISSING) != v}
+            removed = [k for k in entry.state if k not in context]
+            self._append(key, entry, changed, removed)
+            state = dict(entry.state)
+        self._notify(agent, state)
+
+    def update(self, agent: dict, changes: dict) -> dict:
+        """Сливает changes в контекст агента атомарно относительно других записей."""
+        key = context_key(agent)
+        with self._key_lock(key), self._locked(key):
+            entry = self._current(key)
+            changed = {k: v for k, v in changes.items() if entry.state.get(k, _MISSING) != v}
+            changed["_updated"] = datetime.datetime.now().isoformat()
+            self._append(key, entry, changed, [])
+            state = dict(entry.state)
+        self._notify(agent, state)
+        return state
+
+    def _notify(self, agent: dict, state: dict):
+        for fn in self.listeners:
+            try:
+                fn(agent, state)
+            except Exception as e:
+                logger.warning(f"⚠️ Обработчик записи контекста {agent.get('slug')}: {e}")
+
+    def compact(self, agent: dict, base_version: int, keys, changes: dict) -> list[str]:
+        """
+        Заменяет ключи keys на changes (сводку) одним событием.
+        Ключи, изменённые после base_version (пока шло сжатие), не трогаются.
+        Возвращает удалённые ключи; исходные значения уходят в архив <slug>.archive.jsonl.
+        """
+        key = context_key(agent)
+        with self._key_lock(key), self._locked(key):
+            entry = self._current(key)
+            since = self.changes_since(agent, base_version)
+            if since["reset"]:
+                return []
+            touched = set(since["set"]) | set(since["unset"])
+            removed = [k for k in keys if k in entry.state and k not in touched]
+            if not removed:
+                return []
+            archive = self._archive_file(key)
+            archive.parent.mkdir(parents=True, exist_ok=True)
+            with open(archive, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"ts": datetime.datetime.now().isoformat(), "version": entry.version,
+                                    "entries": {k: entry.state[k] for k in removed}}, ensure_ascii=False) + "\n")
+            self._append(key, entry, dict(changes), removed)
+        return removed
+
+    def archived(self, agent: dict) -> list[dict]:
+        """Архив сжатых записей контекста: [{"ts", "version", "entries"}], старые — первыми."""
+        try:
+            data = self._archive_file(context_key(agent)).read_bytes()
+        except OSError:
+            return []
+        return _parse_events(data)
+
+    def _import_legacy(self, key: tuple, data: dict | None = None):
+        """Контекст-файл {slug}.json (прежний формат) → первое событие журнала."""
+        legacy = self._legacy(key)
+        if data is None:
+            try:
+                data = json.loads(legacy.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError):
+                data = {}
+        with self._locked(key):
+            if not self._log(key).exists():
+                self._append(key, _Entry(), dict(data), [])
+        if legacy.exists():
+            os.replace(legacy, legacy.with_name(legacy.name + ".migrated"))
+
+    def move(self, agent: dict, folder: str):
+        """Переносит контекст агента в другой каталог (агент переехал)."""
+        old, new = context_key(agent), context_key({**agent, "folder": folder})
+        if old == new:
+            return
+        with self._key_lock(old), self._locked(old):
+            for src, dst in ((self._log(old), self._log(new)), (self._snap_dir(old), self._snap_dir(new)),
+                             (self._archive_file(old), self._archive_file(new))):
+                if src.exists():
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(src, dst)
+            self._cache.pop(old, None)
+
+    def forget(self, agent: dict):
+        key = context_key(agent)
+        with self._key_lock(key):
+            self._log(key).unlink(missing_ok=True)
+            self._legacy(key).unlink(missing_ok=True)
+            self._archive_file(key).unlink(missing_ok=True)
+            shutil.rmtree(self._snap_dir(key), ignore_errors=True)
+            self._cache.pop(key, None)
+
+    def shard(self, owner: str, agents: list[dict]) -> dict:
+        """Контексты агентов одного владельца: {slug: context}. Чужие шарды не читаются."""
+        return {
+            a["slug"]: ctx
+            for a in agents
+            if a.get("owner") == owner and (ctx := self.load(a))
+        }
+
+    # === Перенос из плоской раскладки ===
+    def migrate_flat(self, agents: list[dict]) -> int:
+        """
+        data/context/{slug}.json → журнал data/context/<owner>/<folder>/{slug}.events.jsonl
+        агента, первым зарегистрированного под этим slug (agents — в порядке meta_store).
+        Остальным одноимённым агентам общий контекст не копируется, чтобы он не утёк
+        чужим владельцам. Контекст без агентов остаётся на месте.
+        """
+        if not self.directory.is_dir():
+            return 0
+        by_slug: dict[str, list[dict]] = {}
+        for a in agents:
+            by_slug.setdefault(a["slug"], []).append(a)
+        moved = 0
+        for flat in self.directory.glob("*.json"):
+            owners = by_slug.get(flat.stem)
+            if not owners:
+                continue
+            try:
+                data = json.loads(flat.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError):
+                logger.warning(f"⚠️ Поврежден контекст {flat.name}, не перенесён.")
+                continue
+            agent, others = owners[0], owners[1:]
+            key = context_key(agent)
+            with self._key_lock(key):
+                self._import_legacy(key, data)
+            if others:
+                logger.info(
+                    f"📦 Контекст {flat.name} перенесён только владельцу {agent.get('owner')!r}; "
+                    f"не перенесён агентам: {', '.join(repr(a.get('owner')) for a in others)}"
+                )
+            os.replace(flat, flat.with_name(flat.name + ".migrated"))
+            moved += 1
+        self.migrated += moved
+        return moved
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "hits": self.hits, "misses": self.misses,
+                "caught_up": self.caught_up, "events": self.events, "snapshots": self.snapshots,
+                "migrated": self.migrated}
+
+
+_MISSING = object()
+
+context_store = ContextStore()
+
+
+def load_context(agent: dict) -> dict:
+    return context_store.load(agent)
+
+
+def save_context(agent: dict, context: dict):
+    context_store.save(agent, context)
+
+
+def update_context(agent: dict, changes: dict) -> dict:
+    return context_store.update(agent, changes)
+
+
+def apply_changes(context: dict, changes: dict) -> dict:
+    """Применяет результат changes_since к ранее загруженному контексту."""
+    if changes.get("reset"):
+        return dict(changes["set"])
+    merged = {**context, **changes["set"]}
+    for k in changes["unset"]:
+        merged.pop(k, None)
+    return merged
+
+
+def migrate_flat_contexts() -> int:
+    """Переносит контексты из плоской папки в шарды владельцев (однократно, при старте)."""
+    moved = context_store.migrate_flat(meta_store.find(is_folder=False))
+    if moved:
+        logger.info(f"📦 Контексты {moved} агентов перенесены в шарды владельцев ({CONTEXT_PATH})")
+    return moved
+
 
 def merge_contexts(*contexts):
     merged = {}
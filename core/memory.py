@@ -0,0 +1,359 @@
+"""
+Память агентов: append-only журнал JSONL, разбитый на сегменты.
+
+Вместо memory.json (чтение всего файла + перезапись на каждую запись)
+у агента есть каталог memory/ с сегментами 000001.jsonl, 000002.jsonl, ...
+Запись — дописывание одной строки в активный (последний) сегмент.
+Когда активный сегмент вырастает больше MEMORY_SEGMENT_KB, начинается новый,
+а закрытый сегмент фоновый поток сжимает в архив 000001.jsonl.gz.
+Последние записи («хвост») читаются с конца активного сегмента, не трогая архив.
+Старый memory.json при первом обращении переносится в первый сегмент
+и переименовывается в memory.json.migrated.
+
+Для страниц обзора памяти (/check_memory) есть индекс хвостов: по одному
+файлу на владельца (data/memory_index/<owner>.json) с последними
+MEMORY_TAIL_SIZE записями каждого агента. Он обновляется при каждой записи
+в память, так что обзору не нужно обходить дерево agents/ и читать журналы.
+"""
+import os
+import re
+import gzip
+import json
+import queue
+import logging
+import threading
+from pathlib import Path
+from filelock import FileLock
+from core.meta_store import meta_store
+
+logger = logging.getLogger("manager")
+
+BASE = Path(__file__).resolve().parent.parent
+
+# === Настройки ===
+MEMORY_SEGMENT_KB = int(os.getenv("MEMORY_SEGMENT_KB", "256"))
+MEMORY_DIR_NAME = "memory"
+MEMORY_TAIL_SIZE = int(os.getenv("MEMORY_TAIL_SIZE", "5"))
+MEMORY_INDEX_DIR = Path(os.getenv("MEMORY_INDEX_DIR", str(BASE / "data" / "memory_index")))
+
+_TAIL_BLOCK = 64 * 1024
+
+
+def _seq(path: Path) -> int:
+    return int(path.name.split(".", 1)[0])
+
+
+class MemoryLog:
+    def __init__(self, segment_bytes: int = MEMORY_SEGMENT_KB * 1024):
+        self.segment_bytes = segment_bytes
+        self._compact_queue: "queue.Queue[Path]" = queue.Queue()
+        self._compactor: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self.appends = 0
+        self.rolled = 0
+        self.compacted = 0
+        self.migrated = 0
+
+    # === Сегменты ===
+    @staticmethod
+    def directory(agent_path: Path) -> Path:
+        return Path(agent_path) / MEMORY_DIR_NAME
+
+    def segments(self, agent_path: Path) -> list[Path]:
+        """Сегменты по возрастанию номера (для каждого номера — один файл, архив в приоритете)."""
+        d = self.directory(agent_path)
+        if not d.is_dir():
+            return []
+        by_seq: dict[int, Path] = {}
+        for p in d.iterdir():
+            if p.name.endswith(".jsonl.gz") or p.name.endswith(".jsonl"):
+                try:
+                    seq = _seq(p)
+                except ValueError:
+                    continue
+                if seq not in by_seq or p.name.endswith(".gz"):
+                    by_seq[seq] = p
+        return [by_seq[s] for s in sorted(by_seq)]
+
+    def _lock(self, agent_path: Path) -> FileLock:
+        d = self.directory(agent_path)
+        d.mkdir(parents=True, exist_ok=True)
+        return FileLock(str(d / ".lock"))
+
+    def _active(self, agent_path: Path) -> Path:
+        segs = self.segments(agent_path)
+        if segs and segs[-1].name.endswith(".jsonl"):
+            return segs[-1]
+        nxt = _seq(segs[-1]) + 1 if segs else 1
+        return self.directory(agent_path) / f"{nxt:06d}.jsonl"
+
+    # === Запись ===
+    def append(self, agent_path: Path, record: dict):
+        agent_path = Path(agent_path)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock(agent_path):
+            self._migrate(agent_path)
+            active = self._active(agent_path)
+            with open(active, "a", encoding="utf-8") as f:
+                f.write(line)
+                size = f.tell()
+            if size >= self.segment_bytes:
+                # Следующая запись начнёт новый сегмент; этот — в архив
+                nxt = self.directory(agent_path) / f"{_seq(active) + 1:06d}.jsonl"
+                nxt.touch()
+                self.rolled += 1
+                self._schedule_compaction(active)
+        self.appends += 1
+
+    def _migrate(self, agent_path: Path):
+        """memory.json → первый сегмент (вызывается под блокировкой агента)."""
+        legacy = agent_path / "memory.json"
+        if not legacy.exists():
+            return
+        try:
+            records = json.loads(legacy.read_text(encoding="utf-8") or "[]")
+        except json.JSONDecodeError:
+            logger.warning(f"⚠️ Поврежден memory.json у {agent_path.name}, перенесено пустым.")
+            records = []
+        if self.segments(agent_path):
+            # Сегменты уже есть (перенос прерывался) — memory.json старше, ставим его в начало
+            first = self.directory(agent_path) / "000000.jsonl"
+        else:
+            first = self.directory(agent_path) / "000001.jsonl"
+        tmp = first.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for r in records if isinstance(records, list) else []:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        os.replace(tmp, first)
+        os.replace(legacy, legacy.with_name("memory.json.migrated"))
+        self.migrated += 1
+        logger.info(f"📦 Память {agent_path.name} перенесена в сегменты: {len(records)} записей")
+        if first.name == "000000.jsonl":
+            self._schedule_compaction(first)
+
+    # === Чтение ===
+    @staticmethod
+    def _read_segment(path: Path) -> list[dict]:
+        try:
+            if path.name.endswith(".gz"):
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    lines = f.read().splitlines()
+            else:
+                lines = path.read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return []
+        return _parse(lines)
+
+    @staticmethod
+    def _tail_lines(path: Path, n: int) -> list[str]:
+        """Последние n строк файла — чтение блоками с конца."""
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = b""
+            while pos > 0 and data.count(b"\n") <= n:
+                step = min(_TAIL_BLOCK, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        return data.decode("utf-8", errors="ignore").splitlines()[-n:]
+
+    def tail(self, agent_path: Path, n: int) -> list[dict]:
+        """Последние n записей (от старых к новым)."""
+        agent_path = Path(agent_path)
+        if (agent_path / "memory.json").exists():
+            with self._lock(agent_path):
+                self._migrate(agent_path)
+        found: list[dict] = []
+        for seg in reversed(self.segments(agent_path)):
+            need = n - len(found)
+            if need <= 0:
+                break
+            if seg.name.endswith(".gz"):
+                records = self._read_segment(seg)[-need:]
+            else:
+                try:
+                    records = _parse(self._tail_lines(seg, need))
+                except OSError:
+                    records = []
+            found = records + found
+        return found[-n:] if n > 0 else []
+
+    def read_all(self, agent_path: Path) -> list[dict]:
+        agent_path = Path(agent_path)
+        if (agent_path / "memory.json").exists():
+            with self._lock(agent_path):
+                self._migrate(agent_path)
+        records = []
+        for seg in self.segments(agent_path):
+            records.extend(self._read_segment(seg))
+        return records
+
+    # === Сжатие закрытых сегментов ===
+    def _schedule_compaction(self, segment: Path):
+        self._compact_queue.put(segment)
+        with self._start_lock:
+            if self._compactor is None or not self._compactor.is_alive():
+                self._compactor = threading.Thread(target=self._compact_loop, name="memory-compactor", daemon=True)
+                self._compactor.start()
+
+    def _compact_loop(self):
+        while True:
+            segment = self._compact_queue.get()
+            try:
+                self.compact(segment)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось сжать сегмент памяти {segment}: {e}")
+
+    def compact(self, segment: Path):
+        """Сжимает закрытый сегмент в .jsonl.gz (атомарно: tmp → rename → удаление исходника)."""
+        if not segment.exists():
+            return
+        archive = segment.with_name(segment.name + ".gz")
+        tmp = archive.with_name(archive.name + ".tmp")
+        with open(segment, "rb") as src, gzip.open(tmp, "wb") as dst:
+            for chunk in iter(lambda: src.read(_TAIL_BLOCK), b""):
+                dst.write(chunk)
+        os.replace(tmp, archive)
+        segment.unlink(missing_ok=True)
+        self.compacted += 1
+
+    def stats(self) -> dict:
+        return {
+            "appends": self.appends,
+            "rolled": self.rolled,
+            "compacted": self.compacted,
+            "migrated": self.migrated,
+            "compaction_queue": self._compact_queue.qsize(),
+        }
+
+
+def _parse(lines: list[str]) -> list[dict]:
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue  # строка, оборванная при сбое записи
+    return records
+
+
+memory_log = MemoryLog()
+
+
+class MemoryIndex:
+    """
+    Последние записи памяти агентов, по файлу-шарду на владельца:
+    {slug: {"tail": [...], "count": N, "updated": date}}.
+    Шард кэшируется в памяти и перечитывается, только если файл изменился
+    (mtime, размер, inode) — например, его обновил другой воркер.
+    """
+
+    def __init__(self, directory: Path = MEMORY_INDEX_DIR, tail_size: int = MEMORY_TAIL_SIZE):
+        self.directory = Path(directory)
+        self.tail_size = tail_size
+        self._cache: dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _file(self, owner: str) -> Path:
+        name = re.sub(r"[^\w.-]", "_", owner or "_").lstrip(".") or "_"
+        return self.directory / f"{name}.json"
+
+    @staticmethod
+    def _signature(path: Path):
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _load(self, owner: str) -> dict | None:
+        path = self._file(owner)
+        sig = self._signature(path)
+        if sig is None:
+            return None
+        with self._lock:
+            cached = self._cache.get(owner)
+            if cached and cached[0] == sig:
+                return cached[1]
+        try:
+            shard = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return None
+        with self._lock:
+            self._cache[owner] = (sig, shard)
+        return shard
+
+    def _store(self, owner: str, shard: dict):
+        path = self._file(owner)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(shard, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+        with self._lock:
+            self._cache[owner] = (self._signature(path), shard)
+
+    def record(self, owner: str, slug: str, record: dict):
+        """
+        Добавляет запись в кольцо последних записей агента. Если шарда владельца
+        ещё нет, он сначала строится по журналам всех его агентов — иначе шард
+        из одной этой записи скрыл бы память остальных (shard() его уже не перестроит).
+        """
+        path = self._file(owner)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(str(path) + ".lock"):
+            shard = self._load(owner)
+            if shard is None:
+                # Журнал уже содержит и эту запись (save_memory пишет его первым)
+                shard = self._collect(meta_store.find(owner=owner, is_folder=False))
+                if (shard.get(slug) or {}).get("tail", [])[-1:] == [record]:
+                    self._store(owner, shard)
+                    return
+            shard = dict(shard)
+            item = dict(shard.get(slug) or {"tail": [], "count": 0})
+            item["tail"] = (item.get("tail", []) + [record])[-self.tail_size:]
+            # count неизвестен (None), если шард строился по журналам
+            item["count"] = None if item.get("count") is None else item["count"] + 1
+            item["updated"] = record.get("date")
+            shard[slug] = item
+            self._store(owner, shard)
+
+    def _collect(self, agents: list[dict]) -> dict:
+        shard = {}
+        for a in agents:
+            if not a.get("path"):
+                continue
+            tail = memory_log.tail(Path(a["path"]), self.tail_size)
+            if tail:
+                shard[a["slug"]] = {"tail": tail, "count": None, "updated": tail[-1].get("date")}
+        return shard
+
+    def build(self, owner: str, agents: list[dict]) -> dict:
+        """Строит шард владельца по журналам памяти (первый запуск или потерянный индекс)."""
+        path = self._file(owner)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(str(path) + ".lock"):
+            shard = self._collect(agents)
+            self._store(owner, shard)
+        return shard
+
+    def forget(self, owner: str, slug: str):
+        path = self._file(owner)
+        if not path.exists():
+            return
+        with FileLock(str(path) + ".lock"):
+            shard = dict(self._load(owner) or {})
+            if shard.pop(slug, None) is not None:
+                self._store(owner, shard)
+
+    def shard(self, owner: str, agents: list[dict]) -> dict:
+        """Шард владельца; строится при первом обращении."""
+        shard = self._load(owner)
+        if shard is None:
+            shard = self.build(owner, agents)
+        return shard
+
+
+memory_index = MemoryIndex()
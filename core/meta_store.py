@@ -0,0 +1,394 @@
+"""
+Хранилище метаданных агентов и каталогов (SQLite, режим WAL).
+
+Раньше все записи лежали в agents/agents.json: каждый запрос разбирал файл
+целиком, а каждое изменение переписывало его под общей блокировкой.
+Теперь каждая запись — строка таблицы agents: поля owner/folder/slug/is_folder
+вынесены в индексируемые колонки, полная запись хранится JSON-ом в data.
+Изменения выполняются транзакциями; при первом запуске записи из agents.json
+переносятся в базу (один раз, файл остаётся как резервная копия).
+
+Поверх базы — кэш в памяти процесса: разобранные записи хранятся между
+запросами и перепроверяются дёшево, по stat() файлов базы и WAL
+(mtime, размер, inode). Если файлы изменились, сверяется счётчик версии
+в таблице settings: его увеличивает каждая транзакция записи, поэтому
+изменения из других воркеров/процессов замечаются, а свои записи
+применяются к кэшу сразу после COMMIT без перечитывания таблицы.
+"""
+import os
+import json
+import bisect
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger("manager")
+
+BASE = Path(__file__).resolve().parent.parent
+
+# === Настройки ===
+META_DB_PATH = Path(os.getenv("META_DB_PATH", str(BASE / "agents" / "agents.db")))
+META_JSON_PATH = BASE / "agents" / "agents.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS agents (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner     TEXT,
+    folder    TEXT,
+    slug      TEXT NOT NULL,
+    is_folder INTEGER NOT NULL DEFAULT 0,
+    data      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_agents_owner_folder_slug ON agents(owner, folder, slug);
+CREATE INDEX IF NOT EXISTS idx_agents_slug ON agents(slug);
+CREATE TABLE IF NOT EXISTS settings (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _columns(entry: dict) -> tuple:
+    return (
+        entry.get("owner"),
+        entry.get("folder"),
+        entry.get("slug") or "",
+        int(bool(entry.get("is_folder"))),
+        json.dumps(entry, ensure_ascii=False),
+    )
+
+
+class MetaIndex:
+    """
+    Индексы над записями: owner → folder → slug → [id] и slug → [id]
+    (общий индекс по slug нужен маршрутизации вебхуков, где владелец неизвестен).
+    Списки id отсортированы — порядок выдачи совпадает с порядком создания.
+    """
+
+    def __init__(self, rows=()):
+        self.rows: dict[int, dict] = {}
+        self.tree: dict[str | None, dict[str | None, dict[str, list[int]]]] = {}
+        self.slugs: dict[str, list[int]] = {}
+        for row_id, entry in rows:
+            self.put(row_id, entry)
+
+    @staticmethod
+    def _keys(entry: dict) -> tuple:
+        return entry.get("owner"), entry.get("folder"), entry.get("slug") or ""
+
+    def put(self, row_id: int, entry: dict):
+        if row_id in self.rows:
+            self._unlink(row_id, self.rows[row_id])
+        self.rows[row_id] = entry
+        owner, folder, slug = self._keys(entry)
+        bisect.insort(self.tree.setdefault(owner, {}).setdefault(folder, {}).setdefault(slug, []), row_id)
+        bisect.insort(self.slugs.setdefault(slug, []), row_id)
+
+    def remove(self, row_id: int):
+        entry = self.rows.pop(row_id, None)
+        if entry is not None:
+            self._unlink(row_id, entry)
+
+    def _unlink(self, row_id: int, entry: dict):
+        owner, folder, slug = self._keys(entry)
+        folders = self.tree.get(owner, {})
+        slugs = folders.get(folder, {})
+        ids = slugs.get(slug, [])
+        if row_id in ids:
+            ids.remove(row_id)
+        if not ids:
+            slugs.pop(slug, None)
+        if not slugs:
+            folders.pop(folder, None)
+        if not folders:
+            self.tree.pop(owner, None)
+        ids = self.slugs.get(slug, [])
+        if row_id in ids:
+            ids.remove(row_id)
+        if not ids:
+            self.slugs.pop(slug, None)
+
+    def query(self, owner=None, folder=None, slug=None, is_folder=None) -> list[dict]:
+        if owner is not None:
+            folders = self.tree.get(owner, {})
+            groups = [folders.get(folder, {})] if folder is not None else folders.values()
+            ids = []
+            for slugs in groups:
+                if slug is not None:
+                    ids.extend(slugs.get(slug, ()))
+                else:
+                    for slug_ids in slugs.values():
+                        ids.extend(slug_ids)
+            ids.sort()
+        elif slug is not None:
+            ids = self.slugs.get(slug, [])
+        else:
+            ids = sorted(self.rows)
+
+        found = []
+        for row_id in ids:
+            e = self.rows[row_id]
+            if folder is not None and e.get("folder") != folder:
+                continue
+            if is_folder is not None and bool(e.get("is_folder")) != is_folder:
+                continue
+            found.append(dict(e))
+        return found
+
+
+class MetaStore:
+    """Записи agents.json в SQLite: индексированные выборки и транзакционные изменения."""
+
+    def __init__(self, db_path: Path = META_DB_PATH, json_path: Path = META_JSON_PATH):
+        self.db_path = Path(db_path)
+        self.json_path = Path(json_path)
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._ready = False
+        # Кэш записей с индексами, версия и подпись файлов, на которых он построен
+        self._cache_lock = threading.Lock()
+        self._cache: MetaIndex | None = None
+        self._version = -1
+        self._signature = None
+        self.hits = 0
+        self.revalidations = 0
+        self.reloads = 0
+
+    # === Соединения ===
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    conn.executescript(_SCHEMA)
+                    self._migrate_json(conn)
+                    self._ready = True
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение потока с базой — для соседних таблиц (users, см. core/users.py)."""
+        return self._conn()
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE … COMMIT: изменения видны другим процессам целиком или никак.
+        Вложенный вызов выполняется внутри уже открытой транзакции.
+        Изменения кэша копятся до COMMIT и отбрасываются при ROLLBACK."""
+        conn = self._conn()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.pending = []
+        try:
+            yield conn
+            version = None
+            if self._local.pending:
+                conn.execute(
+                    "INSERT INTO settings (key, value) VALUES ('version', 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+                )
+                version = self._read_version(conn)
+        except BaseException:
+            self._local.pending = []
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        pending, self._local.pending = self._local.pending, []
+        if version is not None:
+            self._apply(pending, version)
+
+    # === Кэш ===
+    def _files_signature(self):
+        sig = []
+        for path in (self.db_path, Path(str(self.db_path) + "-wal")):
+            try:
+                st = path.stat()
+                sig.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    @staticmethod
+    def _read_version(conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT value FROM settings WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _apply(self, ops: list[tuple], version: int):
+        """Применяет свои изменения к кэшу после COMMIT (или сбрасывает кэш, если он отстал)."""
+        with self._cache_lock:
+            if self._cache is None or self._version != version - 1:
+                self._cache = None
+                return
+            for op, row_id, entry in ops:
+                if op == "put":
+                    self._cache.put(row_id, entry)
+                else:
+                    self._cache.remove(row_id)
+            self._version = version
+            # Подпись файлов не запоминаем: между COMMIT и stat() мог записать другой процесс,
+            # следующее чтение сверит версию
+            self._signature = None
+
+    def _snapshot(self) -> MetaIndex:
+        """Актуальные записи: из кэша, если база не менялась, иначе — перечитанные.
+        Индекс меняется на месте под _cache_lock — читать его только под этой блокировкой."""
+        conn = self._conn()
+        if conn.in_transaction:
+            # Внутри транзакции записи читаем напрямую: они могут быть ещё не зафиксированы
+            rows = conn.execute("SELECT id, data FROM agents ORDER BY id").fetchall()
+            return MetaIndex((r[0], json.loads(r[1])) for r in rows)
+
+        signature = self._files_signature()
+        with self._cache_lock:
+            if self._cache is not None and signature == self._signature:
+                self.hits += 1
+                return self._cache
+
+        conn.execute("BEGIN")
+        try:
+            version = self._read_version(conn)
+            with self._cache_lock:
+                if self._cache is not None and version == self._version:
+                    # Файлы тронуты (например, checkpoint WAL), но данные те же
+                    self._signature = signature
+                    self.revalidations += 1
+                    return self._cache
+            rows = conn.execute("SELECT id, data FROM agents ORDER BY id").fetchall()
+        finally:
+            conn.execute("COMMIT")
+
+        cache = MetaIndex((r[0], json.loads(r[1])) for r in rows)
+        with self._cache_lock:
+            self._cache, self._version, self._signature = cache, version, signature
+            self.reloads += 1
+        return cache
+
+    def invalidate(self):
+        with self._cache_lock:
+            self._cache = None
+
+    def _pending(self, op: str, row_id: int, entry: dict | None = None):
+        self._local.pending.append((op, row_id, entry))
+
+    def _migrate_json(self, conn: sqlite3.Connection):
+        """Однократный перенос записей из agents.json."""
+        done = conn.execute("SELECT value FROM settings WHERE key = 'migrated_json'").fetchone()
+        if done or not self.json_path.exists():
+            return
+        try:
+            entries = json.loads(self.json_path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.json_path.name} для переноса: {e}")
+            entries = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT COUNT(*) FROM agents").fetchone()[0] == 0:
+                conn.executemany(
+                    "INSERT INTO agents (owner, folder, slug, is_folder, data) VALUES (?, ?, ?, ?, ?)",
+                    [_columns(e) for e in entries if isinstance(e, dict)],
+                )
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('migrated_json', ?)",
+                         (str(len(entries)),))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        logger.info(f"📦 Метаданные перенесены из {self.json_path.name} в {self.db_path.name}: {len(entries)} записей")
+
+    # === Чтение ===
+    def all(self) -> list[dict]:
+        return self.find()
+
+    def find(self, owner: str | None = None, folder: str | None = None,
+             slug: str | None = None, is_folder: bool | None = None) -> list[dict]:
+        """Выборка по индексам owner/folder/slug (None — без условия) с фильтром is_folder."""
+        index = self._snapshot()
+        with self._cache_lock:
+            return index.query(owner, folder, slug, is_folder)
+
+    def get(self, slug: str, owner: str | None = None) -> dict | None:
+        found = self.find(owner=owner, slug=slug)
+        return found[0] if found else None
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._cache.rows) if self._cache is not None else None,
+            "owners": len(self._cache.tree) if self._cache is not None else None,
+            "version": self._version,
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "reloads": self.reloads,
+        }
+
+    # === Изменения ===
+    def create(self, entry: dict) -> dict:
+        with self.transaction() as conn:
+            cur = conn.execute("INSERT INTO agents (owner, folder, slug, is_folder, data) VALUES (?, ?, ?, ?, ?)",
+                               _columns(entry))
+            self._pending("put", cur.lastrowid, dict(entry))
+        return entry
+
+    @staticmethod
+    def _update_row(conn: sqlite3.Connection, slug: str, owner: str | None, changes: dict, drop=()):
+        if owner is None:
+            row = conn.execute("SELECT id, data FROM agents WHERE slug = ? AND owner IS NULL ORDER BY id",
+                               (slug,)).fetchone()
+        else:
+            row = conn.execute("SELECT id, data FROM agents WHERE slug = ? AND owner = ? ORDER BY id",
+                               (slug, owner)).fetchone()
+        if not row:
+            return None, None
+        entry = {**json.loads(row[1]), **changes}
+        for key in drop:
+            entry.pop(key, None)
+        conn.execute("UPDATE agents SET owner = ?, folder = ?, slug = ?, is_folder = ?, data = ? WHERE id = ?",
+                     (*_columns(entry), row[0]))
+        return row[0], entry
+
+    def update(self, slug: str, owner: str | None, changes: dict, drop=()) -> dict | None:
+        """Обновляет поля первой записи с таким slug у владельца (drop — удаляемые ключи);
+        возвращает новую запись."""
+        with self.transaction() as conn:
+            row_id, entry = self._update_row(conn, slug, owner, changes, drop)
+            if row_id is not None:
+                self._pending("put", row_id, dict(entry))
+        return entry
+
+    def _delete_where(self, where: str, params: tuple) -> int:
+        with self.transaction() as conn:
+            ids = [r[0] for r in conn.execute(f"SELECT id FROM agents WHERE {where}", params)]
+            for row_id in ids:
+                conn.execute("DELETE FROM agents WHERE id = ?", (row_id,))
+                self._pending("del", row_id)
+        return len(ids)
+
+    def delete(self, slug: str, owner: str) -> int:
+        return self._delete_where("slug = ? AND owner = ?", (slug, owner))
+
+    def delete_folder(self, folder: str, owner: str) -> int:
+        """Удаляет запись каталога и все записи владельца в нём."""
+        return self._delete_where("(folder = ? AND owner = ?) OR slug = ?", (folder, owner, f"folder_{folder}_{owner}"))
+
+    def replace_all(self, entries: list[dict]):
+        """Полная перезапись (совместимость со save_meta для массовых правок)."""
+        with self.transaction() as conn:
+            for (row_id,) in conn.execute("SELECT id FROM agents").fetchall():
+                self._pending("del", row_id)
+            conn.execute("DELETE FROM agents")
+            for e in entries:
+                cur = conn.execute("INSERT INTO agents (owner, folder, slug, is_folder, data) VALUES (?, ?, ?, ?, ?)",
+                                   _columns(e))
+                self._pending("put", cur.lastrowid, dict(e))
+
+
+meta_store = MetaStore()
@@ -0,0 +1,40 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+from core.auth import get_current_user
+from core.loader import registry
+from core.executor import agent_executor
+from core.workers import worker_pool
+from core.llm_cache import response_cache
+from core.singleflight import agent_flights
+from core.tokens import token_usage
+from core.meta_store import meta_store
+from core.mcp import context_store
+from core.retrieval import memory_retriever
+from core.compaction import context_compactor
+from core.users import user_store
+from core.passwords import password_hasher, login_throttle
+from core.sessions import token_cache, revocations
+
+router = APIRouter()
+
+
+@router.get("/api/metrics", response_class=JSONResponse)
+async def runtime_metrics(user: str = Depends(get_current_user)):
+    """Счётчики рантайма менеджера: кэш модулей агентов, очередь исполнителя и т.п."""
+    return {
+        "ok": True,
+        "modules": registry.stats(),
+        "executor": agent_executor.stats(),
+        "workers": worker_pool.stats(),
+        "llm_cache": response_cache.stats(),
+        "coalescing": agent_flights.stats(),
+        "tokens": token_usage.stats(),
+        "meta": meta_store.stats(),
+        "context": context_store.stats(),
+        "retrieval": memory_retriever.stats(),
+        "compaction": context_compactor.stats(),
+        "users": user_store.stats(),
+        "passwords": password_hasher.stats(),
+        "login_throttle": login_throttle.stats(),
+        "auth_tokens": {**token_cache.stats(), **revocations.stats()},
+    }
@@ -7,7 +7,8 @@ from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 
 from core.auth import get_current_user
-from utils import load_meta, save_meta, ensure_user_root, filter_meta_by_owner
+from utils import ensure_user_root
+from core.meta_store import meta_store
 
 logger = logging.getLogger("manager")
 router = APIRouter()
@@ -38,12 +39,9 @@ def get_folders(user: str = Depends(get_current_user)):
     Возвращает список всех каталогов (папок) текущего пользователя.
     Показывает только те, у которых is_folder=True.
     """
-    meta = load_meta()
-    user_meta = filter_meta_by_owner(meta, user)
     folders = sorted({
         a.get("folder", "root")
-        for a in user_meta
-        if a.get("is_folder", False)
+        for a in meta_store.find(owner=user, is_folder=True)
     })
     return JSONResponse(folders)
 
@@ -53,13 +51,10 @@ async def get_folder_agents(folder_name: str, user: str = Depends(get_current_us
     """
     Возвращает всех агентов текущего пользователя внутри заданного каталога.
     """
-    meta = load_meta()
     folder = folder_name.strip().lower()
     agents = [
-        a for a in meta
-        if not a.get("is_folder", False)
-        and a.get("folder", "").strip().lower() == folder
-        and a.get("owner") == user
+        a for a in meta_store.find(owner=user, is_folder=False)
+        if a.get("folder", "").strip().lower() == folder
     ]
     return JSONResponse(agents)
 
@@ -68,8 +63,7 @@ async def get_folder_agents(folder_name: str, user: str = Depends(get_current_us
 @router.get("/agents", response_class=JSONResponse)
 async def list_agents(user: str = Depends(get_current_user)):
     """Возвращает список всех агентов текущего пользователя."""
-    meta = load_meta()
-    agents = [a for a in meta if not a.get("is_folder", False) and a.get("owner") == user]
+    agents = meta_store.find(owner=user, is_folder=False)
     return JSONResponse(agents)
 
 
@@ -80,13 +74,10 @@ async def init_user_workspace(user: str = Depends(get_current_user)):
     Гарантирует, что у пользователя есть директория /agents/{user},
     папка root и агент assistant_default.
     """
-    meta = load_meta()
+    meta = meta_store.find(owner=user)
     
     # Удаляем старые дубликаты ассистентов этого пользователя
-    assistants = [
-        a for a in meta
-        if a.get("slug") == "assistant_default" and a.get("owner") == user
-    ]
+    assistants = [a for a in meta if a.get("slug") == "assistant_default"]
     if len(assistants) > 1:
         logger.warning(f"⚠️ Найдено {len(assistants)} ассистентов у пользователя {user}, оставляем одного.")
         keep = min(assistants, key=lambda a: a.get("created_at", ""))
@@ -99,7 +90,9 @@ async def init_user_workspace(user: str = Depends(get_current_user)):
                     meta.remove(extra)
                 except Exception as e:
                     logger.warning(f"Ошибка удаления дубликата ассистента: {e}")
-        save_meta(meta)
+        with meta_store.transaction():
+            meta_store.delete("assistant_default", user)
+            meta_store.create(keep)
     
     user_root = ensure_user_root(user)
 
@@ -109,7 +102,7 @@ async def init_user_workspace(user: str = Depends(get_current_user)):
         for a in meta
     )
     if not has_root:
-        meta.append({
+        meta_store.create({
             "folder": "root",
             "is_folder": True,
             "name": "root",
@@ -117,7 +110,6 @@ async def init_user_workspace(user: str = Depends(get_current_user)):
             "owner": user,
             "created_at": __import__('datetime').datetime.utcnow().isoformat() + 'Z'
         })
-        save_meta(meta)
 
     # Проверяем наличие assistant_default
     # Проверяем наличие ассистента пользователя (по slug и owner)
@@ -263,8 +255,7 @@ async def init_user_workspace(user: str = Depends(get_current_user)):
             "deploy_url": "",
             "status": "ready"
         }
-        meta.append(entry)
-        save_meta(meta)
+        meta_store.create(entry)
         logger.info(f"✅ Создан assistant_default с Amvera LLM для пользователя {user}")
     else:
         logger.info(f"ℹ️ assistant_default уже существует для пользователя {user}")
@@ -0,0 +1,171 @@
+"""
+Хэширование паролей вне event loop и ограничение неудачных входов.
+
+bcrypt намеренно медленный (100–300 мс CPU на проверку). Вызванный прямо
+в async-обработчике /login, он останавливал все остальные запросы менеджера.
+Здесь хэширование и проверка уходят в отдельный небольшой пул потоков
+(bcrypt отпускает GIL), а очередь к нему ограничена: при перегрузке запрос
+получает 503 сразу, а не копится.
+
+Неудачные входы считаются в скользящем окне LOGIN_FAILURE_WINDOW секунд
+отдельно по имени пользователя и по IP. Когда лимит исчерпан, /login отвечает
+429 ещё до bcrypt — перебор паролей не может занять весь CPU менеджера.
+Попытки, которые ещё проверяются, идут в лимит наравне с неудачными: пачка
+одновременных запросов не проскакивает мимо счётчика, пока bcrypt занят.
+Успешный вход сбрасывает счётчик имени.
+
+IP берётся из request.client. За обратным прокси это адрес прокси, пока uvicorn
+не доверяет его X-Forwarded-For: адрес прокси нужно указать в FORWARDED_ALLOW_IPS,
+иначе лимит по IP становится общим для всех пользователей.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+PASSWORD_HASH_THREADS = int(os.getenv("PASSWORD_HASH_THREADS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+LOGIN_FAILURE_WINDOW = float(os.getenv("LOGIN_FAILURE_WINDOW", "300"))
+LOGIN_MAX_FAILURES_PER_USER = int(os.getenv("LOGIN_MAX_FAILURES_PER_USER", "5"))
+LOGIN_MAX_FAILURES_PER_IP = int(os.getenv("LOGIN_MAX_FAILURES_PER_IP", "20"))
+
+
+class HasherBusy(Exception):
+    """Очередь к пулу хэширования переполнена."""
+
+
+class PasswordHasher:
+    def __init__(self, threads: int = PASSWORD_HASH_THREADS, max_queue: int = PASSWORD_HASH_MAX_QUEUE):
+        self.threads = threads
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.completed = 0
+        self.rejected = 0
+        self._busy_total = 0.0
+
+    async def run(self, fn, *args):
+        """Выполняет fn(*args) (verify/hash) в пуле bcrypt; HasherBusy — очередь переполнена."""
+        with self._lock:
+            if self.inflight >= self.threads + self.max_queue:
+                self.rejected += 1
+                raise HasherBusy()
+            self.inflight += 1
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+                self.completed += 1
+                self._busy_total += time.monotonic() - started
+
+    def stats(self) -> dict:
+        return {
+            "threads": self.threads,
+            "inflight": self.inflight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_ms": round(self._busy_total / self.completed * 1000, 1) if self.completed else None,
+        }
+
+
+class LoginThrottle:
+    """Неудачные и ещё не завершённые входы по имени и по IP в скользящем окне."""
+
+    def __init__(self, window: float = LOGIN_FAILURE_WINDOW,
+                 per_user: int = LOGIN_MAX_FAILURES_PER_USER, per_ip: int = LOGIN_MAX_FAILURES_PER_IP):
+        self.window = window
+        self.limits = {"user": per_user, "ip": per_ip}
+        self._failures: dict[tuple, deque] = {}
+        self._inflight: dict[tuple, int] = {}
+        self._lock = threading.Lock()
+        self.blocked = 0
+        self._last_sweep = time.monotonic()
+
+    @staticmethod
+    def _keys(username: str, ip: str | None) -> list[tuple]:
+        return [key for key in (("user", username), ("ip", ip)) if key[1] is not None]
+
+    def _recent(self, key: tuple, now: float) -> deque | None:
+        q = self._failures.get(key)
+        if q is None:
+            return None
+        while q and now - q[0] > self.window:
+            q.popleft()
+        if not q:
+            del self._failures[key]
+            return None
+        return q
+
+    def _sweep(self, now: float):
+        """Убирает устаревшие счётчики, чтобы словарь не рос от случайных имён."""
+        if now - self._last_sweep < self.window:
+            return
+        self._last_sweep = now
+        for key in list(self._failures):
+            self._recent(key, now)
+
+    def _release(self, keys: list[tuple]):
+        for key in keys:
+            left = self._inflight.get(key, 0) - 1
+            if left > 0:
+                self._inflight[key] = left
+            else:
+                self._inflight.pop(key, None)
+
+    def acquire(self, username: str, ip: str | None) -> int:
+        """
+        Начинает попытку входа. 0 — можно (попытка учтена как незавершённая,
+        её нужно закрыть failure/success/release), иначе — через сколько секунд пробовать снова.
+        """
+        now = time.monotonic()
+        wait = 0.0
+        keys = self._keys(username, ip)
+        with self._lock:
+            for key in keys:
+                q = self._recent(key, now)
+                failed = len(q) if q is not None else 0
+                if failed + self._inflight.get(key, 0) < self.limits[key[0]]:
+                    continue
+                # Лимит заняли идущие проверки — их исход станет известен через доли секунды
+                wait = max(wait, self.window - (now - q[0]) if failed >= self.limits[key[0]] else 1.0)
+            if wait <= 0:
+                for key in keys:
+                    self._inflight[key] = self._inflight.get(key, 0) + 1
+                return 0
+        self.blocked += 1
+        return int(wait) + 1
+
+    def failure(self, username: str, ip: str | None):
+        now = time.monotonic()
+        keys = self._keys(username, ip)
+        with self._lock:
+            self._release(keys)
+            self._sweep(now)
+            for key in keys:
+                self._failures.setdefault(key, deque(maxlen=self.limits[key[0]])).append(now)
+
+    def success(self, username: str, ip: str | None):
+        with self._lock:
+            self._release(self._keys(username, ip))
+            self._failures.pop(("user", username), None)
+
+    def release(self, username: str, ip: str | None):
+        """Закрывает попытку без исхода (ошибка до проверки пароля, например HasherBusy)."""
+        with self._lock:
+            self._release(self._keys(username, ip))
+
+    def stats(self) -> dict:
+        return {"tracked": len(self._failures), "inflight": sum(self._inflight.values()), "blocked": self.blocked}
+
+
+password_hasher = PasswordHasher()
+login_throttle = LoginThrottle()
@@ -0,0 +1,75 @@
+"""
+Рендеринг ответов агентов в HTML (markdown2), в том числе инкрементальный —
+для потоковой выдачи /assign_task_stream.
+"""
+import json
+import logging
+from markdown2 import markdown
+
+logger = logging.getLogger("manager")
+
+MARKDOWN_EXTRAS = ["fenced-code-blocks", "tables"]
+
+
+def normalize_result_text(raw_text: str) -> str:
+    """Пустой ответ → заглушка, валидный JSON → красиво отформатированный JSON."""
+    raw_text = (raw_text or "").strip()
+    if not raw_text:
+        return "(пустой ответ от агента)"
+    if raw_text.lstrip().startswith(("{", "[")):
+        try:
+            return json.dumps(json.loads(raw_text), ensure_ascii=False, indent=2)
+        except (json.JSONDecodeError, TypeError, ValueError):
+            logger.warning("[render] ответ агента невалидный JSON, обрабатываю как текст")
+    return raw_text
+
+
+def render_markdown(text: str) -> str:
+    return markdown(text, extras=MARKDOWN_EXTRAS)
+
+
+class IncrementalMarkdown:
+    """
+    Рендерит Markdown по мере поступления текста.
+    Каждый завершённый блок (абзац, список, таблица, блок кода) рендерится один раз:
+    граница блока — пустая строка вне ``` -блока. Незавершённый хвост остаётся в буфере.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0          # до какого символа буфер уже отрендерен
+        self._scan = 0         # до какого символа буфер уже просмотрен
+        self._in_fence = False
+        self._boundary = 0     # последняя найденная безопасная граница
+
+    def feed(self, text: str) -> str:
+        """Добавляет текст; возвращает HTML для блоков, которые завершились (или '')."""
+        self.buffer += text
+        # Просматриваем только полные строки, которые ещё не видели
+        while True:
+            nl = self.buffer.find("\n", self._scan)
+            if nl == -1:
+                break
+            line = self.buffer[self._scan:nl]
+            if line.lstrip().startswith("```"):
+                self._in_fence = not self._in_fence
+            elif not line.strip() and not self._in_fence:
+                self._boundary = nl + 1
+            self._scan = nl + 1
+
+        if self._boundary <= self._pos:
+            return ""
+        chunk = self.buffer[self._pos:self._boundary]
+        self._pos = self._boundary
+        return render_markdown(chunk) if chunk.strip() else ""
+
+    @property
+    def pending(self) -> str:
+        """Ещё не отрендеренный хвост (показывается клиентом как обычный текст)."""
+        return self.buffer[self._pos:]
+
+    def finish(self) -> str:
+        """Рендерит оставшийся хвост после окончания потока."""
+        chunk = self.buffer[self._pos:]
+        self._pos = len(self.buffer)
+        return render_markdown(chunk) if chunk.strip() else ""
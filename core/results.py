@@ -0,0 +1,139 @@
+"""
+Хранилище результатов задач агентов.
+
+Результаты (HTML ответа) больше не лежат в метаданных агента (last_task):
+у каждого агента свой append-only файл data/results/<owner>/<slug>.jsonl,
+одна строка — одна задача. История ограничена RESULT_HISTORY последними
+записями (файл подрезается, когда вырастает вдвое). Фронт получает
+результаты отдельным запросом — /api/agent/{slug}/last_result и /results.
+"""
+import os
+import re
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from filelock import FileLock
+from fastapi import APIRouter, Depends, HTTPException, Query
+from core.auth import get_current_user
+from core.meta_store import meta_store
+
+logger = logging.getLogger("manager")
+router = APIRouter()
+
+BASE = Path(__file__).resolve().parent.parent
+
+# === Настройки ===
+RESULT_HISTORY = int(os.getenv("RESULT_HISTORY", "20"))
+RESULTS_DIR = Path(os.getenv("RESULTS_DIR", str(BASE / "data" / "results")))
+
+
+def _safe(name: str) -> str:
+    return re.sub(r"[^\w.-]", "_", name or "_").lstrip(".") or "_"
+
+
+class ResultStore:
+    def __init__(self, directory: Path = RESULTS_DIR, history: int = RESULT_HISTORY):
+        self.directory = Path(directory)
+        self.history = history
+        self._lines: dict[Path, int] = {}
+
+    def _file(self, owner: str, slug: str) -> Path:
+        return self.directory / _safe(owner) / f"{_safe(slug)}.jsonl"
+
+    def append(self, owner: str, slug: str, task: str, result, date: str | None = None) -> dict:
+        record = {
+            "task": task,
+            "result": result,
+            "date": date or datetime.utcnow().isoformat() + "Z",
+        }
+        path = self._file(owner, slug)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(str(path) + ".lock"):
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count = self._lines.get(path)
+            count = self._count(path) if count is None else count + 1
+            if count > 2 * self.history:
+                count = self._trim(path)
+            self._lines[path] = count
+        return record
+
+    @staticmethod
+    def _count(path: Path) -> int:
+        with open(path, "rb") as f:
+            return sum(1 for _ in f)
+
+    def _trim(self, path: Path) -> int:
+        lines = path.read_text(encoding="utf-8").splitlines()[-self.history:]
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+        os.replace(tmp, path)
+        return len(lines)
+
+    def history_of(self, owner: str, slug: str, limit: int | None = None) -> list[dict]:
+        """Последние результаты агента, новые — первыми."""
+        path = self._file(owner, slug)
+        try:
+            lines = path.read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return []
+        records = []
+        for line in reversed(lines):
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # строка, оборванная при сбое записи
+            if len(records) >= (limit or self.history):
+                break
+        return records
+
+    def latest(self, owner: str, slug: str) -> dict | None:
+        found = self.history_of(owner, slug, limit=1)
+        return found[0] if found else None
+
+    def forget(self, owner: str, slug: str):
+        path = self._file(owner, slug)
+        self._lines.pop(path, None)
+        path.unlink(missing_ok=True)
+
+
+result_store = ResultStore()
+
+
+def migrate_last_tasks() -> int:
+    """Переносит last_task из метаданных агентов в хранилище результатов (однократно)."""
+    moved = 0
+    with meta_store.transaction():
+        for entry in meta_store.find(is_folder=False):
+            last = entry.get("last_task")
+            if last is None:
+                continue
+            if isinstance(last, dict):
+                result_store.append(entry.get("owner"), entry["slug"], last.get("task", ""), last.get("result"))
+            meta_store.update(entry["slug"], entry.get("owner"), {}, drop=("last_task",))
+            moved += 1
+    if moved:
+        logger.info(f"📦 Результаты {moved} агентов перенесены из метаданных в {RESULTS_DIR}")
+    return moved
+
+
+# === API ===
+def _check_agent(slug: str, user: str):
+    if not meta_store.get(slug, owner=user):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+
+@router.get("/api/agent/{slug}/last_result")
+async def get_last_result(slug: str, user: str = Depends(get_current_user)):
+    """Последняя задача и результат агента (то, что раньше было last_task в /agents)."""
+    _check_agent(slug, user)
+    return {"ok": True, "agent": slug, "last_task": result_store.latest(user, slug)}
+
+
+@router.get("/api/agent/{slug}/results")
+async def get_results(slug: str, limit: int = Query(RESULT_HISTORY, ge=1, le=RESULT_HISTORY),
+                      user: str = Depends(get_current_user)):
+    """История результатов агента, новые — первыми."""
+    _check_agent(slug, user)
+    return {"ok": True, "agent": slug, "results": result_store.history_of(user, slug, limit)}
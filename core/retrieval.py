@@ -0,0 +1,251 @@
+"""
+Поиск релевантных записей памяти агента (BM25) для промпта.
+
+Вместо «последних N записей» в промпт идут записи памяти, наиболее похожие
+на текущую задачу. У каждого агента есть инвертированный индекс
+memory/bm25.jsonl — по строке на запись памяти: частоты терминов, длина
+и короткий фрагмент «задача → результат». Индекс пополняется в save_memory
+(дописыванием строки), в памяти процесса держатся списки вхождений,
+которые догоняют файл, дочитывая только новые строки. Для агентов с памятью,
+но без индекса, он строится по журналу памяти при первом обращении.
+Индекс хранит последние RETRIEVAL_MAX_DOCS записей (файл подрезается,
+когда вырастает вдвое).
+
+Токенизация простая: слова в нижнем регистре без HTML, обрезанные до
+RETRIEVAL_STEM символов — грубая замена стемминга, которой для русских
+словоформ («отчёт», «отчёта», «отчётом») хватает.
+"""
+import os
+import re
+import json
+import math
+import hashlib
+import logging
+import threading
+from collections import Counter
+from pathlib import Path
+from filelock import FileLock
+from core.memory import memory_log, MEMORY_DIR_NAME
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+RETRIEVAL_MAX_DOCS = int(os.getenv("RETRIEVAL_MAX_DOCS", "500"))
+RETRIEVAL_SNIPPET_CHARS = int(os.getenv("RETRIEVAL_SNIPPET_CHARS", "800"))
+RETRIEVAL_STEM = int(os.getenv("RETRIEVAL_STEM", "6"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+_INDEX_NAME = "bm25.jsonl"
+
+
+def tokenize(text: str) -> list[str]:
+    text = re.sub(r"<[^>]+>", " ", text or "").lower()
+    return [w[:RETRIEVAL_STEM] for w in re.findall(r"\w+", text) if len(w) > 1 and not w.isdigit()]
+
+
+def _strip_html(text: str) -> str:
+    return re.sub(r"\s+", " ", re.sub(r"<[^>]+>", " ", text or "")).strip()
+
+
+def _doc_key(record: dict) -> str:
+    raw = f"{record.get('date', '')}\x00{record.get('task', '')}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _document(record: dict) -> dict:
+    task = str(record.get("task", ""))
+    result = record.get("result", "")
+    if not isinstance(result, str):
+        result = json.dumps(result, ensure_ascii=False)
+    terms = tokenize(task) + tokenize(result)
+    result = _strip_html(result)
+    if len(result) > RETRIEVAL_SNIPPET_CHARS:
+        result = result[:RETRIEVAL_SNIPPET_CHARS].rstrip() + "…"
+    return {
+        "key": _doc_key(record),
+        "task": task,
+        "text": f"{task} → {result}",
+        "len": len(terms),
+        "tf": dict(Counter(terms)),
+    }
+
+
+class _Index:
+    """Списки вхождений одного агента и позиция, до которой прочитан файл индекса."""
+    __slots__ = ("docs", "postings", "total_len", "offset", "inode", "lines")
+
+    def __init__(self):
+        self.docs: dict[int, dict] = {}
+        self.postings: dict[str, dict[int, int]] = {}
+        self.total_len = 0
+        self.offset = 0
+        self.inode = None
+        self.lines = 0
+
+    def add(self, doc: dict):
+        doc_id = self.lines
+        self.lines += 1
+        self.docs[doc_id] = {"key": doc["key"], "task": doc["task"], "text": doc["text"], "len": doc["len"]}
+        self.total_len += doc["len"]
+        for term, tf in doc["tf"].items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+
+    def keys(self) -> set[str]:
+        return {d["key"] for d in self.docs.values()}
+
+
+class MemoryRetriever:
+    def __init__(self, max_docs: int = RETRIEVAL_MAX_DOCS):
+        self.max_docs = max_docs
+        self._cache: dict[Path, _Index] = {}
+        self._lock = threading.Lock()
+        self.indexed = 0
+        self.built = 0
+        self.searches = 0
+        self.matched = 0
+
+    @staticmethod
+    def _file(agent_path: Path) -> Path:
+        return Path(agent_path) / MEMORY_DIR_NAME / _INDEX_NAME
+
+    @staticmethod
+    def _file_lock(agent_path: Path) -> FileLock:
+        d = Path(agent_path) / MEMORY_DIR_NAME
+        d.mkdir(parents=True, exist_ok=True)
+        return FileLock(str(d / "bm25.lock"))
+
+    # === Загрузка ===
+    def _index(self, agent_path: Path) -> _Index | None:
+        """Индекс агента, догнавший файл; None — файла индекса ещё нет."""
+        path = self._file(agent_path)
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        with self._lock:
+            index = self._cache.get(path)
+            if index is None or index.inode != st.st_ino or index.offset > st.st_size:
+                index = _Index()
+                index.inode = st.st_ino
+                self._cache[path] = index
+            if index.offset == st.st_size:
+                return index
+            with open(path, "rb") as f:
+                f.seek(index.offset)
+                data = f.read(st.st_size - index.offset)
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].decode("utf-8", errors="ignore").splitlines():
+                try:
+                    index.add(json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    continue  # строка, оборванная при сбое записи
+            index.offset += end
+            return index
+
+    def _write(self, path: Path, docs: list[dict]):
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        os.replace(tmp, path)
+
+    def build(self, agent_path: Path) -> int:
+        """Строит индекс по журналу памяти агента (агенты, у которых индекса ещё не было)."""
+        agent_path = Path(agent_path)
+        with self._file_lock(agent_path):
+            records = [r for r in memory_log.read_all(agent_path) if isinstance(r, dict)][-self.max_docs:]
+            self._write(self._file(agent_path), [_document(r) for r in records])
+        self.built += 1
+        return len(records)
+
+    # === Запись ===
+    def add(self, agent_path: Path, record: dict):
+        """Добавляет запись памяти в индекс (вызывается после memory_log.append)."""
+        agent_path = Path(agent_path)
+        path = self._file(agent_path)
+        if not path.exists():
+            self.build(agent_path)  # журнал уже содержит и эту запись
+            return
+        doc = _document(record)
+        with self._file_lock(agent_path):
+            index = self._index(agent_path)
+            if index is not None and doc["key"] in index.keys():
+                return
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+            self.indexed += 1
+            if index is not None and index.lines + 1 > 2 * self.max_docs:
+                self._trim(path)
+
+    def _trim(self, path: Path):
+        lines = path.read_text(encoding="utf-8").splitlines()[-self.max_docs:]
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def forget(self, agent_path: Path):
+        path = self._file(agent_path)
+        with self._lock:
+            self._cache.pop(path, None)
+
+    # === Поиск ===
+    def search(self, agent_path: Path, query: str, k: int = RETRIEVAL_TOP_K, exclude_task: str | None = None) -> list[dict]:
+        """
+        Топ-k записей памяти по BM25: [{"text", "task", "score"}], самые похожие — первыми.
+        Записи о той же самой задаче (exclude_task) пропускаются.
+        """
+        agent_path = Path(agent_path)
+        index = self._index(agent_path)
+        if index is None:
+            if not memory_log.segments(agent_path) and not (agent_path / "memory.json").exists():
+                return []
+            self.build(agent_path)
+            index = self._index(agent_path)
+        self.searches += 1
+        terms = set(tokenize(query))
+        if index is None or not index.docs or not terms:
+            return []
+
+        # Документы за пределами последних max_docs (файл ещё не подрезан) не учитываем
+        first = max(0, index.lines - self.max_docs)
+        n = index.lines - first
+        avg_len = (index.total_len / len(index.docs)) or 1.0
+        scores: dict[int, float] = {}
+        for term in terms:
+            postings = index.postings.get(term)
+            if not postings:
+                continue
+            live = {d: tf for d, tf in postings.items() if d >= first}
+            if not live:
+                continue
+            idf = math.log(1 + (n - len(live) + 0.5) / (len(live) + 0.5))
+            for doc_id, tf in live.items():
+                dl = index.docs[doc_id]["len"]
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+
+        found = []
+        for doc_id, score in sorted(scores.items(), key=lambda x: (-x[1], -x[0])):
+            doc = index.docs[doc_id]
+            if exclude_task is not None and doc["task"] == exclude_task:
+                continue
+            found.append({"text": doc["text"], "task": doc["task"], "score": round(score, 3)})
+            if len(found) >= k:
+                break
+        if found:
+            self.matched += 1
+        return found
+
+    def stats(self) -> dict:
+        return {
+            "agents": len(self._cache),
+            "indexed": self.indexed,
+            "built": self.built,
+            "searches": self.searches,
+            "matched": self.matched,
+        }
+
+
+memory_retriever = MemoryRetriever()
@@ -0,0 +1,194 @@
+"""
+Проверенные токены, отзыв токенов и семейства refresh-токенов.
+
+get_current_user вызывается на каждый запрос, а интерфейс офиса делает их
+десятки на загрузку страницы — полная проверка JWT (разбор + HMAC) каждый раз
+не нужна. Проверенный токен кладётся в LRU-кэш по sha256 от токена; запись
+живёт TOKEN_CACHE_TTL секунд, но не дольше exp самого токена.
+
+Отзыв: таблица revoked_tokens в базе метаданных (общая для воркеров).
+Отзывается либо конкретный токен (jti), либо целое семейство ("fam:<id>") —
+все access- и refresh-токены одного входа. В памяти держится множество
+отозванных идентификаторов; новые строки дочитываются из базы не чаще,
+чем раз в TOKEN_REVOCATION_SYNC секунд, поэтому проверка на попадании
+в кэш остаётся проверкой по множеству.
+
+Ротация refresh-токена (rotate) отзывает его и запоминает выданную взамен пару
+на REFRESH_TOKEN_REUSE_GRACE секунд: несколько вкладок, одновременно
+предъявивших один и тот же refresh-токен, получают одну и ту же новую пару,
+а не отзыв всего входа как при утечке.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from core.meta_store import meta_store
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+TOKEN_CACHE_ITEMS = int(os.getenv("TOKEN_CACHE_ITEMS", "4096"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+TOKEN_REVOCATION_SYNC = float(os.getenv("TOKEN_REVOCATION_SYNC", "2"))
+REFRESH_TOKEN_REUSE_GRACE = float(os.getenv("REFRESH_TOKEN_REUSE_GRACE", "30"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    jti        TEXT NOT NULL UNIQUE,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rotated_tokens (
+    jti         TEXT PRIMARY KEY,
+    successor   TEXT NOT NULL,
+    reuse_until REAL NOT NULL
+);
+"""
+
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class TokenCache:
+    """LRU проверенных токенов: sha256(токен) → (срок записи, payload)."""
+
+    def __init__(self, items: int = TOKEN_CACHE_ITEMS, ttl: float = TOKEN_CACHE_TTL):
+        self.items = items
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token: str) -> dict | None:
+        key = token_hash(token)
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                expires, payload = item
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._memory[key]
+            self.misses += 1
+        return None
+
+    def put(self, token: str, payload: dict):
+        expires = min(time.time() + self.ttl, float(payload.get("exp") or 0) or float("inf"))
+        with self._lock:
+            self._memory[token_hash(token)] = (expires, payload)
+            self._memory.move_to_end(token_hash(token))
+            while len(self._memory) > self.items:
+                self._memory.popitem(last=False)
+                self.evictions += 1
+
+    def drop(self, token: str):
+        with self._lock:
+            self._memory.pop(token_hash(token), None)
+
+    def stats(self) -> dict:
+        return {"items": len(self._memory), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class RevocationList:
+    """Отозванные jti и семейства токенов (таблица revoked_tokens + множество в памяти)."""
+
+    def __init__(self, sync_interval: float = TOKEN_REVOCATION_SYNC, reuse_grace: float = REFRESH_TOKEN_REUSE_GRACE):
+        self.sync_interval = sync_interval
+        self.reuse_grace = reuse_grace
+        self._revoked: dict[str, float] = {}  # jti / "fam:<id>" → срок действия
+        self._last_id = 0
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+        self._ready = False
+        self.revoked_count = 0
+        self.reused_count = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = meta_store.connection()
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    conn.executescript(_SCHEMA)
+                    self._ready = True
+        return conn
+
+    def _sync(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._synced_at < self.sync_interval:
+            return
+        rows = self._conn().execute(
+            "SELECT id, jti, expires_at FROM revoked_tokens WHERE id > ?", (self._last_id,)
+        ).fetchall()
+        wall = time.time()
+        with self._lock:
+            for row_id, jti, expires_at in rows:
+                self._revoked[jti] = expires_at
+                self._last_id = max(self._last_id, row_id)
+            for jti in [j for j, exp in self._revoked.items() if exp < wall]:
+                del self._revoked[jti]
+            self._synced_at = now
+
+    def is_revoked(self, payload: dict) -> bool:
+        self._sync()
+        jti, fam = payload.get("jti"), payload.get("fam")
+        return (jti is not None and jti in self._revoked) or (fam is not None and f"fam:{fam}" in self._revoked)
+
+    def revoke(self, ident: str, expires_at: float):
+        """Отзывает jti или семейство ("fam:<id>") до expires_at (unix time)."""
+        self._conn()  # схема — до транзакции
+        with meta_store.transaction() as tx:
+            tx.execute("INSERT OR IGNORE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)", (ident, expires_at))
+            # Истёкшие токены и так не пройдут проверку exp — их записи больше не нужны
+            tx.execute("DELETE FROM revoked_tokens WHERE expires_at < ?", (time.time(),))
+        with self._lock:
+            self._revoked[ident] = expires_at
+        self.revoked_count += 1
+
+    def rotate(self, jti: str, expires_at: float, successor: dict) -> dict | None:
+        """
+        Отзывает использованный refresh-токен jti, выдавая взамен successor.
+        Возвращает пару для клиента: successor — при первом предъявлении,
+        ранее выданную пару — при повторе в пределах reuse_grace секунд,
+        None — повтор позже (токен утёк).
+        """
+        self._conn()  # схема — до транзакции
+        now = time.time()
+        with meta_store.transaction() as tx:
+            fresh = tx.execute(
+                "INSERT OR IGNORE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)", (jti, expires_at)
+            ).rowcount
+            if fresh:
+                tx.execute("DELETE FROM rotated_tokens WHERE reuse_until < ?", (now,))
+                tx.execute(
+                    "INSERT OR REPLACE INTO rotated_tokens (jti, successor, reuse_until) VALUES (?, ?, ?)",
+                    (jti, json.dumps(successor), now + self.reuse_grace),
+                )
+                result = successor
+            else:
+                row = tx.execute(
+                    "SELECT successor FROM rotated_tokens WHERE jti = ? AND reuse_until >= ?", (jti, now)
+                ).fetchone()
+                result = json.loads(row[0]) if row else None
+        with self._lock:
+            self._revoked[jti] = expires_at
+        if fresh:
+            self.revoked_count += 1
+        elif result is not None:
+            self.reused_count += 1
+        return result
+
+    def stats(self) -> dict:
+        return {"revoked": len(self._revoked), "revocations": self.revoked_count, "reused": self.reused_count}
+
+
+token_cache = TokenCache()
+revocations = RevocationList()
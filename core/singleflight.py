@@ -0,0 +1,69 @@
+"""
+Single-flight: одинаковые одновременные вызовы выполняются один раз.
+
+Если задача с тем же ключом (владелец, агент, текст задачи) уже выполняется,
+новый вызов не запускает второй LLM-запрос, а ждёт и получает тот же результат.
+Выполнение идёт в отдельной asyncio.Task, поэтому отмена одного из ожидающих
+(например, закрытая вкладка) не обрывает результат для остальных. Когда
+отменены все ожидающие (таймаут fan_out, дедлайн, закрытые вкладки), выполнение
+отменяется тоже — иначе брошенный вызов держал бы воркер и слот исполнителя
+и записывал бы контекст и память после ответа «timeout».
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger("manager")
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: dict[tuple, _Flight] = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def do(self, key: tuple, coro_fn, *args, **kwargs):
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(coro_fn(*args, **kwargs)))
+            self._inflight[key] = flight
+            flight.task.add_done_callback(lambda t: self._forget(key, flight))
+            self.executions += 1
+        else:
+            self.coalesced += 1
+            logger.info("🔗 Повторный вызов объединён с уже выполняющимся: %s", key[:2])
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # Ушёл последний ожидающий — результат больше никому не нужен
+                self.abandoned += 1
+                self._forget(key, flight)
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _forget(self, key: tuple, flight: _Flight):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self._inflight),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
+
+
+agent_flights = SingleFlight()
@@ -2,64 +2,187 @@ from fastapi import APIRouter, Form, Depends
 from fastapi.responses import JSONResponse
 from core.auth import get_current_user
 from utils import call_agent_with_context, save_memory
-from core.mcp import load_context, save_context, merge_contexts
-from utils import load_meta
+from core.mcp import context_store, update_context, merge_contexts, apply_changes
+from core.meta_store import meta_store
+from core.fanout import fan_out
 from pathlib import Path
-import asyncio, json, logging
+import os, re, json, logging
 
 logger = logging.getLogger("team_think")
 router = APIRouter()
 
+# === Настройки ===
+TEAMTHINK_MAX_ROUNDS = int(os.getenv("TEAMTHINK_MAX_ROUNDS", "5"))
+TEAMTHINK_CONVERGENCE = float(os.getenv("TEAMTHINK_CONVERGENCE", "0.8"))
+TEAMTHINK_SELF_RECAP_CHARS = int(os.getenv("TEAMTHINK_SELF_RECAP_CHARS", "500"))
+
+# Служебные ключи контекста, которые коллегам не передаются
+_PRIVATE_KEYS = {"teamthink_topic", "teamthink_result", "teamthink_rounds",
+                 "colleague_contexts", "last_task", "last_result"}
+
+
+def _shared_context(ctx: dict) -> dict:
+    return {k: v for k, v in ctx.items() if not k.startswith("_") and k not in _PRIVATE_KEYS}
+
+
+def _context_delta(before: dict, after: dict) -> dict:
+    """Ключи, которые появились или изменились с прошлого снимка."""
+    return {k: v for k, v in after.items() if before.get(k) != v}
+
+
+def _similarity(a: str, b: str) -> float:
+    """Похожесть двух реплик (Jaccard по словам) — признак того, что агенту больше нечего добавить."""
+    ta, tb = set(re.findall(r"\w+", a.lower())), set(re.findall(r"\w+", b.lower()))
+    if not ta and not tb:
+        return 1.0
+    return len(ta & tb) / len(ta | tb)
+
+
+def _recap(text: str) -> str:
+    text = (text or "").strip()
+    if len(text) <= TEAMTHINK_SELF_RECAP_CHARS:
+        return text
+    return text[:TEAMTHINK_SELF_RECAP_CHARS].rstrip() + "…"
+
+
 @router.post("/team_think")
 async def team_think(
     folder: str = Form(...),
     topic: str = Form(...),
+    rounds: int = Form(1),
     user: str = Depends(get_current_user)
 ):
     """
     🤝 Командный режим "Коллективное мышление" (TeamThink)
-    Агентам передаётся общий контекст и тема для обсуждения.
+    Агентам передаётся контекст коллег и тема для обсуждения.
+    При rounds > 1 обсуждение идёт в несколько раундов: в каждом следующем агент
+    получает только новое — реплики коллег из прошлого раунда и изменившиеся
+    ключи их контекста, а не всю историю. Обсуждение завершается досрочно,
+    когда реплики агентов перестают меняться (TEAMTHINK_CONVERGENCE).
     """
-    meta = load_meta()
-    agents_in_folder = [
-        a for a in meta
-        if a.get("folder") == folder
-        and not a.get("is_folder")
-        and a.get("owner") == user
-    ]
+    agents_in_folder = meta_store.find(owner=user, folder=folder, is_folder=False)
     if not agents_in_folder:
         return JSONResponse({"ok": False, "error": f"Нет сотрудников в каталоге '{folder}'"}, status_code=404)
 
-    # 🧠 Собираем общий контекст всех агентов
-    all_contexts = {a["slug"]: load_context(a["slug"]) for a in agents_in_folder}
-    merged_context = merge_contexts(*all_contexts.values())
-    context_text = json.dumps(merged_context, ensure_ascii=False, indent=2)
+    rounds = max(1, min(rounds, TEAMTHINK_MAX_ROUNDS))
+    slugs = [a["slug"] for a in agents_in_folder]
 
-    results = []
+    # 🧠 Контексты коллег (свой контекст агент получает сам через call_agent_with_context).
+    # Между раундами подтягиваются только изменения после запомненной версии.
+    versions, contexts = {}, {}
+    for a in agents_in_folder:
+        versions[a["slug"]], contexts[a["slug"]] = context_store.load_versioned(a)
+    shared = {slug: _shared_context(ctx) for slug, ctx in contexts.items()}
+    seen = {slug: {} for slug in slugs}           # что агент уже видел из контекстов коллег
+    latest: dict[str, str] = {}                   # последняя удачная реплика каждого агента
+    discussion = []
+    round_log = []
+    converged = False
+    prev_round: dict[str, str] = {}
 
-    async def handle(agent):
-        slug = agent["slug"]
-        try:
-            prompt = (
-                f"💬 Тема для коллективного размышления:\n{topic}\n\n"
-                f"📘 Контексты коллег:\n{context_text}\n\n"
-                f"Ты — {slug}. Подумай вслух и предложи свой вклад. "
-                f"Ответь с учётом своей роли и предыдущего опыта команды."
+    for rnd in range(1, rounds + 1):
+        if rnd > 1:
+            for a in agents_in_folder:
+                slug = a["slug"]
+                changes = context_store.changes_since(a, versions[slug])
+                if changes["version"] != versions[slug]:
+                    contexts[slug] = apply_changes(contexts[slug], changes)
+                    versions[slug] = changes["version"]
+                    shared[slug] = _shared_context(contexts[slug])
+        prompts: dict[str, str] = {}
+        tokens: dict[str, int] = {}
+
+        def build_prompt(slug: str) -> str:
+            colleagues = merge_contexts(*(shared[s] for s in slugs if s != slug))
+            delta = _context_delta(seen[slug], colleagues)
+            seen[slug] = colleagues
+            if rnd == 1:
+                return (
+                    f"💬 Тема для коллективного размышления:\n{topic}\n\n"
+                    f"📘 Контексты коллег:\n{json.dumps(delta, ensure_ascii=False, indent=2)}\n\n"
+                    f"Ты — {slug}. Подумай вслух и предложи свой вклад. "
+                    f"Ответь с учётом своей роли и предыдущего опыта команды."
+                )
+            replies = "\n\n".join(f"— {s}: {text}" for s, text in prev_round.items() if s != slug)
+            parts = [
+                f"💬 Тема для коллективного размышления:\n{topic}\n",
+                f"🔁 Раунд {rnd}. Твоя прошлая реплика (кратко):\n{_recap(latest.get(slug, ''))}\n",
+                f"🗣 Новые реплики коллег:\n{replies or '(нет новых реплик)'}\n",
+            ]
+            if delta:
+                parts.append(f"📘 Изменения в контекстах коллег:\n{json.dumps(delta, ensure_ascii=False, indent=2)}\n")
+            parts.append(
+                f"Ты — {slug}. Дополни или скорректируй свою позицию с учётом нового. "
+                f"Не повторяй уже сказанное."
             )
-            res = await call_agent_with_context(agent, prompt)
-            result_text = res.get("result") if isinstance(res, dict) else str(res)
-
-            save_memory(Path(agent["path"]), {"task": f"TeamThink: {topic}", "result": result_text})
-            ctx = load_context(slug)
-            ctx["teamthink_topic"] = topic
-            ctx["teamthink_result"] = result_text
-            ctx["colleague_contexts"] = list(all_contexts.keys())
-            save_context(slug, ctx)
-
-            results.append({"agent": slug, "result": result_text})
-        except Exception as e:
-            logger.exception(f"[team_think] Ошибка у агента {slug}: {e}")
-            results.append({"agent": slug, "error": str(e)})
-
-    await asyncio.gather(*[handle(a) for a in agents_in_folder])
-    return JSONResponse({"ok": True, "folder": folder, "topic": topic, "results": results})
+            return "\n".join(parts)
+
+        async def handle(agent):
+            slug = agent["slug"]
+            prompts[slug] = build_prompt(slug)
+            res = await call_agent_with_context(agent, prompts[slug], include_context=(rnd == 1))
+            if isinstance(res, dict) and not res.get("ok", True):
+                raise RuntimeError(res.get("error") or "Агент вернул ошибку")
+            if isinstance(res, dict):
+                tokens[slug] = res.get("prompt_tokens", 0)
+            return res.get("result") if isinstance(res, dict) else str(res)
+
+        run = await fan_out(agents_in_folder, handle)
+
+        current = {r["agent"]: r["result"] for r in run["results"] if r["status"] == "ok"}
+        similarities = [_similarity(latest[s], text) for s, text in current.items() if s in latest]
+        similarity = round(min(similarities), 3) if similarities else None
+
+        for slug, text in current.items():
+            discussion.append({"agent": slug, "round": rnd, "response": text})
+        latest.update(current)
+        prev_round = current
+
+        round_log.append({
+            "round": rnd,
+            **run,
+            "prompt_chars": sum(len(p) for p in prompts.values()),
+            "prompt_tokens": sum(tokens.values()),
+            "similarity": similarity,
+        })
+        logger.info(
+            f"[TeamThink] {folder}: раунд {rnd}, промпты {round_log[-1]['prompt_chars']} символов, "
+            f"похожесть {similarity}"
+        )
+
+        if not current:
+            break
+        if similarity is not None and similarity >= TEAMTHINK_CONVERGENCE and len(similarities) == len(current):
+            converged = True
+            break
+
+    # 💾 Память и контекст сохраняем один раз — по итогу обсуждения
+    for agent in agents_in_folder:
+        slug = agent["slug"]
+        if slug not in latest:
+            continue
+        save_memory(Path(agent["path"]), {"task": f"TeamThink: {topic}", "result": latest[slug]},
+                    owner=user, slug=slug)
+        update_context(agent, {
+            "teamthink_topic": topic,
+            "teamthink_result": latest[slug],
+            "teamthink_rounds": len(round_log),
+            "colleague_contexts": [s for s in slugs if s != slug],
+        })
+
+    results = [
+        {"agent": slug, "status": "ok", "result": latest[slug]} if slug in latest
+        else {"agent": slug, "status": "error", "error": "Агент не ответил ни в одном раунде"}
+        for slug in slugs
+    ]
+    return JSONResponse({
+        "ok": True,
+        "folder": folder,
+        "topic": topic,
+        "rounds": round_log,
+        "converged": converged,
+        "discussion": discussion,
+        "results": results,
+        "partial": any(r["status"] != "ok" for r in results),
+        "elapsed_ms": sum(r["elapsed_ms"] for r in round_log),
+    })
@@ -0,0 +1,185 @@
+"""
+Подсчёт токенов (tiktoken) и распределение бюджета промпта.
+
+Бюджет на промпт зависит от модели агента. Он делится между частями промпта
+по приоритету: роль (PROMPT из bot.py) → задача → контекст команды → память.
+Роль и задача не обрезаются, пока помещаются в бюджет; контекст и память
+получают остаток (не больше своей доли) и обрезаются по токенам, а не по символам.
+Если BPE-словари tiktoken недоступны (нет сети/кэша), считаем приближённо по байтам.
+
+Боты, созданные до бюджета токенов, сами режут вход до последних N символов
+и сами ставят PROMPT в начало запроса — для них allocate() получает ещё и лимит
+в символах (char_limit) и делит его без роли: задача → контекст → память.
+Задача не обрезается короче PROMPT_LEGACY_MIN_TASK_CHARS, даже если длинный
+PROMPT бота не оставляет места.
+"""
+import os
+import math
+import logging
+import threading
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+PROMPT_RESPONSE_RESERVE = int(os.getenv("PROMPT_RESPONSE_RESERVE", "1024"))
+PROMPT_CONTEXT_SHARE = float(os.getenv("PROMPT_CONTEXT_SHARE", "0.5"))
+PROMPT_MEMORY_SHARE = float(os.getenv("PROMPT_MEMORY_SHARE", "0.2"))
+PROMPT_LEGACY_MIN_TASK_CHARS = int(os.getenv("PROMPT_LEGACY_MIN_TASK_CHARS", "1000"))
+
+# Окно контекста моделей Amvera (токены)
+MODEL_CONTEXT_TOKENS = {
+    "llama8b": 8192,
+    "llama70b": 8192,
+    "gpt-4.1": 128000,
+    "gpt-5": 128000,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+
+_MODEL_ENCODINGS = {"gpt-4.1": "o200k_base", "gpt-5": "o200k_base"}
+_DEFAULT_ENCODING = "cl100k_base"
+
+_encodings: dict[str, object] = {}
+_lock = threading.Lock()
+
+TRUNCATION_MARK = "…"
+
+
+def _encoding(model: str):
+    """Кодировка tiktoken для модели или None, если словарь не загрузить."""
+    name = _MODEL_ENCODINGS.get(model, _DEFAULT_ENCODING)
+    with _lock:
+        if name not in _encodings:
+            try:
+                import tiktoken
+                _encodings[name] = tiktoken.get_encoding(name)
+            except Exception as e:
+                logger.warning(f"tiktoken: кодировка {name} недоступна ({e}), считаю токены приближённо")
+                _encodings[name] = None
+        return _encodings[name]
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    if not text:
+        return 0
+    enc = _encoding(model)
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    # ≈ 4 байта UTF-8 на токен: для кириллицы точнее, чем 4 символа
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
+
+def truncate_tokens(text: str, limit: int, model: str = "", keep: str = "head") -> str:
+    """Обрезает текст до limit токенов; keep="head" — оставляет начало, "tail" — конец."""
+    if limit <= 0 or not text:
+        return ""
+    enc = _encoding(model)
+    if enc is not None:
+        ids = enc.encode(text, disallowed_special=())
+        if len(ids) <= limit:
+            return text
+        ids = ids[:limit] if keep == "head" else ids[-limit:]
+        cut = enc.decode(ids)
+    else:
+        if count_tokens(text) <= limit:
+            return text
+        chars = max(1, int(len(text) * limit / count_tokens(text)))
+        cut = text[:chars] if keep == "head" else text[-chars:]
+    return cut + TRUNCATION_MARK if keep == "head" else TRUNCATION_MARK + cut
+
+
+def truncate_chars(text: str, limit: int, keep: str = "head") -> str:
+    """Обрезает текст до limit символов (вместе с отметкой обрезки)."""
+    if len(text) <= limit:
+        return text
+    if limit <= len(TRUNCATION_MARK):
+        return ""
+    n = limit - len(TRUNCATION_MARK)
+    return text[:n] + TRUNCATION_MARK if keep == "head" else TRUNCATION_MARK + text[-n:]
+
+
+def budget_for(model: str) -> int:
+    """Сколько токенов можно отдать под промпт для модели (с запасом на ответ)."""
+    window = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    return max(256, min(PROMPT_TOKEN_BUDGET, window - PROMPT_RESPONSE_RESERVE))
+
+
+def allocate(sections: dict[str, str], model: str = "", overhead: int = 0,
+             char_limit: int | None = None) -> tuple[dict[str, str], dict]:
+    """
+    Распределяет бюджет модели между частями промпта.
+    sections: {"role", "task", "context", "memory"} (отсутствующие части — пустые строки);
+    overhead — токены обвязки (заголовки, подписи), которые точно уйдут в промпт;
+    char_limit — сколько символов (без обвязки) бот примет, не обрезая вход сам;
+    задача получает из него не меньше PROMPT_LEGACY_MIN_TASK_CHARS.
+    Возвращает (обрезанные части, отчёт {"budget", "sections": {имя: токены}, "truncated": [...]}).
+    """
+    budget = budget_for(model)
+    remaining = budget - overhead
+    chars_left = char_limit
+    out, used, truncated = {}, {}, []
+
+    plan = [
+        ("role", None, "head"),
+        ("task", None, "head"),
+        ("context", PROMPT_CONTEXT_SHARE, "tail"),
+        ("memory", PROMPT_MEMORY_SHARE, "head"),
+    ]
+    for name, share, keep in plan:
+        text = sections.get(name) or ""
+        tokens = count_tokens(text, model)
+        limit = max(0, remaining)
+        if share is not None:
+            limit = min(limit, int(budget * share))
+        if tokens > limit:
+            text = truncate_tokens(text, limit, model, keep=keep)
+            tokens = count_tokens(text, model)
+            truncated.append(name)
+            level = logging.WARNING if name in ("role", "task") else logging.INFO
+            logger.log(level, f"[tokens] '{name}' обрезан до {limit} токенов (бюджет {budget}, модель {model or '?'})")
+        if chars_left is not None:
+            char_cap = max(chars_left, PROMPT_LEGACY_MIN_TASK_CHARS) if name == "task" else max(0, chars_left)
+            if len(text) > char_cap:
+                text = truncate_chars(text, char_cap, keep=keep)
+                tokens = count_tokens(text, model)
+                if name not in truncated:
+                    truncated.append(name)
+                level = logging.WARNING if name in ("role", "task") else logging.INFO
+                logger.log(level, f"[tokens] '{name}' обрезан до {char_cap} символов (лимит бота {char_limit})")
+            chars_left -= len(text)
+        out[name] = text
+        used[name] = tokens
+        remaining -= tokens
+
+    report = {"budget": budget, "sections": used, "truncated": truncated}
+    if char_limit is not None:
+        report["char_limit"] = char_limit
+    return out, report
+
+
+class TokenUsage:
+    """Сколько токенов промптов реально отправлено агентам (для /api/metrics)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.tokens_sent = 0
+        self.truncated_calls = 0
+
+    def record(self, tokens: int, truncated: bool = False):
+        with self._lock:
+            self.calls += 1
+            self.tokens_sent += tokens
+            self.truncated_calls += int(truncated)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "tokens_sent": self.tokens_sent,
+            "avg_tokens": round(self.tokens_sent / self.calls, 1) if self.calls else 0.0,
+            "truncated_calls": self.truncated_calls,
+            "tiktoken": {name: enc is not None for name, enc in _encodings.items()},
+        }
+
+
+token_usage = TokenUsage()
@@ -0,0 +1,113 @@
+"""
+Пользователи менеджера: таблица users в той же SQLite-базе, что и метаданные
+агентов (core/meta_store.py).
+
+Раньше каждый /login и /register читал и разбирал data/users.json целиком,
+а регистрация переписывала файл без блокировки — одновременные регистрации
+теряли пользователей. Теперь имя пользователя — первичный ключ таблицы:
+вставка атомарна и дубликат отсекает сама база. Поверх таблицы — индекс
+в памяти процесса (имя → запись): вход не ходит в базу для уже известных
+пользователей, а промах (пользователь, зарегистрированный другим воркером)
+дочитывает одну строку по ключу. Пароли пока только создаются, не меняются,
+поэтому закэшированная запись не устаревает.
+При первом запуске пользователи из data/users.json переносятся в базу
+(один раз, файл остаётся как резервная копия).
+"""
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+from core.meta_store import meta_store
+
+logger = logging.getLogger("manager")
+
+BASE = Path(__file__).resolve().parent.parent
+USERS_JSON_PATH = BASE / "data" / "users.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username   TEXT PRIMARY KEY,
+    password   TEXT NOT NULL,
+    created_at TEXT
+);
+"""
+
+
+class UserExists(Exception):
+    pass
+
+
+class UserStore:
+    def __init__(self, json_path: Path = USERS_JSON_PATH):
+        self.json_path = Path(json_path)
+        self._index: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._ready = False
+        self.hits = 0
+        self.misses = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = meta_store.connection()
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    conn.executescript(_SCHEMA)
+                    self._migrate_json(conn)
+                    self._ready = True
+        return conn
+
+    def _migrate_json(self, conn: sqlite3.Connection):
+        """Однократный перенос пользователей из data/users.json."""
+        done = conn.execute("SELECT value FROM settings WHERE key = 'migrated_users'").fetchone()
+        if done or not self.json_path.exists():
+            return
+        try:
+            users = json.loads(self.json_path.read_text(encoding="utf-8") or "[]")
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.json_path.name} для переноса: {e}")
+            users = []
+        rows = [(u["username"], u["password"], u.get("created_at"))
+                for u in users if isinstance(u, dict) and u.get("username") and u.get("password")]
+        with meta_store.transaction() as tx:
+            tx.executemany("INSERT OR IGNORE INTO users (username, password, created_at) VALUES (?, ?, ?)", rows)
+            tx.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('migrated_users', ?)", (str(len(rows)),))
+        logger.info(f"📦 Пользователи перенесены из {self.json_path.name} в базу: {len(rows)}")
+
+    def get(self, username: str) -> dict | None:
+        user = self._index.get(username)
+        if user is not None:
+            self.hits += 1
+            return user
+        self.misses += 1
+        row = self._conn().execute(
+            "SELECT username, password, created_at FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        if row is None:
+            return None
+        user = {"username": row[0], "password": row[1], "created_at": row[2]}
+        with self._lock:
+            self._index[username] = user
+        return user
+
+    def create(self, username: str, password_hash: str) -> dict:
+        """Добавляет пользователя; UserExists — если имя занято (в том числе другим воркером)."""
+        user = {"username": username, "password": password_hash,
+                "created_at": datetime.utcnow().isoformat() + "Z"}
+        self._conn()  # схема — до транзакции: executescript завершает открытую транзакцию
+        try:
+            with meta_store.transaction() as conn:
+                conn.execute("INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)",
+                             (user["username"], user["password"], user["created_at"]))
+        except sqlite3.IntegrityError:
+            raise UserExists(username)
+        with self._lock:
+            self._index[username] = user
+        return user
+
+    def stats(self) -> dict:
+        return {"cached": len(self._index), "hits": self.hits, "misses": self.misses}
+
+
+user_store = UserStore()
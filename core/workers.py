@@ -0,0 +1,444 @@
+"""
+Пул процессов для изолированного выполнения агентов.
+
+Пользовательские bot.py исполняются не в процессе менеджера, а в заранее
+запущенных воркерах. Воркер держит модули агентов «тёплыми» (через
+core.loader), принимает задачи по Pipe и отвечает результатом. На каждую
+задачу действует жёсткий таймаут: зависший или упавший воркер убивается
+и заменяется новым. После AGENT_WORKER_MAX_TASKS задач (или при превышении
+AGENT_WORKER_MAX_RSS_MB) воркер перезапускается, чтобы утечки памяти
+в ботах не копились.
+
+Свободный воркер ожидается асинхронно (очередь ожидающих future), поэтому
+ожидание не занимает поток agent_executor. Отмена задачи только посылает
+процессу SIGTERM — убивает и заменяет воркер поток исполнителя, который
+обслуживал задачу, а не event loop.
+
+Режим включается AGENT_ISOLATION=process (по умолчанию); AGENT_ISOLATION=thread
+возвращает выполнение в пул потоков менеджера.
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from pathlib import Path
+
+from core.executor import agent_executor
+
+logger = logging.getLogger("manager")
+
+# === Настройки ===
+AGENT_ISOLATION = os.getenv("AGENT_ISOLATION", "process").lower()
+AGENT_WORKERS = int(os.getenv("AGENT_WORKERS", "4"))
+AGENT_TASK_TIMEOUT = float(os.getenv("AGENT_TASK_TIMEOUT", "120"))
+AGENT_WORKER_MAX_TASKS = int(os.getenv("AGENT_WORKER_MAX_TASKS", "200"))
+AGENT_WORKER_MAX_RSS_MB = float(os.getenv("AGENT_WORKER_MAX_RSS_MB", "0"))  # 0 — без лимита
+AGENT_WORKER_START_METHOD = os.getenv("AGENT_WORKER_START_METHOD", "spawn")
+
+BASE = Path(__file__).resolve().parent.parent
+
+
+class AgentTimeout(TimeoutError):
+    pass
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+# === Код воркера (выполняется в дочернем процессе) ===
+def _rss_mb() -> float:
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux отдаёт КБ, macOS — байты
+        return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+    except Exception:
+        return 0.0
+
+
+async def _stream_chunks(conn, task_id, mod, task: str) -> str:
+    parts = []
+    async for chunk in mod.handle_task_stream(task):
+        if chunk:
+            parts.append(chunk)
+            conn.send(("chunk", task_id, chunk, 0.0))
+    return "".join(parts)
+
+
+def _worker_main(conn, base_dir: str):
+    """
+    Цикл воркера: получает (task_id, path, task, stream), отвечает (status, task_id, payload, rss).
+    В потоковом режиме перед финальным ответом шлёт ("chunk", task_id, text, 0.0).
+    """
+    if hasattr(signal, "SIGINT"):
+        # Ctrl+C получает менеджер, он сам остановит воркеры
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if base_dir not in sys.path:
+        sys.path.insert(0, base_dir)
+    from core.loader import load_agent_module
+
+    # Один event loop на всё время жизни воркера: async-клиенты LLM привязаны к loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg is None:
+            break
+        task_id, path, task, stream = msg
+        try:
+            mod = load_agent_module(Path(path))
+            if stream and hasattr(mod, "handle_task_stream"):
+                reply = ("ok", task_id, loop.run_until_complete(_stream_chunks(conn, task_id, mod, task)))
+            elif hasattr(mod, "handle_task_async"):
+                reply = ("ok", task_id, loop.run_until_complete(mod.handle_task_async(task)))
+            elif hasattr(mod, "handle_task"):
+                reply = ("ok", task_id, mod.handle_task(task))
+            else:
+                raise AttributeError(f"Функция handle_task не найдена в {Path(path).name}")
+        except Exception as e:
+            reply = ("error", task_id, f"{type(e).__name__}: {e}")
+        try:
+            conn.send(reply + (_rss_mb(),))
+        except Exception:
+            # Результат не сериализуется — отдаём строковое представление
+            conn.send((reply[0], task_id, str(reply[2]), _rss_mb()))
+    loop.close()
+    conn.close()
+
+
+# === Сторона менеджера ===
+class _Worker:
+    _ids = itertools.count(1)
+
+    def __init__(self, ctx):
+        self.id = next(self._ids)
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child_conn, str(BASE)),
+            name=f"agent-worker-{self.id}", daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+        self.rss_mb = 0.0
+        self.warm: set[str] = set()
+
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def stop(self, timeout: float = 2.0):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def terminate(self):
+        """SIGTERM без ожидания: процесс доберёт kill() в потоке исполнителя."""
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join(1)
+
+
+class _Ticket:
+    """
+    Связывает асинхронный вызов с воркером, чтобы его можно было отменить.
+    state: pending → running (_call начал работу) или abandoned (отменён раньше).
+    """
+    __slots__ = ("worker", "cancelled", "state", "_lock")
+
+    def __init__(self):
+        self.worker: _Worker | None = None
+        self.cancelled = False
+        self.state = "pending"
+        self._lock = threading.Lock()
+
+    def _move(self, state: str) -> bool:
+        with self._lock:
+            if self.state != "pending":
+                return False
+            self.state = state
+            return True
+
+    def start(self) -> bool:
+        return self._move("running")
+
+    def abandon(self) -> bool:
+        return self._move("abandoned")
+
+
+def _deliver(pool: "WorkerPool", fut: asyncio.Future, worker: _Worker):
+    """Передаёт воркер ожидающему (в его event loop); ушедший ожидающий — следующему."""
+    if fut.done():
+        pool._hand_over(worker)
+    else:
+        fut.set_result(worker)
+
+
+def _fail(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_exception(RuntimeError("Пул агентов остановлен"))
+
+
+class WorkerPool:
+    """Постоянный пул процессов-воркеров с таймаутами, отменой и рециклингом."""
+
+    def __init__(self, size: int = AGENT_WORKERS, timeout: float = AGENT_TASK_TIMEOUT,
+                 max_tasks: int = AGENT_WORKER_MAX_TASKS, max_rss_mb: float = AGENT_WORKER_MAX_RSS_MB):
+        self.size = size
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        self._ctx = multiprocessing.get_context(AGENT_WORKER_START_METHOD)
+        self._idle: list[_Worker] = []
+        self._waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._lock = threading.Lock()
+        self._started = False
+        self._task_ids = itertools.count(1)
+        self.busy = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.cancelled = 0
+        self.recycled = 0
+
+    @property
+    def enabled(self) -> bool:
+        return AGENT_ISOLATION == "process" and self.size > 0
+
+    def start(self):
+        """Предзапускает воркеры (блокирующий вызов — spawn занимает время)."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        workers = [_Worker(self._ctx) for _ in range(self.size)]
+        for w in workers:
+            with self._lock:
+                self.busy += 1
+            self._hand_over(w)
+        logger.info("🧩 Запущен пул агентов: %s процессов", self.size)
+
+    def stop(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+            waiters, self._waiters = list(self._waiters), deque()
+            self._started = False
+        for loop, fut in waiters:
+            try:
+                loop.call_soon_threadsafe(_fail, fut)
+            except RuntimeError:
+                pass
+        for w in workers:
+            w.stop()
+
+    # === Свободные воркеры ===
+    async def _acquire(self, path: str) -> _Worker:
+        """Ждёт свободный воркер, не занимая поток."""
+        if not self._started:
+            await asyncio.to_thread(self.start)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._idle:
+                # Предпочитаем воркер, у которого модуль агента уже «прогрет»
+                worker = next((w for w in self._idle if path in w.warm), self._idle[0])
+                self._idle.remove(worker)
+                self.busy += 1
+                return worker
+            fut = loop.create_future()
+            self._waiters.append((loop, fut))
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, fut))
+                except ValueError:
+                    pass  # воркер уже в пути — _deliver передаст его дальше
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self._hand_over(fut.result())
+            raise
+
+    def _hand_over(self, worker: _Worker):
+        """Отдаёт воркер первому ожидающему или в список свободных (из любого потока)."""
+        with self._lock:
+            if self._started:
+                while self._waiters:
+                    loop, fut = self._waiters.popleft()
+                    try:
+                        loop.call_soon_threadsafe(_deliver, self, fut, worker)
+                        return
+                    except RuntimeError:
+                        continue  # event loop ожидающего закрыт
+                self.busy -= 1
+                self._idle.append(worker)
+                return
+            self.busy -= 1
+        # Пул остановлен — без join, вызов может прийти из event loop
+        worker.terminate()
+        worker.conn.close()
+
+    def _release(self, worker: _Worker, healthy: bool):
+        """Возвращает воркер после задачи (в потоке исполнителя: kill/spawn блокируют)."""
+        if not healthy:
+            worker.kill()
+            worker.conn.close()
+            worker = _Worker(self._ctx)
+        elif worker.tasks >= self.max_tasks or (self.max_rss_mb and worker.rss_mb > self.max_rss_mb):
+            logger.info("♻️ Воркер %s перезапущен (задач: %s, RSS: %.0f МБ)", worker.id, worker.tasks, worker.rss_mb)
+            self.recycled += 1
+            worker.stop()
+            worker = _Worker(self._ctx)
+        self._hand_over(worker)
+
+    # === Выполнение ===
+    def _call(self, ticket: _Ticket, path: str, task: str, timeout: float, on_chunk=None):
+        """
+        Блокирующая отправка задачи воркеру ticket.worker (выполняется в потоке agent_executor).
+        Если передан on_chunk — задача потоковая, фрагменты отдаются в него по мере прихода.
+        """
+        if not ticket.start():
+            raise asyncio.CancelledError()  # отменён до начала — воркер уже возвращён в пул
+        worker = ticket.worker
+        healthy = False
+        try:
+            if ticket.cancelled:
+                raise asyncio.CancelledError()  # cancel() уже послал воркеру SIGTERM
+            if not worker.alive():
+                self.crashes += 1
+                worker.conn.close()
+                worker = ticket.worker = _Worker(self._ctx)
+            task_id = next(self._task_ids)
+            worker.conn.send((task_id, path, task, on_chunk is not None))
+            deadline = time.monotonic() + timeout
+            while True:
+                if not worker.conn.poll(max(deadline - time.monotonic(), 0)):
+                    self.timeouts += 1
+                    raise AgentTimeout(f"Агент {Path(path).name} не ответил за {timeout:.0f} с")
+                try:
+                    status, _, payload, rss = worker.conn.recv()
+                except (EOFError, OSError):
+                    if ticket.cancelled:
+                        raise asyncio.CancelledError()
+                    self.crashes += 1
+                    raise WorkerCrashed(f"Процесс агента {Path(path).name} аварийно завершился")
+                if status != "chunk":
+                    break
+                on_chunk(payload)
+            healthy = True
+            worker.tasks += 1
+            worker.rss_mb = rss
+            worker.warm.add(path)
+            if status != "ok":
+                raise RuntimeError(payload)
+            self.completed += 1
+            return payload
+        finally:
+            with ticket._lock:
+                ticket.worker = None  # после этого cancel() воркер уже не тронет
+            self._release(worker, healthy)
+
+    def cancel(self, ticket: _Ticket):
+        """
+        Отменяет задачу. Не дошла до воркера — воркер возвращается в пул;
+        уже выполняется — процессу уходит SIGTERM (без ожидания: event loop не блокируется).
+        """
+        ticket.cancelled = True
+        if ticket.abandon():
+            worker, ticket.worker = ticket.worker, None
+            if worker is not None:
+                self._hand_over(worker)
+            return
+        with ticket._lock:
+            if ticket.worker is not None:
+                self.cancelled += 1
+                ticket.worker.terminate()
+
+    async def _execute(self, ticket: _Ticket, path: Path, task: str, owner: str | None,
+                       timeout: float | None, on_chunk=None):
+        # Место в очереди agent_executor → свободный воркер (асинхронно) → поток на время задачи
+        release = await agent_executor.take_slot(owner)
+        try:
+            resolved = str(Path(path).resolve())
+            ticket.worker = await self._acquire(resolved)
+        except BaseException:
+            release(False)
+            raise
+        try:
+            return await agent_executor.submit(
+                release, self._call, ticket, resolved, task, timeout or self.timeout, on_chunk
+            )
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+
+    async def run(self, path: Path, task: str, owner: str | None = None, timeout: float | None = None):
+        """Выполняет handle_task агента в воркере; учитывает лимиты agent_executor."""
+        return await self._execute(_Ticket(), path, task, owner, timeout)
+
+    async def stream(self, path: Path, task: str, owner: str | None = None, timeout: float | None = None):
+        """Потоковый вариант run: асинхронно отдаёт фрагменты ответа агента."""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+        streamed = False
+
+        def on_chunk(text):
+            loop.call_soon_threadsafe(queue.put_nowait, text)
+
+        fut = asyncio.ensure_future(self._execute(_Ticket(), path, task, owner, timeout, on_chunk))
+        fut.add_done_callback(lambda _: queue.put_nowait(done))
+        try:
+            while (item := await queue.get()) is not done:
+                streamed = True
+                yield item
+            result = fut.result()
+            if not streamed:
+                # У агента нет handle_task_stream — ответ пришёл целиком
+                yield result
+        finally:
+            if not fut.done():
+                fut.cancel()  # _execute отменит задачу у воркера
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = len(self._idle)
+            waiting = len(self._waiters)
+        return {
+            "enabled": self.enabled,
+            "workers": self.size,
+            "idle": idle,
+            "waiting": waiting,
+            "busy": self.busy,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "crashes": self.crashes,
+            "cancelled": self.cancelled,
+            "recycled": self.recycled,
+            "max_tasks_per_worker": self.max_tasks,
+            "task_timeout": self.timeout,
+        }
+
+
+worker_pool = WorkerPool()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import sys
 from logging.handlers import RotatingFileHandler
@@ -8,7 +9,11 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from dotenv import load_dotenv
 
-from core import agents, brainstorm, checklist, office, demo, context, team_think, auth
+from core import agents, brainstorm, checklist, office, demo, context, team_think, auth, metrics, results
+from core.workers import worker_pool
+from core.http import close_http_client
+from core.mcp import migrate_flat_contexts
+from core.compaction import context_compactor
 
 
 
@@ -61,6 +66,8 @@ app.include_router(checklist.router)
 app.include_router(office.router)
 app.include_router(context.router)
 app.include_router(team_think.router)
+app.include_router(metrics.router)
+app.include_router(results.router)
 
 
 
@@ -71,9 +78,24 @@ async def startup_event():
     demo._seed_demo_if_empty(AGENTS_DIR)
     demo.ensure_assistant_llm(AGENTS_DIR, BASE)
     demo.ensure_demo_agents_llm(AGENTS_DIR, BASE)
+    results.migrate_last_tasks()
+    migrate_flat_contexts()
+    context_compactor.start()
+    if worker_pool.enabled:
+        await asyncio.get_running_loop().run_in_executor(None, worker_pool.start)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await context_compactor.stop()
+    worker_pool.stop()
+    await close_http_client()
 
 if __name__ == "__main__":
     import uvicorn, os
     port = int(os.getenv("PORT", 8000))
     logger.info("Запуск менеджера на порту %s", port)
-    uvicorn.run("main:app", host="0.0.0.0", port=port)
+    # За обратным прокси: X-Forwarded-For принимается только от адресов из FORWARDED_ALLOW_IPS
+    # (лимит входов по IP в core/passwords.py должен видеть адрес клиента, а не прокси)
+    uvicorn.run("main:app", host="0.0.0.0", port=port, proxy_headers=True,
+                forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"))
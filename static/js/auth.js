@@ -1,3 +1,104 @@
+// ======================================================
+// 🔄 Обновление access-токена по refresh-токену
+// ======================================================
+// Access-токен живёт недолго (ACCESS_TOKEN_EXPIRE_MINUTES), поэтому:
+//  - за минуту до истечения он обновляется сам (/token/refresh, с ротацией refresh-токена);
+//  - если запрос всё же получил 401, токен обновляется и запрос повторяется один раз.
+// Вкладки делят localStorage: обновляет одна (Web Locks), остальные подхватывают
+// новые токены по событию storage и не предъявляют уже использованный refresh-токен.
+let refreshInFlight = null;
+let refreshTimer = null;
+
+function tokenExpiresAt(token) {
+  try {
+    const payload = JSON.parse(atob(token.split(".")[1].replace(/-/g, "+").replace(/_/g, "/")));
+    return payload.exp ? payload.exp * 1000 : null;
+  } catch {
+    return null;
+  }
+}
+
+function clearTokens() {
+  localStorage.removeItem("token");
+  localStorage.removeItem("refresh_token");
+}
+
+function withRefreshLock(fn) {
+  if (navigator.locks && navigator.locks.request) {
+    return navigator.locks.request("token-refresh", fn);
+  }
+  return fn();
+}
+
+// staleToken — access-токен, который перестал подходить; если в localStorage
+// уже другой, его обновила другая вкладка — повторять обновление не нужно
+async function refreshAccessToken(staleToken = localStorage.getItem("token")) {
+  if (!localStorage.getItem("refresh_token")) return false;
+  // Одновременные 401 ждут одно и то же обновление: повторное предъявление
+  // использованного refresh-токена сервер считает утечкой и отзывает весь вход
+  if (!refreshInFlight) {
+    refreshInFlight = withRefreshLock(async () => {
+      const current = localStorage.getItem("token");
+      if (current && current !== staleToken) {
+        scheduleRefresh();
+        return true;
+      }
+      const refreshToken = localStorage.getItem("refresh_token");
+      if (!refreshToken) return false;
+      try {
+        const form = new FormData();
+        form.append("refresh_token", refreshToken);
+        const res = await nativeFetch("/token/refresh", { method: "POST", body: form });
+        if (!res.ok) return false;
+        const data = await res.json();
+        localStorage.setItem("token", data.access_token);
+        if (data.refresh_token) localStorage.setItem("refresh_token", data.refresh_token);
+        scheduleRefresh();
+        return true;
+      } catch (err) {
+        console.error("Ошибка обновления токена:", err);
+        return false;
+      }
+    }).finally(() => {
+      setTimeout(() => { refreshInFlight = null; }, 0);
+    });
+  }
+  return refreshInFlight;
+}
+
+function scheduleRefresh() {
+  clearTimeout(refreshTimer);
+  const token = localStorage.getItem("token");
+  const expiresAt = token && tokenExpiresAt(token);
+  if (!expiresAt || !localStorage.getItem("refresh_token")) return;
+  const delay = Math.max(5000, expiresAt - Date.now() - 60000);
+  refreshTimer = setTimeout(() => refreshAccessToken(token), delay);
+}
+
+// Другая вкладка обновила токены (или вышла) — перевзводим свой таймер
+window.addEventListener("storage", (e) => {
+  if (e.key === "token" || e.key === "refresh_token" || e.key === null) scheduleRefresh();
+});
+
+const nativeFetch = window.fetch.bind(window);
+
+window.fetch = async (input, init = {}) => {
+  const res = await nativeFetch(input, init);
+  const url = typeof input === "string" ? input : input.url;
+  const sameOrigin = !/^https?:/i.test(url) || url.startsWith(window.location.origin);
+  const headers = new Headers(init.headers || {});
+  if (res.status !== 401 || !sameOrigin || !headers.has("Authorization") || url.includes("/token/refresh")) {
+    return res;
+  }
+  const usedToken = (headers.get("Authorization") || "").replace(/^Bearer\s+/i, "");
+  if (!(await refreshAccessToken(usedToken))) return res;
+  headers.set("Authorization", `Bearer ${localStorage.getItem("token")}`);
+  return nativeFetch(input, { ...init, headers });
+};
+
+scheduleRefresh();
+
+
 // ======================================================
 // 🔐 Автоматическая проверка авторизации при загрузке
 // ======================================================
@@ -16,12 +117,12 @@ document.addEventListener("DOMContentLoaded", async () => {
     });
     if (res.status === 401) {
       // Токен просрочен или невалиден
-      localStorage.removeItem("token");
+      clearTokens();
       window.location.href = "/login";
     }
   } catch (err) {
     console.error("Ошибка проверки авторизации:", err);
-    localStorage.removeItem("token");
+    clearTokens();
     window.location.href = "/login";
   }
 });
@@ -40,7 +141,7 @@ async function requireAuth() {
   });
 
   if (!res.ok) {
-    localStorage.removeItem("token");
+    clearTokens();
     window.location.href = "/login";
     return false;
   }
@@ -73,9 +174,15 @@ window.addEventListener("DOMContentLoaded", async () => {
   }
 });
 
-document.addEventListener("click", (e) => {
+document.addEventListener("click", async (e) => {
   if (e.target.id === "logoutBtn") {
-    localStorage.removeItem("token");
+    try {
+      // Отзываем токен на сервере вместе с refresh-токенами этого входа
+      await nativeFetch("/logout", { method: "POST", headers: authHeaders() });
+    } catch (err) {
+      console.error("Ошибка выхода:", err);
+    }
+    clearTokens();
     window.location.href = "/login";
   }
 });
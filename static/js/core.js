@@ -280,12 +280,10 @@ const assignTask = async (slug) => {
     resultBox.innerHTML = `<div class="spinner"></div> Выполняется...`;
 
     try {
-      const res = await fetch("/assign_task", {
-        method: "POST",
-        body: new URLSearchParams({ slug, task }),
-        headers: { ...authHeaders(), Accept: "application/json" }
+      // 🌊 Ответ приходит по мере генерации
+      const data = await streamAssignTask(slug, task, html => {
+        resultBox.innerHTML = html || `<div class="spinner"></div> Выполняется...`;
       });
-      const data = await res.json();
 
       if (!data.ok) throw new Error(data.error || "Ошибка выполнения");
 
@@ -736,6 +734,53 @@ document.addEventListener("DOMContentLoaded", () => {
 // 🌍 Глобальные экспорты (для office.js и других модулей)
 // ========================================================================
 
+// === 🌊 Потоковое выполнение задачи агентом (/assign_task_stream, NDJSON) ===
+// onProgress(html) вызывается на каждом фрагменте: готовые Markdown-блоки + ещё не размеченный хвост.
+window.streamAssignTask = async function streamAssignTask(slug, task, onProgress) {
+  const res = await fetch("/assign_task_stream", {
+    method: "POST",
+    headers: { ...authHeaders(), Accept: "application/x-ndjson" },
+    body: new URLSearchParams({ slug, task }),
+  });
+  if (!res.ok || !res.body) {
+    const text = await res.text();
+    throw new Error(`${res.status}: ${text.slice(0, 100)}`);
+  }
+
+  const escapeHtml = s => s.replace(/[&<>]/g, c => ({ "&": "&amp;", "<": "&lt;", ">": "&gt;" }[c]));
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "", html = "", pending = "", final = null;
+
+  const handleEvent = event => {
+    if (event.type === "delta") {
+      pending += event.text;
+    } else if (event.type === "html") {
+      html += event.html;
+      pending = event.pending || "";
+    } else if (event.type === "done") {
+      final = { ok: true, agent: event.agent, result: event.result };
+      return;
+    } else if (event.type === "error") {
+      final = { ok: false, error: event.error };
+      return;
+    }
+    onProgress?.(html + (pending ? `<p class="streaming">${escapeHtml(pending)}</p>` : ""));
+  };
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (value) buffer += decoder.decode(value, { stream: !done });
+    const lines = buffer.split("\n");
+    buffer = lines.pop();
+    lines.filter(l => l.trim()).forEach(l => handleEvent(JSON.parse(l)));
+    if (done) break;
+  }
+  if (buffer.trim()) handleEvent(JSON.parse(buffer));
+
+  return final || { ok: false, error: "Поток ответа прерван" };
+};
+
 // Безопасное обновление списка каталогов
 window.refreshFolderSelect = async function refreshFolderSelect() {
   try {
@@ -783,7 +828,6 @@ window.buildGraphData = function buildGraphData(agents) {
     type: "agent",
     folder: a.folder || "root",
     status: a.status || "done",
-    last_task: a.last_task || null,
   }));
 
   agentNodes.forEach(a => {
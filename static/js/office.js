@@ -541,6 +541,16 @@ function fillSidepanel(node) {
     } else {
       showLink.style.display = "none";
     }
+    // Результаты хранятся отдельно от метаданных — подгружаем последний по запросу
+    if (!node.last_task && !node.lastTaskRequested) {
+      node.lastTaskRequested = true;
+      loadLastResult(node.id).then(lastTask => {
+        if (lastTask && currentNode === node) {
+          node.last_task = lastTask;
+          fillSidepanel(node);
+        }
+      });
+    }
     // lastTask.textContent = `🧩 Последняя задача: ${t}`;
     
     actions.style.display = "flex";
@@ -619,9 +629,11 @@ if (teamThinkBtn) {
       const formData = new FormData();
       formData.append("topic", topic);
       formData.append("folder", currentFolder || "demo");
+      formData.append("rounds", "3");
 
       const res = await fetch("/team_think", {
         method: "POST",
+        headers: { ...authHeaders() },
         body: formData
       });
       const data = await res.json();
@@ -629,7 +641,8 @@ if (teamThinkBtn) {
       // === Этап 1: ответы агентов ===
       if (data.discussion && data.discussion.length) {
         for (const msg of data.discussion) {
-          await appendWithTyping(output, `<p><b>${msg.agent}:</b> ${msg.response}</p>`);
+          const label = msg.round > 1 ? ` <small>(раунд ${msg.round})</small>` : "";
+          await appendWithTyping(output, `<p><b>${msg.agent}${label}:</b> ${msg.response}</p>`);
           scrollToBottom(output);
         }
       }
@@ -665,6 +678,21 @@ if (teamThinkBtn) {
 
 // === Помощники ===
 
+// последний результат агента (/api/agent/{slug}/last_result)
+async function loadLastResult(slug) {
+  try {
+    const res = await fetch(`/api/agent/${encodeURIComponent(slug)}/last_result`, {
+      headers: { ...authHeaders(), Accept: "application/json" }
+    });
+    if (!res.ok) return null;
+    const data = await res.json();
+    return data.last_task || null;
+  } catch (e) {
+    console.warn("Не удалось загрузить последний результат", e);
+    return null;
+  }
+}
+
 // постепенное появление текста
 async function appendWithTyping(container, html) {
   const tmp = document.createElement("div");
@@ -754,14 +782,12 @@ async function assignTaskFromOffice(slug, task) {
       setTimeout(() => Graph.graphData(data), 300);
     }, 400);
 
-    // Отправляем задачу агенту
-    const res = await fetch("/assign_task", {
-      method: "POST",
-      headers: { ...authHeaders(), Accept: "application/json" },
-      body: new URLSearchParams({ slug, task }),
+    // Отправляем задачу агенту — ответ приходит потоком
+    const dataRes = await streamAssignTask(slug, task, html => {
+      if (!resultBox) return;
+      resultBox.innerHTML = html;
+      resultBox.scrollTop = resultBox.scrollHeight;
     });
-    console.log('res',res)
-    const dataRes = await res.json();
     if (!dataRes.ok) throw new Error(dataRes.error || "Ошибка выполнения");
 
     // 🟢 Останавливаем пульсацию и ставим статус "done"
@@ -1,14 +1,22 @@
 import os
+import re
 import json
 import asyncio
 import logging
-import importlib.util
 from pathlib import Path
 from datetime import datetime
-import requests
 from typing import Any, Dict
-from filelock import FileLock
-from core.mcp import load_context, save_context
+from core.mcp import load_context, update_context
+from core.loader import load_agent_module
+from core.executor import agent_executor
+from core.workers import worker_pool
+from core.http import get_http_client
+from core.llm_cache import response_cache, cache_key, cache_enabled_for
+from core.singleflight import agent_flights
+from core.tokens import count_tokens, allocate, token_usage, budget_for, PROMPT_MEMORY_SHARE, PROMPT_LEGACY_MIN_TASK_CHARS
+from core.meta_store import meta_store
+from core.memory import memory_log, memory_index
+from core.retrieval import memory_retriever
 
 logger = logging.getLogger("manager")
 
@@ -16,44 +24,21 @@ logger = logging.getLogger("manager")
 BASE_DIR = Path(__file__).resolve().parent
 AGENTS_DIR = BASE_DIR / "agents"
 AGENTS_DIR.mkdir(parents=True, exist_ok=True)
-META_PATH = AGENTS_DIR / "agents.json"
 
 
 
 
-# === Метаданные (agents.json) ===
+# === Метаданные (SQLite, см. core/meta_store.py) ===
 def load_meta() -> list[dict]:
-    """Безопасно загружает agents.json (если поврежден — восстанавливает)."""
-    logger.info("META_PATH %s", META_PATH)
-    try:
-        if not META_PATH.exists():
-            META_PATH.write_text("[]", encoding="utf-8")
-        return json.loads(META_PATH.read_text(encoding="utf-8"))
-    except json.JSONDecodeError:
-        logger.warning("⚠️ Поврежден agents.json — восстановлен.")
-        META_PATH.write_text("[]", encoding="utf-8")
-        return []
-
+    """Все записи агентов и каталогов. Для выборок по владельцу/каталогу — meta_store.find()."""
+    return meta_store.all()
 
-import time
 
 def save_meta(meta: list[dict]):
-    tmp_path = META_PATH.with_suffix(".tmp")
-    lock = FileLock(str(META_PATH) + ".lock")
-
-    with lock:
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(meta, f, ensure_ascii=False, indent=2)
-
-        import shutil, time
-        for attempt in range(3):
-            try:
-                shutil.move(str(tmp_path), str(META_PATH))
-                logger.debug("✅ agents.json обновлён")
-                break
-            except PermissionError as e:
-                logger.warning(f"⚠️ agents.json занят, попытка {attempt+1}/3: {e}")
-                time.sleep(1)
+    """Полная перезапись метаданных одной транзакцией (для массовых правок).
+    Точечные изменения — meta_store.create/update/delete."""
+    meta_store.replace_all(meta)
+    logger.debug("✅ Метаданные агентов обновлены")
 
 
 
@@ -72,22 +57,28 @@ def ensure_user_root(owner: str) -> Path:
 
 
 # === Вызов агентов ===
-async def call_agent_local(path: Path, task: str) -> Dict[str, Any]:
-    """Вызывает локального агента через его bot.py."""
+async def call_agent_local(path: Path, task: str, owner: str | None = None) -> Dict[str, Any]:
+    """
+    Вызывает локального агента через его bot.py.
+    По умолчанию — в изолированном процессе из worker_pool,
+    при AGENT_ISOLATION=thread — в пуле потоков менеджера.
+    """
     try:
-        bot_file = path / "bot.py"
-        if not bot_file.exists():
-            raise FileNotFoundError(f"bot.py не найден в {path}")
-
-        spec = importlib.util.spec_from_file_location(f"agent_{path.name}", str(bot_file))
-        mod = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(mod)
-
-        if not hasattr(mod, "handle_task"):
-            raise AttributeError(f"Функция handle_task не найдена в {path.name}")
-
-        logger.info(f"🧠 Вызов локального агента: {path.name}")
-        res = mod.handle_task(task)
+        if worker_pool.enabled:
+            if not (path / "bot.py").exists():
+                raise FileNotFoundError(f"bot.py не найден в {path}")
+            logger.info(f"🧠 Вызов локального агента (воркер): {path.name}")
+            res = await worker_pool.run(path, task, owner=owner)
+        else:
+            mod = await agent_executor.run(load_agent_module, path, owner=owner)
+            logger.info(f"🧠 Вызов локального агента: {path.name}")
+            if hasattr(mod, "handle_task_async"):
+                # Асинхронный агент: без отдельного потока на вызов
+                res = await agent_executor.run_async(mod.handle_task_async, task, owner=owner)
+            elif hasattr(mod, "handle_task"):
+                res = await agent_executor.run(mod.handle_task, task, owner=owner)
+            else:
+                raise AttributeError(f"Функция handle_task не найдена в {path.name}")
         return {"ok": True, "source": "local", "result": res}
 
     except Exception as e:
@@ -95,6 +86,35 @@ async def call_agent_local(path: Path, task: str) -> Dict[str, Any]:
         return {"ok": False, "error": str(e)}
 
 
+async def stream_agent_local(path: Path, task: str, owner: str | None = None):
+    """
+    Потоковый вызов локального агента: отдаёт фрагменты текста по мере генерации.
+    Если в bot.py нет handle_task_stream — весь ответ приходит одним фрагментом.
+    Ошибки пробрасываются вызывающему.
+    """
+    if not (path / "bot.py").exists():
+        raise FileNotFoundError(f"bot.py не найден в {path}")
+    logger.info(f"🧠 Потоковый вызов локального агента: {path.name}")
+
+    if worker_pool.enabled:
+        async for chunk in worker_pool.stream(path, task, owner=owner):
+            yield chunk
+        return
+
+    mod = await agent_executor.run(load_agent_module, path, owner=owner)
+    if hasattr(mod, "handle_task_stream"):
+        async with agent_executor.slot(owner, blocking=False):
+            async for chunk in mod.handle_task_stream(task):
+                if chunk:
+                    yield chunk
+    elif hasattr(mod, "handle_task_async"):
+        yield await agent_executor.run_async(mod.handle_task_async, task, owner=owner)
+    elif hasattr(mod, "handle_task"):
+        yield await agent_executor.run(mod.handle_task, task, owner=owner)
+    else:
+        raise AttributeError(f"Функция handle_task не найдена в {path.name}")
+
+
 async def call_agent_remote(url: str, task: str) -> Dict[str, Any]:
     """Отправляет задачу агенту, развернутому удаленно (через webhook)."""
     try:
@@ -107,7 +127,8 @@ async def call_agent_remote(url: str, task: str) -> Dict[str, Any]:
                 "text": task
             }
         }
-        r = requests.post(url.rstrip("/") + "/webhook", json=payload, timeout=20)
+        client = get_http_client()
+        r = await client.post(url.rstrip("/") + "/webhook", json=payload, timeout=20)
         r.raise_for_status()
         return {"ok": True, "source": "remote", "status": r.status_code, "result": r.text}
     except Exception as e:
@@ -116,71 +137,149 @@ async def call_agent_remote(url: str, task: str) -> Dict[str, Any]:
 
 
 # === Память агента ===
-def save_memory(agent_path: Path, record: dict[str, Any]):
-    """Сохраняет запись в memory.json агента (безопасно и атомарно)."""
-    mem_file = agent_path / "memory.json"
-    tmp_file = mem_file.with_suffix(".tmp")
-    lock = FileLock(str(mem_file) + ".lock")
-
-    with lock:
-        try:
-            memory = []
-            if mem_file.exists():
-                try:
-                    memory = json.loads(mem_file.read_text(encoding="utf-8"))
-                except json.JSONDecodeError:
-                    logger.warning(f"⚠️ Поврежден memory.json у {agent_path.name}, восстановлен.")
-                    memory = []
-
-            record["date"] = record.get("date") or datetime.utcnow().isoformat() + "Z"
-            memory.append(record)
-
-            with open(tmp_file, "w", encoding="utf-8") as f:
-                json.dump(memory, f, ensure_ascii=False, indent=2)
-            os.replace(tmp_file, mem_file)
-        except Exception as e:
-            logger.warning(f"Ошибка записи памяти агента {agent_path.name}: {e}")
+def save_memory(agent_path: Path, record: dict[str, Any], owner: str | None = None, slug: str | None = None):
+    """
+    Дописывает запись в память агента (append-only сегменты, см. core/memory.py).
+    С owner и slug обновляется и индекс последних записей владельца (/check_memory).
+    """
+    try:
+        record["date"] = record.get("date") or datetime.utcnow().isoformat() + "Z"
+        memory_log.append(agent_path, record)
+        memory_retriever.add(agent_path, record)
+        if owner and slug:
+            memory_index.record(owner, slug, record)
+    except Exception as e:
+        logger.warning(f"Ошибка записи памяти агента {agent_path.name}: {e}")
 
 
 # === Контекст ===
-async def call_agent_with_context(agent, task: str):
+def _prompt_context(context: dict | None, task: str) -> dict:
     """
-    Вызывает агента с учётом его контекста и PROMPT из bot.py.
-    Теперь:
-      - Контролирует размер контекста
-      - Подсчитывает примерное количество токенов
+    Часть контекста, которая идёт в промпт.
+    Служебные ключи (_updated, _token_count, ...) модели не нужны и делали бы
+    каждый промпт уникальным. Собственный прошлый ответ на ту же самую задачу
+    тоже не передаётся — повторный запуск не должен ссылаться сам на себя.
+    """
+    ctx = {k: v for k, v in (context or {}).items() if not k.startswith("_")}
+    if ctx.get("last_task") == task:
+        ctx.pop("last_task", None)
+        ctx.pop("last_result", None)
+    return ctx
+
+
+PROMPT_MEMORY_ITEMS = int(os.getenv("PROMPT_MEMORY_ITEMS", "3"))
+
+
+def _recent_memory(agent_path: Path, task: str, limit: int = PROMPT_MEMORY_ITEMS) -> str:
+    """Последние записи памяти агента (кроме записей о той же задаче), свежие — первыми."""
+    if limit <= 0:
+        return ""
+    try:
+        memory = memory_log.tail(agent_path, limit * 2)
+    except OSError:
+        return ""
+    records = [r for r in memory if isinstance(r, dict) and r.get("task") != task][-limit:]
+    records.reverse()  # свежие — первыми: при нехватке бюджета обрезается самое старое
+    return "\n".join(f"- {r.get('task', '')} → {r.get('result', '')}" for r in records)
+
+
+def _relevant_memory(agent_path: Path, task: str, model: str) -> str:
+    """
+    Записи памяти, самые похожие на задачу (BM25, core/retrieval.py), в пределах
+    доли бюджета под память. Если похожих нет — последние записи, как раньше.
+    """
+    try:
+        found = memory_retriever.search(agent_path, task, exclude_task=task)
+    except OSError as e:
+        logger.warning(f"Поиск по памяти агента {agent_path.name} не удался: {e}")
+        found = []
+    if not found:
+        return _recent_memory(agent_path, task)
+    limit = int(budget_for(model) * PROMPT_MEMORY_SHARE)
+    lines, used = [], 0
+    for doc in found:
+        line = f"- {doc['text']}"
+        tokens = count_tokens(line, model) + 1
+        if lines and used + tokens > limit:
+            break
+        lines.append(line)
+        used += tokens
+    return "\n".join(lines)
+
+
+# === Старые боты ===
+# Боты, созданные до бюджета токенов, режут вход сами: task = task[-4000:],
+# затем query = PROMPT + "\n\nПользователь: " + task и ещё раз query[-4000:].
+# Промпт длиннее остатка после их PROMPT теряет начало. Роль такие боты
+# добавляют сами, поэтому менеджер её не повторяет и отдаёт место задаче.
+_LEGACY_CUT = re.compile(r"\b(?:task|query)\s*\[\s*-\s*(\d+)\s*:\s*\]")
+_LEGACY_QUERY_GLUE = "\n\nПользователь: "
+
+
+def _bot_prompt(bot_text: str) -> str:
+    """PROMPT из исходника bot.py (как есть, без strip)."""
+    match = re.search(r'PROMPT\s*=\s*"""(.*?)"""', bot_text, re.DOTALL)
+    return match.group(1) if match else ""
+
+
+def bot_char_limit(bot_text: str, bot_prompt: str | None = None) -> int | None:
+    """
+    Сколько символов задачи старый бот примет, ничего не обрезав; None — бот вход не режет.
+    bot_prompt — PROMPT, который бот сам добавит в начало запроса (по умолчанию — из bot_text).
+    Не меньше PROMPT_LEGACY_MIN_TASK_CHARS: при очень длинном PROMPT бот срежет
+    начало своей роли, но задача дойдёт (обрезка в боте оставляет конец запроса).
+    """
+    cuts = [int(n) for n in _LEGACY_CUT.findall(bot_text)]
+    if not cuts:
+        return None
+    if bot_prompt is None:
+        bot_prompt = _bot_prompt(bot_text)
+    limit = min(cuts)
+    return min(limit, max(PROMPT_LEGACY_MIN_TASK_CHARS, limit - len(bot_prompt) - len(_LEGACY_QUERY_GLUE)))
+
+
+def agent_char_limit(path: Path) -> int | None:
+    """bot_char_limit для агента по пути (None — bot.py нет или он вход не режет)."""
+    try:
+        return bot_char_limit((Path(path) / "bot.py").read_text(encoding="utf-8"))
+    except OSError:
+        return None
+
+
+def build_agent_prompt(agent, task: str, include_context: bool = True) -> dict:
+    """
+    Собирает полный промпт агента: PROMPT из bot.py + контекст команды + память + задача.
+    include_context=False — без контекста и памяти агента (вызывающий сам передаёт нужную их часть).
+      - Делит бюджет токенов модели между частями по приоритету (core/tokens.py)
+      - Считает токены через tiktoken
       - Логирует всё в debug
+    Возвращает {"prompt", "context", "token_count", "bot_digest", "budget"}.
     """
-    import json, re, importlib.util, logging
-    from datetime import datetime
-    from pathlib import Path
-    from core.mcp import load_context, save_context
-    from utils import call_agent_local
+    import hashlib
 
     logger = logging.getLogger("context")
 
     agent_id = agent["slug"]
     path = Path(agent["path"])
+    model = _agent_model(agent)
 
-    # === 1️⃣ Загружаем контекст ===
-    context = load_context(agent_id)
-    context_text = json.dumps(context or {}, ensure_ascii=False, indent=2)
-
-    # === 2️⃣ Ограничиваем размер контекста ===
-    MAX_CONTEXT_CHARS = 3000  # оптимально ~500–700 токенов
-    if len(context_text) > MAX_CONTEXT_CHARS:
-        logger.warning(f"[{agent_id}] Контекст слишком длинный ({len(context_text)} символов) — обрезаем.")
-        context_text = context_text[-MAX_CONTEXT_CHARS:]
+    # === 1️⃣ Загружаем контекст и память ===
+    context = load_context(agent)
+    context_text = json.dumps(_prompt_context(context, task), ensure_ascii=False, indent=2) if include_context else ""
+    memory_text = _relevant_memory(path, task, model) if include_context else ""
 
-    # === 3️⃣ Извлекаем PROMPT из bot.py ===
+    # === 2️⃣ Извлекаем PROMPT из bot.py ===
     prompt_text = ""
+    bot_digest = ""
+    char_limit = None
     bot_path = path / "bot.py"
     if bot_path.exists():
         try:
             text = bot_path.read_text(encoding="utf-8")
-            match = re.search(r'PROMPT\s*=\s*"""(.*?)"""', text, re.DOTALL)
-            if match:
-                prompt_text = match.group(1).strip()
+            bot_digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            raw_prompt = _bot_prompt(text)
+            prompt_text = raw_prompt.strip()
+            char_limit = bot_char_limit(text, raw_prompt)
         except Exception as e:
             logger.warning(f"[{agent_id}] Ошибка чтения PROMPT: {e}")
 
@@ -188,38 +287,121 @@ async def call_agent_with_context(agent, task: str):
     role_weight = 1.0 - team_bias
     context_weight = team_bias
 
-    # === 4️⃣ Формируем объединённый промпт ===
-    full_prompt = (
-        f"🧠 Роль агента (вес {role_weight:.1f}):\n"
-        f"{prompt_text or 'Универсальный сотрудник.'}\n\n"
-        f"📘 Контекст команды (вес {context_weight:.1f}):\n"
-        f"{context_text}\n\n"
-        f"🧩 Новая задача:\n{task}\n\n"
-        f"Ответь, учитывая баланс — "
-        f"{'ориентируйся на личное мнение' if role_weight > 0.6 else 'учитывай коллективное мнение команды'}."
-    )
-
-    # === 5️⃣ Примерная оценка количества токенов ===
-    def estimate_tokens(text: str):
-        # Простейшая эвристика — 1 токен ≈ 4 символа латиницы
-        return int(len(text) / 4)
-
-    token_count = estimate_tokens(full_prompt)
-    logger.info(f"[{agent_id}] ➜ {token_count} токенов (≈{len(full_prompt)} символов)")
-
-    # === 6️⃣ Вызов агента ===
-    result = await call_agent_local(path, full_prompt)
-
-    # === 7️⃣ Обновляем контекст ===
-    new_context = {
-        **(context or {}),
-        "last_task": task,
-        "last_result": result.get("result") if isinstance(result, dict) else str(result),
-        "_updated": datetime.now().isoformat(),
-        "_token_count": token_count
+    # === 3️⃣ Формируем объединённый промпт ===
+    def render(parts: dict) -> str:
+        context_block = (
+            f"📘 Контекст команды (вес {context_weight:.1f}):\n"
+            f"{parts['context']}\n\n"
+        ) if parts["context"] else ""
+        memory_block = f"🗂 Похожие задачи из памяти:\n{parts['memory']}\n\n" if parts["memory"] else ""
+        role_block = f"🧠 Роль агента (вес {role_weight:.1f}):\n{parts['role']}\n\n" if parts["role"] else ""
+        return (
+            f"{role_block}"
+            f"{context_block}"
+            f"{memory_block}"
+            f"🧩 Новая задача:\n{parts['task']}\n\n"
+            f"Ответь, учитывая баланс — "
+            f"{'ориентируйся на личное мнение' if role_weight > 0.6 else 'учитывай коллективное мнение команды'}."
+        )
+
+    # === 4️⃣ Делим бюджет токенов: роль → задача → контекст → память ===
+    # Старый бот сам ставит PROMPT перед запросом — роль не дублируем
+    sections = {
+        "role": "" if char_limit is not None else (prompt_text or "Универсальный сотрудник."),
+        "task": task,
+        "context": context_text,
+        "memory": memory_text,
     }
-    save_context(agent_id, new_context)
+    # Обвязка: заголовки и подписи без самих частей (заголовок роли — если роль есть)
+    skeleton = {k: "" for k in sections}
+    skeleton["role"] = " " if sections["role"] else ""
+    overhead = count_tokens(render(skeleton), model)
+    if char_limit is not None:
+        # Обвязка с заголовками контекста и памяти — они появятся, если эти части не пусты
+        char_limit = max(0, char_limit - len(render({"role": "", "task": "", "context": " ", "memory": " "})))
+    parts, budget = allocate(sections, model, overhead=overhead, char_limit=char_limit)
+    full_prompt = render(parts)
+
+    token_count = count_tokens(full_prompt, model)
+    logger.info(f"[{agent_id}] ➜ {token_count} токенов (≈{len(full_prompt)} символов, бюджет {budget['budget']})")
+
+    return {"prompt": full_prompt, "context": context, "token_count": token_count,
+            "bot_digest": bot_digest, "budget": budget}
+
+
+def remember_agent_result(agent, built: dict, task: str, result_text: str):
+    """Записывает последнюю задачу и результат в контекст агента."""
+    update_context(agent, {
+        "last_task": task,
+        "last_result": result_text,
+        "_token_count": built["token_count"]
+    })
+
+
+def _agent_model(agent) -> str:
+    return agent.get("model") or os.getenv("AMVERA_MODEL", "")
+
+
+def _response_cache_key(agent, built: dict) -> str | None:
+    if not cache_enabled_for(agent):
+        return None
+    return cache_key(_agent_model(agent), built["bot_digest"], built["prompt"])
+
+
+def _cacheable(text) -> bool:
+    return isinstance(text, str) and bool(text.strip()) and not text.startswith("⚠️")
 
+
+async def call_agent_with_context(agent, task: str, include_context: bool = True):
+    """
+    Вызывает агента с учётом его контекста и PROMPT из bot.py.
+    Одинаковые одновременные вызовы (владелец, агент, задача) выполняются один раз,
+    а одинаковый промпт к той же модели и версии bot.py отдаётся из кэша ответов.
+    В результат добавляется prompt_tokens — размер отправленного промпта.
+    """
+    key = (agent.get("owner"), agent["slug"], task, include_context)
+    return await agent_flights.do(key, _call_agent_with_context, agent, task, include_context)
+
+
+async def _call_agent_with_context(agent, task: str, include_context: bool = True):
+    built = build_agent_prompt(agent, task, include_context)
+    key = _response_cache_key(agent, built)
+
+    cached = response_cache.get(key) if key else None
+    if cached is not None:
+        logger.info(f"💾 Ответ агента {agent['slug']} взят из кэша")
+        result = {"ok": True, "source": "cache", "result": cached, "cached": True}
+    else:
+        token_usage.record(built["token_count"], bool(built["budget"]["truncated"]))
+        result = await call_agent_local(Path(agent["path"]), built["prompt"], owner=agent.get("owner"))
+        if key and result.get("ok") and _cacheable(result.get("result")):
+            response_cache.put(key, result["result"], model=_agent_model(agent))
+
+    remember_agent_result(agent, built, task, result.get("result") if isinstance(result, dict) else str(result))
+    result["prompt_tokens"] = built["token_count"]
     return result
 
 
+async def stream_agent_with_context(agent, task: str):
+    """
+    Потоковый вариант call_agent_with_context: отдаёт фрагменты ответа по мере генерации.
+    Контекст обновляется только после того, как поток полностью дочитан.
+    """
+    built = build_agent_prompt(agent, task)
+    key = _response_cache_key(agent, built)
+
+    cached = response_cache.get(key) if key else None
+    if cached is not None:
+        yield cached
+        remember_agent_result(agent, built, task, cached)
+        return
+
+    token_usage.record(built["token_count"], bool(built["budget"]["truncated"]))
+    parts = []
+    async for chunk in stream_agent_local(Path(agent["path"]), built["prompt"], owner=agent.get("owner")):
+        parts.append(chunk)
+        yield chunk
+    result_text = "".join(parts)
+    if key and _cacheable(result_text):
+        response_cache.put(key, result_text, model=_agent_model(agent))
+    remember_agent_result(agent, built, task, result_text)